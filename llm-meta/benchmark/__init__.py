@@ -0,0 +1,8 @@
+"""离线性能基准测试
+
+  mock_llm  本地 OpenAI 兼容模拟服务：可配置延迟分布、流式分块节奏和错误注入
+  loadgen   按目标RPS发送请求并统计延迟分位数、吞吐量和错误率
+  run       启动模拟服务和被测服务，依次执行 scenarios.yaml 中的场景并与基线比较
+
+在 llm-meta 目录下运行：python -m benchmark.run
+"""
@@ -0,0 +1,186 @@
+"""按目标RPS发送请求（开环：不因响应变慢而降低发送速率）并统计结果"""
+import asyncio
+import json
+import random
+import time
+from collections import Counter
+from typing import Any, Dict, List, Optional
+
+import httpx
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+
+def percentile(values: List[float], p: float) -> Optional[float]:
+    """最近秩法分位数，values需已排序"""
+    if not values:
+        return None
+    rank = max(0, min(len(values) - 1, int(round(p / 100 * len(values) + 0.5)) - 1))
+    return round(values[rank], 2)
+
+
+def rss_bytes(pid: int) -> Optional[int]:
+    """进程常驻内存；未安装psutil时读取 /proc（仅Linux）"""
+    if psutil is not None:
+        try:
+            return psutil.Process(pid).memory_info().rss
+        except psutil.Error:
+            return None
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        return None
+    return None
+
+
+def _fill(value: Any, n: int) -> Any:
+    """把请求体字符串中的 {n} 替换为请求序号，使每个请求的提示词不同（避免命中缓存）"""
+    if isinstance(value, str):
+        return value.replace("{n}", str(n))
+    if isinstance(value, dict):
+        return {k: _fill(v, n) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_fill(v, n) for v in value]
+    return value
+
+
+class Result:
+    __slots__ = ("status", "latency_ms", "ttft_ms", "error")
+
+    def __init__(self, status: int, latency_ms: float, ttft_ms: Optional[float] = None, error: Optional[str] = None):
+        self.status = status
+        self.latency_ms = latency_ms
+        self.ttft_ms = ttft_ms
+        self.error = error
+
+
+async def _send(client: httpx.AsyncClient, spec: Dict[str, Any], n: int) -> Result:
+    body = _fill(spec.get("json"), n)
+    start = time.perf_counter()
+    try:
+        if not spec.get("stream"):
+            response = await client.request(spec.get("method", "GET"), spec["path"], json=body,
+                                            headers=spec.get("headers"))
+            await response.aread()
+            return Result(response.status_code, (time.perf_counter() - start) * 1000)
+
+        ttft = None
+        error = None
+        async with client.stream(spec.get("method", "POST"), spec["path"], json=body,
+                                 headers=spec.get("headers")) as response:
+            async for line in response.aiter_lines():
+                if line.startswith("event: error"):
+                    error = "stream error event"
+                elif ttft is None and line.startswith("data:") and '"delta"' in line:
+                    ttft = (time.perf_counter() - start) * 1000
+        status = response.status_code if error is None else 599
+        return Result(status, (time.perf_counter() - start) * 1000, ttft, error)
+    except httpx.HTTPError as e:
+        return Result(0, (time.perf_counter() - start) * 1000, error=type(e).__name__)
+
+
+async def run_load(base_url: str, spec: Dict[str, Any], rps: float, duration: float,
+                   pids: Optional[List[int]] = None, max_in_flight: int = 1000,
+                   arrivals: str = "uniform", timeout: float = 60.0, seed: Optional[int] = None) -> Dict[str, Any]:
+    """以rps的速率发送duration秒的请求，返回统计结果
+
+    arrivals 为 uniform 时等间隔发送，为 poisson 时按泊松过程发送。
+    同时在途的请求超过 max_in_flight 时不再发送并计入 dropped（说明被测服务已饱和）。
+    pids 中的进程在测试期间每0.5秒采样一次内存。
+    """
+    rng = random.Random(seed)
+    results: List[Result] = []
+    in_flight = 0
+    dropped = 0
+    memory: Dict[int, List[int]] = {pid: [] for pid in pids or []}
+    limits = httpx.Limits(max_connections=max_in_flight, max_keepalive_connections=max_in_flight)
+
+    async def one(n: int):
+        nonlocal in_flight
+        try:
+            results.append(await _send(client, spec, n))
+        finally:
+            in_flight -= 1
+
+    async def sample_memory():
+        while True:
+            for pid, samples in memory.items():
+                rss = rss_bytes(pid)
+                if rss is not None:
+                    samples.append(rss)
+            await asyncio.sleep(0.5)
+
+    async with httpx.AsyncClient(base_url=base_url, timeout=timeout, limits=limits) as client:
+        sampler = asyncio.ensure_future(sample_memory())
+        tasks = []
+        start = time.perf_counter()
+        next_at = 0.0
+        n = 0
+        while next_at < duration:
+            delay = start + next_at - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            if in_flight >= max_in_flight:
+                dropped += 1
+            else:
+                in_flight += 1
+                tasks.append(asyncio.ensure_future(one(n)))
+            n += 1
+            next_at += rng.expovariate(rps) if arrivals == "poisson" else 1 / rps
+        await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - start
+        sampler.cancel()
+        await asyncio.gather(sampler, return_exceptions=True)
+
+    ok = [r for r in results if 200 <= r.status < 300]
+    latencies = sorted(r.latency_ms for r in ok)
+    ttfts = sorted(r.ttft_ms for r in ok if r.ttft_ms is not None)
+    stats: Dict[str, Any] = {
+        "sent": n - dropped,
+        "dropped": dropped,
+        "ok": len(ok),
+        "error_rate": round(1 - len(ok) / n, 4) if n else 0.0,
+        "statuses": dict(Counter(str(r.status) for r in results)),
+        "target_rps": rps,
+        "throughput_rps": round(len(ok) / elapsed, 2) if elapsed else 0.0,
+        "p50_ms": percentile(latencies, 50),
+        "p95_ms": percentile(latencies, 95),
+        "p99_ms": percentile(latencies, 99),
+        "max_ms": round(latencies[-1], 2) if latencies else None,
+    }
+    if spec.get("stream"):
+        stats["ttft_p50_ms"] = percentile(ttfts, 50)
+        stats["ttft_p95_ms"] = percentile(ttfts, 95)
+    # 多个进程按同一时刻的采样相加
+    totals = [sum(samples) for samples in zip(*memory.values())]
+    if totals:
+        stats["rss_peak_mb"] = round(max(totals) / 2 ** 20, 1)
+        stats["rss_end_mb"] = round(totals[-1] / 2 ** 20, 1)
+    errors = Counter(r.error for r in results if r.error)
+    if errors:
+        stats["errors"] = dict(errors)
+    return stats
+
+
+def main():
+    """单独对某个接口施压：python -m benchmark.loadgen http://localhost:8000 '{"path": "/health"}' --rps 50"""
+    import argparse
+    parser = argparse.ArgumentParser(description="按目标RPS发送请求")
+    parser.add_argument("base_url")
+    parser.add_argument("spec", help='请求的JSON描述，如 {"method": "POST", "path": "/api/generate", "json": {...}}')
+    parser.add_argument("--rps", type=float, default=10)
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--pid", type=int, action="append", help="采样内存的进程ID")
+    args = parser.parse_args()
+    stats = asyncio.run(run_load(args.base_url, json.loads(args.spec), args.rps, args.duration, args.pid))
+    print(json.dumps(stats, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
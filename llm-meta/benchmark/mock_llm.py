@@ -0,0 +1,151 @@
+"""模拟的 OpenAI 兼容接口（/v1/chat/completions）
+
+行为由 profile 控制，可在启动时指定，也可通过 PUT /_profile 在场景之间切换：
+
+  latency:        非流式响应的延迟分布
+  first_chunk:    流式响应首个分块的延迟分布
+  chunk_interval: 流式分块之间的间隔分布
+  chunks:         流式分块数量
+  chunk_text:     每个分块的内容
+  error_rate:     直接返回错误状态码的概率
+  error_statuses: 注入的错误状态码，随机选择（429时附带Retry-After）
+  stream_error_rate: 流式响应在中途断开的概率
+
+延迟分布格式：
+  {"dist": "fixed", "ms": 100}
+  {"dist": "uniform", "min_ms": 50, "max_ms": 150}
+  {"dist": "normal", "mean_ms": 100, "stddev_ms": 20}
+  {"dist": "lognormal", "median_ms": 100, "sigma": 0.5}
+"""
+import argparse
+import asyncio
+import json
+import math
+import random
+import time
+from typing import Any, Dict, Optional
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+DEFAULT_PROFILE: Dict[str, Any] = {
+    "latency": {"dist": "lognormal", "median_ms": 200, "sigma": 0.4},
+    "first_chunk": {"dist": "lognormal", "median_ms": 150, "sigma": 0.4},
+    "chunk_interval": {"dist": "uniform", "min_ms": 10, "max_ms": 30},
+    "chunks": 20,
+    "chunk_text": "测试token ",
+    "error_rate": 0.0,
+    "error_statuses": [500],
+    "stream_error_rate": 0.0,
+}
+
+
+def sample_ms(spec: Optional[Dict[str, Any]], rng: random.Random) -> float:
+    """按分布配置采样一个延迟（毫秒），不小于0"""
+    if not spec:
+        return 0.0
+    dist = spec.get("dist", "fixed")
+    if dist == "fixed":
+        value = spec.get("ms", 0)
+    elif dist == "uniform":
+        value = rng.uniform(spec["min_ms"], spec["max_ms"])
+    elif dist == "normal":
+        value = rng.gauss(spec["mean_ms"], spec["stddev_ms"])
+    elif dist == "lognormal":
+        value = rng.lognormvariate(math.log(spec["median_ms"]), spec.get("sigma", 0.5))
+    else:
+        raise ValueError(f"不支持的延迟分布: {dist}")
+    return max(0.0, value)
+
+
+class MockState:
+    def __init__(self, profile: Optional[Dict[str, Any]] = None, seed: Optional[int] = None):
+        self.rng = random.Random(seed)
+        self.profile: Dict[str, Any] = dict(DEFAULT_PROFILE)
+        self.update(profile)
+        self.requests = 0
+        self.errors = 0
+
+    def update(self, profile: Optional[Dict[str, Any]]) -> None:
+        self.profile = dict(DEFAULT_PROFILE, **(profile or {}))
+
+    def delay(self, name: str) -> float:
+        return sample_ms(self.profile.get(name), self.rng) / 1000
+
+
+def create_app(profile: Optional[Dict[str, Any]] = None, seed: Optional[int] = None) -> FastAPI:
+    app = FastAPI(title="mock-llm")
+    state = MockState(profile, seed)
+    app.state.mock = state
+
+    @app.put("/_profile")
+    async def set_profile(request: Request):
+        state.update(await request.json())
+        return state.profile
+
+    @app.get("/_stats")
+    async def get_stats():
+        return {"requests": state.requests, "errors": state.errors}
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        state.requests += 1
+        profile = state.profile
+
+        if state.rng.random() < profile["error_rate"]:
+            state.errors += 1
+            status = state.rng.choice(profile["error_statuses"])
+            await asyncio.sleep(state.delay("first_chunk"))
+            headers = {"Retry-After": "1"} if status == 429 else None
+            return JSONResponse({"error": {"message": "injected error", "type": "mock"}},
+                                status_code=status, headers=headers)
+
+        if body.get("stream"):
+            return StreamingResponse(stream(body), media_type="text/event-stream")
+
+        await asyncio.sleep(state.delay("latency"))
+        text = profile["chunk_text"] * profile["chunks"]
+        return {
+            "id": f"mock-{state.requests}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "mock"),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": 10, "completion_tokens": profile["chunks"],
+                      "total_tokens": 10 + profile["chunks"]}
+        }
+
+    async def stream(body: Dict[str, Any]):
+        profile = state.profile
+        broken = state.rng.random() < profile["stream_error_rate"]
+        await asyncio.sleep(state.delay("first_chunk"))
+        for index in range(profile["chunks"]):
+            if index:
+                await asyncio.sleep(state.delay("chunk_interval"))
+            if broken and index == profile["chunks"] // 2:
+                # 模拟上游连接中途断开
+                state.errors += 1
+                raise ConnectionResetError("injected stream error")
+            chunk = {"choices": [{"index": 0, "delta": {"content": profile["chunk_text"]}}]}
+            yield f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
+        yield "data: [DONE]\n\n"
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="模拟的OpenAI兼容接口")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9100)
+    parser.add_argument("--profile", help="profile的JSON字符串")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    import uvicorn
+    profile = json.loads(args.profile) if args.profile else None
+    uvicorn.run(create_app(profile, args.seed), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
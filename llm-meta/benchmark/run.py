@@ -0,0 +1,295 @@
+"""运行基准测试
+
+  1. 启动模拟上游（benchmark/mock_llm.py）
+  2. 复制 config/config.yaml，把所有模型的接口地址改为模拟上游，在临时目录中启动 llm-meta 服务
+  3. 启动 server/ 下的监控服务（不可用时跳过监控场景）
+  4. 依次执行 scenarios.yaml 中的场景，输出延迟分位数、吞吐量和内存
+  5. 检查吞吐量是否达到目标RPS，并与基线比较，超出容差时以非0状态退出
+
+全程只访问本机，不需要网络和真实的API密钥。
+
+用法（在 llm-meta 目录下）：
+  python -m benchmark.run                       # 运行全部场景并与基线比较
+  python -m benchmark.run --only generate chat  # 只运行指定场景
+  python -m benchmark.run --save-baseline       # 将本次结果保存为基线
+  python -m benchmark.run --ci                  # CI中使用：缺少基线的场景也判定为失败
+"""
+import argparse
+import asyncio
+import json
+import os
+import secrets
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Dict, List, Optional
+
+import httpx
+import yaml
+
+from .loadgen import run_load
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+LLM_DIR = os.path.dirname(BENCH_DIR)
+MONITOR_DIR = os.path.join(os.path.dirname(LLM_DIR), "server")
+
+LATENCY_METRICS = ("p50_ms", "p95_ms", "p99_ms", "ttft_p50_ms", "ttft_p95_ms")
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_ready(url: str, process: subprocess.Popen, timeout: float = 30.0) -> bool:
+    """等待服务的健康检查接口返回200"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            return False
+        try:
+            if httpx.get(url, timeout=1.0).status_code == 200:
+                return True
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    return False
+
+
+def stop(process: Optional[subprocess.Popen]) -> None:
+    if process is None or process.poll() is not None:
+        return
+    process.terminate()
+    try:
+        process.wait(10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+
+
+def log_tail(log, lines: int = 20) -> str:
+    """进程输出的最后几行（临时目录在退出时删除，出错时直接打印）"""
+    log.flush()
+    with open(log.name, "r", encoding="utf-8", errors="replace") as f:
+        return "".join(f.readlines()[-lines:])
+
+
+def service_config(mock_url: str, workdir: str) -> str:
+    """生成被测服务的配置：保留 config/config.yaml 的设置，模型接口指向模拟上游"""
+    with open(os.path.join(LLM_DIR, "config", "config.yaml"), "r", encoding="utf-8") as f:
+        config = yaml.safe_load(f) or {}
+    for model_config in (config.get("models") or {}).values():
+        model_config.update(base_url=mock_url, api_key="benchmark")
+        for backend in model_config.get("backends") or []:
+            backend.update(base_url=mock_url, api_key="benchmark")
+    settings = config.setdefault("settings", {})
+    settings["config_reload"] = {"enabled": False}
+    path = os.path.join(workdir, "config", "config.yaml")
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        yaml.safe_dump(config, f, allow_unicode=True, sort_keys=False)
+    return path
+
+
+def start_processes(workdir: str, with_monitor: bool) -> Dict[str, Any]:
+    env = dict(os.environ, PYTHONPATH=LLM_DIR)
+    log = open(os.path.join(workdir, "processes.log"), "w")
+    procs: Dict[str, Any] = {"log": log}
+
+    mock_port = free_port()
+    procs["mock"] = subprocess.Popen(
+        [sys.executable, "-m", "benchmark.mock_llm", "--port", str(mock_port), "--seed", "1"],
+        cwd=LLM_DIR, env=env, stdout=log, stderr=subprocess.STDOUT
+    )
+    procs["mock_url"] = f"http://127.0.0.1:{mock_port}"
+    if not wait_ready(procs["mock_url"] + "/_stats", procs["mock"]):
+        raise RuntimeError(f"模拟上游启动失败:\n{log_tail(log)}")
+
+    service_port = free_port()
+    config_path = service_config(procs["mock_url"] + "/v1", workdir)
+    procs["service"] = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "src.main:app", "--host", "127.0.0.1",
+         "--port", str(service_port), "--log-level", "warning"],
+        cwd=workdir, stdout=log, stderr=subprocess.STDOUT,
+        env=dict(env, LLM_CONFIG_PATH=config_path, LOG_LEVEL="WARNING",
+                 LOG_FILE=os.path.join(workdir, "llm_api.log"))
+    )
+    procs["service_url"] = f"http://127.0.0.1:{service_port}"
+    if not wait_ready(procs["service_url"] + "/health", procs["service"]):
+        raise RuntimeError(f"被测服务启动失败:\n{log_tail(log)}")
+
+    procs["monitor"] = None
+    if with_monitor and os.path.isdir(MONITOR_DIR):
+        monitor_port = free_port()
+        procs["monitor_key"] = secrets.token_hex(24)
+        procs["monitor"] = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1",
+             "--port", str(monitor_port), "--log-level", "warning"],
+            cwd=MONITOR_DIR, stdout=log, stderr=subprocess.STDOUT,
+            env=dict(os.environ, API_KEY=procs["monitor_key"], RATE_LIMIT="1000000000", LOG_LEVEL="WARNING",
+                     DB_URL=f"sqlite:///{os.path.join(workdir, 'monitor.db')}",
+                     LOG_FILE=os.path.join(workdir, "monitor.log"))
+        )
+        procs["monitor_url"] = f"http://127.0.0.1:{monitor_port}"
+        if not wait_ready(procs["monitor_url"] + "/health", procs["monitor"]):
+            print(f"监控服务启动失败，跳过监控场景:\n{log_tail(log, 5)}")
+            stop(procs["monitor"])
+            procs["monitor"] = None
+    return procs
+
+
+def check_target(name: str, current: Dict[str, Any], tolerance: Dict[str, Any]) -> List[str]:
+    """不依赖基线的检查：按目标RPS发出的请求有相当一部分没有成功完成，说明服务跟不上负载
+
+    不直接比较 throughput_rps：它按包含收尾时间的总耗时计算，长请求的场景即使没有积压也低于目标RPS
+    """
+    scheduled = current.get("sent", 0) + current.get("dropped", 0)
+    if scheduled and current.get("ok", 0) < scheduled * tolerance.get("target_throughput", 0.90):
+        return [f"{name}: 只完成 {current.get('ok', 0)}/{scheduled} 个请求，未达到目标 {current.get('target_rps')} rps"]
+    return []
+
+
+def compare(name: str, current: Dict[str, Any], baseline: Dict[str, Any], tolerance: Dict[str, Any]) -> List[str]:
+    """返回超出容差的指标说明"""
+    failures = []
+    slack = tolerance.get("latency_slack_ms", 10)
+    for metric in LATENCY_METRICS:
+        base, value = baseline.get(metric), current.get(metric)
+        if base is not None and value is not None and value > base * (1 + tolerance.get("latency", 0.25)) + slack:
+            failures.append(f"{name}.{metric}: {value} > 基线 {base}")
+    # 吞吐量按完成目标请求数的比例比较：throughput_rps 受 --rps-scale 和 --duration（收尾时间占比）影响，
+    # 不能直接与基线对比
+    base_scheduled = baseline.get("sent", 0) + baseline.get("dropped", 0)
+    scheduled = current.get("sent", 0) + current.get("dropped", 0)
+    if base_scheduled and scheduled:
+        base_ratio, ratio = baseline.get("ok", 0) / base_scheduled, current.get("ok", 0) / scheduled
+        if ratio < base_ratio * (1 - tolerance.get("throughput", 0.10)):
+            failures.append(f"{name}.throughput: 完成 {ratio:.0%} 的目标请求 < 基线 {base_ratio:.0%}")
+    else:
+        base, value = baseline.get("throughput_rps"), current.get("throughput_rps", 0)
+        if base and value < base * (1 - tolerance.get("throughput", 0.10)):
+            failures.append(f"{name}.throughput_rps: {value} < 基线 {base}")
+    base, value = baseline.get("error_rate", 0), current.get("error_rate", 0)
+    if value > base + tolerance.get("error_rate", 0.01):
+        failures.append(f"{name}.error_rate: {value} > 基线 {base}")
+    base, value = baseline.get("rss_peak_mb"), current.get("rss_peak_mb")
+    if base and value and value > base * (1 + tolerance.get("memory", 0.30)):
+        failures.append(f"{name}.rss_peak_mb: {value} > 基线 {base}")
+    return failures
+
+
+def print_table(results: Dict[str, Dict[str, Any]]) -> None:
+    columns = ("throughput_rps", "p50_ms", "p95_ms", "p99_ms", "ttft_p95_ms", "error_rate", "rss_peak_mb")
+    print(f"{'场景':<24}" + "".join(f"{c:>15}" for c in columns))
+    for name, stats in results.items():
+        if stats.get("skipped"):
+            print(f"{name:<24}{'跳过':>15}")
+            continue
+        print(f"{name:<24}" + "".join(f"{str(stats.get(c, '-')):>15}" for c in columns))
+
+
+async def run_scenarios(procs: Dict[str, Any], spec: Dict[str, Any], only: Optional[List[str]],
+                        duration: Optional[float], rps_scale: float) -> Dict[str, Dict[str, Any]]:
+    defaults = spec.get("defaults", {})
+    profiles = spec.get("mock_profiles", {})
+    results: Dict[str, Dict[str, Any]] = {}
+    async with httpx.AsyncClient(base_url=procs["mock_url"]) as mock:
+        for scenario in spec.get("scenarios", []):
+            name = scenario["name"]
+            if only and name not in only:
+                continue
+            options = dict(defaults, **scenario)
+            request = dict(options["request"])
+            if options.get("target") == "monitor":
+                if procs["monitor"] is None:
+                    results[name] = {"skipped": True}
+                    continue
+                base_url, pid = procs["monitor_url"], procs["monitor"].pid
+                request["headers"] = dict(request.get("headers") or {}, **{"X-API-Key": procs["monitor_key"]})
+            else:
+                base_url, pid = procs["service_url"], procs["service"].pid
+            await mock.put("/_profile", json=profiles.get(options.get("profile"), {}))
+
+            rps = options["rps"] * rps_scale
+            load = dict(pids=[pid], max_in_flight=options["max_in_flight"], arrivals=options["arrivals"], seed=1)
+            if options.get("warmup"):
+                await run_load(base_url, request, rps, options["warmup"], **load)
+            print(f"运行 {name}：{rps} rps，{duration or options['duration']} 秒")
+            results[name] = await run_load(base_url, request, rps, duration or options["duration"], **load)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="离线性能基准测试")
+    parser.add_argument("--scenarios", default=os.path.join(BENCH_DIR, "scenarios.yaml"))
+    parser.add_argument("--baseline", default=os.path.join(BENCH_DIR, "baseline.json"))
+    parser.add_argument("--only", nargs="*", help="只运行指定名称的场景")
+    parser.add_argument("--duration", type=float, help="覆盖每个场景的持续时间（秒）")
+    parser.add_argument("--rps-scale", type=float, default=1.0, help="所有场景的RPS乘以此系数")
+    parser.add_argument("--no-monitor", action="store_true", help="不启动监控服务")
+    parser.add_argument("--save-baseline", action="store_true", help="将本次结果保存为基线")
+    parser.add_argument("--report", help="将本次结果写入JSON文件")
+    parser.add_argument("--ci", action="store_true", help="缺少基线文件或场景没有基线时判定为失败")
+    args = parser.parse_args()
+
+    with open(args.scenarios, "r", encoding="utf-8") as f:
+        spec = yaml.safe_load(f)
+
+    with tempfile.TemporaryDirectory(prefix="llm-bench-") as workdir:
+        procs = {}
+        try:
+            procs = start_processes(workdir, not args.no_monitor)
+            results = asyncio.run(run_scenarios(procs, spec, args.only, args.duration, args.rps_scale))
+        finally:
+            for key in ("monitor", "service", "mock"):
+                stop(procs.get(key))
+            if procs.get("log"):
+                procs["log"].close()
+
+    print()
+    print_table(results)
+    if args.report:
+        with open(args.report, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+    if args.save_baseline:
+        baseline = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline, "r", encoding="utf-8") as f:
+                baseline = json.load(f)
+        baseline.update({name: stats for name, stats in results.items() if not stats.get("skipped")})
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(baseline, f, ensure_ascii=False, indent=2)
+        print(f"\n基线已保存: {args.baseline}")
+        return
+
+    # 场景中的 tolerance 覆盖全局容差
+    tolerances = {scenario["name"]: dict(spec.get("tolerance", {}), **scenario.get("tolerance", {}))
+                  for scenario in spec.get("scenarios", [])}
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+    else:
+        print(f"\n未找到基线 {args.baseline}，使用 --save-baseline 保存本次结果作为基线")
+    failures = []
+    for name, stats in results.items():
+        if stats.get("skipped"):
+            continue
+        failures += check_target(name, stats, tolerances[name])
+        if name in baseline:
+            failures += compare(name, stats, baseline[name], tolerances[name])
+        elif args.ci:
+            failures.append(f"{name}: 没有基线")
+    if failures:
+        print("\n性能回退：")
+        for failure in failures:
+            print(f"  {failure}")
+        sys.exit(1)
+    print("\n与基线相比未发现性能回退")
+
+
+if __name__ == "__main__":
+    main()
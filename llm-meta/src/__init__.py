@@ -0,0 +1 @@
+# 企业大模型公共服务后端
@@ -0,0 +1,241 @@
+"""批量生成
+
+提供两种方式：
+  - /api/generate/batch：一次提交多条提示词，结果按完成顺序以NDJSON流式返回
+  - 批量任务：上传JSONL文件，后台执行并逐行写入结果文件，服务重启后自动续跑
+
+每个模型有全局并发上限，多个批量请求同时运行时共享该上限。
+"""
+import asyncio
+import json
+import logging
+import os
+import time
+import uuid
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Iterable, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# process(model_id, item) -> 结果文本
+ProcessFn = Callable[[str, Dict[str, Any]], Awaitable[str]]
+
+
+class BatchRunner:
+    def __init__(self):
+        self.default_concurrency = 8
+        self.jobs_dir = os.path.join("data", "batch")
+        self.process: Optional[ProcessFn] = None
+        self._semaphores: Dict[str, asyncio.Semaphore] = {}
+        self._limits: Dict[str, int] = {}
+        self._jobs: Dict[str, Dict[str, Any]] = {}
+        self._tasks: Dict[str, "asyncio.Task"] = {}
+
+    def configure(self, settings: Optional[Dict[str, Any]], models: Dict[str, Any], process: ProcessFn) -> None:
+        """根据 settings.batch 和各模型的 batch_concurrency 初始化"""
+        settings = settings or {}
+        self.default_concurrency = settings.get("max_concurrency", 8)
+        self.jobs_dir = settings.get("jobs_dir", os.path.join("data", "batch"))
+        self.process = process
+        self._limits = {
+            model_id: model_config.get("batch_concurrency", self.default_concurrency)
+            for model_id, model_config in models.items()
+        }
+        self._semaphores = {}
+        os.makedirs(self.jobs_dir, exist_ok=True)
+
+    def concurrency(self, model_id: str) -> int:
+        return self._limits.get(model_id, self.default_concurrency)
+
+    def _semaphore(self, model_id: str) -> asyncio.Semaphore:
+        semaphore = self._semaphores.get(model_id)
+        if semaphore is None:
+            semaphore = asyncio.Semaphore(self.concurrency(model_id))
+            self._semaphores[model_id] = semaphore
+        return semaphore
+
+    async def _run_item(self, model_id: str, index: int, item: Dict[str, Any]) -> Dict[str, Any]:
+        item_id = item.get("id", index)
+        start = time.perf_counter()
+        try:
+            async with self._semaphore(model_id):
+                text = await self.process(model_id, item)
+            result = {"id": item_id, "status": "ok", "text": text}
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            result = {"id": item_id, "status": "error", "error": str(e)}
+        result["latency_ms"] = round((time.perf_counter() - start) * 1000, 1)
+        return result
+
+    async def run(self, model_id: str, items: Iterable[Tuple[int, Dict[str, Any]]]) -> AsyncIterator[Dict[str, Any]]:
+        """并发处理items，按完成顺序产出结果；调用方停止迭代时取消剩余任务"""
+        results: asyncio.Queue = asyncio.Queue()
+        iterator = iter(items)
+        finished = object()
+
+        async def worker():
+            for index, item in iterator:
+                await results.put(await self._run_item(model_id, index, item))
+
+        async def supervise():
+            workers = [asyncio.ensure_future(worker()) for _ in range(self.concurrency(model_id))]
+            try:
+                await asyncio.gather(*workers)
+            except Exception:
+                # 读取items出错时停止其余worker
+                for task in workers:
+                    task.cancel()
+                raise
+            finally:
+                await results.put(finished)
+
+        supervisor = asyncio.ensure_future(supervise())
+        try:
+            while True:
+                result = await results.get()
+                if result is finished:
+                    break
+                yield result
+            # items未能全部读取时向调用方抛出异常，而不是当作已全部完成
+            await supervisor
+        finally:
+            if not supervisor.done():
+                supervisor.cancel()
+
+    # ---- JSONL 批量任务 ----
+
+    def _job_path(self, job_id: str, name: str) -> str:
+        return os.path.join(self.jobs_dir, job_id, name)
+
+    def _save_meta(self, job: Dict[str, Any]) -> None:
+        path = self._job_path(job["job_id"], "meta.json")
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(job, f, ensure_ascii=False)
+        os.replace(path + ".tmp", path)
+
+    def create_job(self, model_id: str, content: bytes) -> Dict[str, Any]:
+        """保存上传的JSONL输入文件并启动任务"""
+        job_id = uuid.uuid4().hex
+        os.makedirs(os.path.join(self.jobs_dir, job_id))
+        with open(self._job_path(job_id, "input.jsonl"), "wb") as f:
+            f.write(content)
+        job = {
+            "job_id": job_id,
+            "model_id": model_id,
+            "state": "pending",
+            "total": sum(1 for line in content.splitlines() if line.strip()),
+            "succeeded": 0,
+            "failed": 0,
+            "created_at": time.time()
+        }
+        self._save_meta(job)
+        self._start(job)
+        return job
+
+    def get_job(self, job_id: str) -> Optional[Dict[str, Any]]:
+        job = self._jobs.get(job_id)
+        if job is None and os.path.exists(self._job_path(job_id, "meta.json")):
+            with open(self._job_path(job_id, "meta.json"), "r", encoding="utf-8") as f:
+                job = json.load(f)
+        return job
+
+    def output_path(self, job_id: str) -> str:
+        return self._job_path(job_id, "output.jsonl")
+
+    def resume_jobs(self) -> None:
+        """启动时继续执行上次未完成的任务"""
+        for job_id in os.listdir(self.jobs_dir):
+            meta_path = self._job_path(job_id, "meta.json")
+            if not os.path.exists(meta_path):
+                continue
+            with open(meta_path, "r", encoding="utf-8") as f:
+                job = json.load(f)
+            if job["state"] in ("pending", "running"):
+                logger.info(f"继续执行批量任务: {job_id}")
+                self._start(job)
+
+    def _start(self, job: Dict[str, Any]) -> None:
+        self._jobs[job["job_id"]] = job
+        task = asyncio.ensure_future(self._run_job(job))
+        self._tasks[job["job_id"]] = task
+        task.add_done_callback(lambda _: self._tasks.pop(job["job_id"], None))
+
+    def _completed_ids(self, job_id: str) -> Dict[Any, str]:
+        """读取已写入的结果，返回 id -> 状态（同一id以最后一条为准）"""
+        statuses: Dict[Any, str] = {}
+        output_path = self.output_path(job_id)
+        if not os.path.exists(output_path):
+            return statuses
+        with open(output_path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    result = json.loads(line)
+                except ValueError:
+                    continue  # 异常退出时最后一行可能不完整
+                statuses[result["id"]] = result["status"]
+        return statuses
+
+    def _ends_with_newline(self, job_id: str) -> bool:
+        with open(self.output_path(job_id), "rb") as f:
+            f.seek(-1, os.SEEK_END)
+            return f.read(1) == b"\n"
+
+    def _pending_items(self, job_id: str, done_ids: Dict[Any, str]) -> Iterable[Tuple[int, Dict[str, Any]]]:
+        with open(self._job_path(job_id, "input.jsonl"), "r", encoding="utf-8") as f:
+            index = 0
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    item = json.loads(line)
+                    if not isinstance(item, dict):
+                        raise ValueError("不是JSON对象")
+                    hash(item.get("id", index))
+                except (ValueError, TypeError):
+                    # 无效的行（包括id不可哈希的）作为单条失败的结果写出
+                    item = {"id": index, "invalid": line.strip()[:100]}
+                if done_ids.get(item.get("id", index)) != "ok":
+                    yield index, item
+                index += 1
+
+    async def _run_job(self, job: Dict[str, Any]) -> None:
+        job_id = job["job_id"]
+        statuses = self._completed_ids(job_id)
+        job["succeeded"] = sum(1 for status in statuses.values() if status == "ok")
+        job["failed"] = len(statuses) - job["succeeded"]
+        job["state"] = "running"
+        self._save_meta(job)
+        try:
+            with open(self.output_path(job_id), "a", encoding="utf-8") as out:
+                if out.tell() > 0 and not self._ends_with_newline(job_id):
+                    out.write("\n")  # 上次异常退出留下的半行单独成行，读取时会被跳过
+                async for result in self.run(job["model_id"], self._pending_items(job_id, statuses)):
+                    out.write(json.dumps(result, ensure_ascii=False) + "\n")
+                    out.flush()
+                    if result["status"] == "ok":
+                        job["succeeded"] += 1
+                        if statuses.get(result["id"]) == "error":
+                            job["failed"] -= 1
+                    elif result["id"] not in statuses:
+                        job["failed"] += 1
+                    statuses[result["id"]] = result["status"]
+            job["state"] = "completed"
+        except asyncio.CancelledError:
+            # 服务关闭，保持running状态以便下次启动续跑
+            raise
+        except Exception as e:
+            logger.error(f"批量任务执行失败 {job_id}: {str(e)}")
+            job["state"] = "failed"
+            job["error"] = str(e)
+        finally:
+            self._save_meta(job)
+
+    async def close(self) -> None:
+        for task in list(self._tasks.values()):
+            task.cancel()
+        if self._tasks:
+            await asyncio.gather(*self._tasks.values(), return_exceptions=True)
+
+
+# 全局批量执行器
+batch_runner = BatchRunner()
@@ -0,0 +1,140 @@
+"""API调用日志
+
+请求处理中只把日志条目放入内存环形缓冲区，由后台线程批量序列化并写入文件，
+写入不会阻塞事件循环。文件按 settings.logging 的 max_size/backups 轮转；
+缓冲区写满时按配置丢弃最旧（oldest）或最新（newest）的条目，并记录丢弃数量。
+"""
+import json
+import logging
+import os
+import re
+import threading
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional
+
+from .shared_state import file_lock
+
+logger = logging.getLogger(__name__)
+
+_SIZE_UNITS = {"": 1, "B": 1, "KB": 1024, "MB": 1024 ** 2, "GB": 1024 ** 3}
+
+
+def parse_size(value: Any) -> int:
+    """解析 "10MB" 形式的大小配置"""
+    if isinstance(value, (int, float)):
+        return int(value)
+    match = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*([KMG]?B?)\s*", str(value).upper())
+    if not match:
+        raise ValueError(f"无法解析的大小: {value}")
+    return int(float(match.group(1)) * _SIZE_UNITS[match.group(2)])
+
+
+class ApiCallLog:
+    def __init__(self):
+        self.path = os.path.join("logs", "api_calls.log")
+        self.max_size = 10 * 1024 ** 2
+        self.backups = 3
+        self.flush_interval = 1.0
+        self.drop = "oldest"
+        self.buffer_size = 10000
+        self.written = 0
+        self.dropped = 0
+        self._buffer: Deque[Dict[str, Any]] = deque()
+        self._cond = threading.Condition()
+        self._closing = False
+        self._thread: Optional[threading.Thread] = None
+
+    def configure(self, settings: Optional[Dict[str, Any]]) -> None:
+        """根据 settings.logging 初始化并启动后台写入线程"""
+        settings = settings or {}
+        api_calls = settings.get("api_calls", {})
+        self.path = api_calls.get("file", os.path.join("logs", "api_calls.log"))
+        self.max_size = parse_size(settings.get("max_size", "10MB"))
+        self.backups = settings.get("backups", 3)
+        self.flush_interval = api_calls.get("flush_interval", 1.0)
+        self.drop = api_calls.get("drop", "oldest")
+        self.buffer_size = api_calls.get("buffer_size", 10000)
+        self._buffer = deque(maxlen=self.buffer_size if self.drop == "oldest" else None)
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        self._closing = False
+        self._thread = threading.Thread(target=self._run, name="api-call-log", daemon=True)
+        self._thread.start()
+
+    def record(self, entry: Dict[str, Any]) -> None:
+        """放入缓冲区，不做任何I/O"""
+        if len(self._buffer) >= self.buffer_size:
+            self.dropped += 1
+            if self.drop != "oldest":
+                return
+        self._buffer.append(entry)
+
+    def _drain(self) -> List[Dict[str, Any]]:
+        entries = []
+        while True:
+            try:
+                entries.append(self._buffer.popleft())
+            except IndexError:
+                return entries
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                if not self._closing:
+                    self._cond.wait(self.flush_interval)
+                closing = self._closing
+            entries = self._drain()
+            if entries:
+                try:
+                    self._write(entries)
+                except Exception as e:
+                    logger.error(f"写入API调用日志失败: {str(e)}")
+            if closing:
+                return
+
+    def _write(self, entries: List[Dict[str, Any]]) -> None:
+        data = "".join(json.dumps(entry, ensure_ascii=False) + "\n" for entry in entries).encode("utf-8")
+        # 多个worker写同一个文件，判断大小和轮转在文件锁内进行，避免重复轮转
+        with file_lock(self.path + ".lock"):
+            try:
+                size = os.path.getsize(self.path)
+            except OSError:
+                size = 0
+            if size and size + len(data) > self.max_size:
+                self._rotate()
+            with open(self.path, "ab") as f:
+                f.write(data)
+        self.written += len(entries)
+
+    def _rotate(self) -> None:
+        """api_calls.log -> api_calls.log.1 -> ... -> api_calls.log.N（最旧的删除）"""
+        if self.backups <= 0:
+            os.remove(self.path)
+            return
+        for index in range(self.backups - 1, 0, -1):
+            source = f"{self.path}.{index}"
+            if os.path.exists(source):
+                os.replace(source, f"{self.path}.{index + 1}")
+        os.replace(self.path, f"{self.path}.1")
+
+    def close(self) -> None:
+        """写出缓冲区中剩余的条目"""
+        if self._thread is None:
+            return
+        with self._cond:
+            self._closing = True
+            self._cond.notify()
+        self._thread.join()
+        self._thread = None
+        if self.dropped:
+            logger.warning(f"API调用日志缓冲区已满，共丢弃 {self.dropped} 条")
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "buffered": len(self._buffer),
+            "written": self.written,
+            "dropped": self.dropped
+        }
+
+
+# 全局API调用日志
+api_call_log = ApiCallLog()
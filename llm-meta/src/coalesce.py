@@ -0,0 +1,159 @@
+"""相同请求合并（single-flight）
+
+同一时刻指纹相同的请求只向上游发送一次，其余请求等待并共享结果；
+流式请求的增量文本会同时分发给所有订阅者，后加入的订阅者先补发已产生的部分。
+所有等待者都离开后，上游请求会被取消。
+"""
+import asyncio
+import logging
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class _Call:
+    def __init__(self, task: "asyncio.Task"):
+        self.task = task
+        self.waiters = 0
+
+
+class _Broadcast:
+    def __init__(self):
+        self.chunks: List[str] = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.changed = asyncio.Event()
+        self.subscribers = 0
+        self.task: Optional["asyncio.Task"] = None
+
+    def notify(self) -> None:
+        # 唤醒当前所有等待者，并为下一轮准备新的事件
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+
+class SingleFlight:
+    def __init__(self):
+        self.enabled = True
+        self.leaders = 0
+        self.coalesced = 0
+        self._calls: Dict[str, _Call] = {}
+        self._streams: Dict[str, _Broadcast] = {}
+
+    def configure(self, settings: Optional[Dict[str, Any]]) -> None:
+        """根据 settings.coalescing 设置是否启用"""
+        self.enabled = (settings or {}).get("enabled", True)
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Any:
+        """执行fn；若相同key的调用正在进行，则等待其结果"""
+        if not self.enabled:
+            return await fn()
+
+        call = self._calls.get(key)
+        if call is None:
+            call = _Call(asyncio.ensure_future(fn()))
+            self._calls[key] = call
+            call.task.add_done_callback(lambda _: self._forget(self._calls, key, call))
+            self.leaders += 1
+        else:
+            self.coalesced += 1
+
+        call.waiters += 1
+        try:
+            return await asyncio.shield(call.task)
+        finally:
+            call.waiters -= 1
+            if call.waiters == 0 and not call.task.done():
+                # 取消的同时移除，之后到达的相同请求重新调用上游，而不是等待已取消的任务
+                self._forget(self._calls, key, call)
+                call.task.cancel()
+
+    def stream(self, key: str, factory: Callable[[], AsyncIterator[str]],
+               on_complete: Optional[Callable[[str], Awaitable[None]]] = None) -> AsyncIterator[str]:
+        """订阅相同key的流式调用，必要时由factory创建上游流"""
+        if not self.enabled:
+            return self._passthrough(factory(), on_complete)
+
+        broadcast = self._streams.get(key)
+        if broadcast is None:
+            broadcast = _Broadcast()
+            self._streams[key] = broadcast
+            broadcast.task = asyncio.ensure_future(self._pump(key, broadcast, factory(), on_complete))
+            self.leaders += 1
+        else:
+            self.coalesced += 1
+        return self._subscribe(key, broadcast)
+
+    async def _passthrough(self, chunks: AsyncIterator[str], on_complete) -> AsyncIterator[str]:
+        parts = []
+        async for chunk in chunks:
+            parts.append(chunk)
+            yield chunk
+        if on_complete is not None:
+            await on_complete("".join(parts))
+
+    async def _pump(self, key: str, broadcast: _Broadcast, chunks: AsyncIterator[str], on_complete) -> None:
+        try:
+            async for chunk in chunks:
+                broadcast.chunks.append(chunk)
+                broadcast.notify()
+        except asyncio.CancelledError:
+            broadcast.error = asyncio.CancelledError()
+            raise
+        except Exception as e:
+            broadcast.error = e
+        finally:
+            broadcast.done = True
+            broadcast.notify()
+            if broadcast.error is not None:
+                self._forget(self._streams, key, broadcast)
+
+        # 上游中途失败时已收到的只是部分内容，不写入缓存
+        if broadcast.error is not None:
+            return
+
+        # 写完缓存后再移除，避免期间到达的相同请求重复调用上游
+        try:
+            if on_complete is not None:
+                await on_complete("".join(broadcast.chunks))
+        except Exception as e:
+            logger.error(f"流式结果写入缓存失败: {str(e)}")
+        finally:
+            self._forget(self._streams, key, broadcast)
+
+    async def _subscribe(self, key: str, broadcast: _Broadcast) -> AsyncIterator[str]:
+        broadcast.subscribers += 1
+        position = 0
+        try:
+            while True:
+                if position < len(broadcast.chunks):
+                    position += 1
+                    yield broadcast.chunks[position - 1]
+                    continue
+                if broadcast.done:
+                    if broadcast.error is not None:
+                        raise broadcast.error
+                    return
+                await broadcast.changed.wait()
+        finally:
+            broadcast.subscribers -= 1
+            if broadcast.subscribers == 0 and not broadcast.done:
+                self._forget(self._streams, key, broadcast)
+                broadcast.task.cancel()
+
+    @staticmethod
+    def _forget(registry: Dict[str, Any], key: str, entry: Any) -> None:
+        if registry.get(key) is entry:
+            del registry[key]
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "leaders": self.leaders,
+            "coalesced": self.coalesced,
+            "in_flight": len(self._calls) + len(self._streams)
+        }
+
+
+# 全局请求合并器
+single_flight = SingleFlight()
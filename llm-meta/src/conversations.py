@@ -0,0 +1,246 @@
+"""对话会话
+
+按 conversation_id 在服务端保存对话历史，客户端每轮只需发送新消息。
+发送给模型的上下文按模型的token预算截取最近的消息（开头的system消息始终保留）；
+开启摘要后，超出预算的旧消息会在后台合并为摘要，作为system消息放在上下文开头。
+
+会话保存在进程内LRU中，可选写入 Redis 或 SQLite，服务重启或多进程部署时从中恢复；
+多worker部署时不使用进程内LRU，未配置存储时使用共享状态的存储。
+"""
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from .response_cache import LRUCache, RedisCache, aioredis
+from .tokenizer import tokenizer
+
+logger = logging.getLogger(__name__)
+
+# summarize(model_id, 已有摘要, 需要合并的消息) -> 新摘要
+SummarizeFn = Callable[[str, Optional[str], List[Dict[str, str]]], Awaitable[str]]
+
+
+class SQLiteSessions:
+    """与 RedisCache 相同接口的SQLite存储，读写在线程池中执行"""
+
+    def __init__(self, settings: Dict[str, Any]):
+        self.path = settings.get("path", os.path.join("data", "conversations.db"))
+        self.table = settings.get("table", "conversations")
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        self._conn = sqlite3.connect(self.path, check_same_thread=False, timeout=10)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            f"CREATE TABLE IF NOT EXISTS {self.table} "
+            "(id TEXT PRIMARY KEY, data TEXT NOT NULL, expires_at REAL NOT NULL)"
+        )
+        self._conn.commit()
+        self._lock = asyncio.Lock()
+
+    def _set(self, key: str, data: str, expires_at: float) -> None:
+        with self._conn:
+            self._conn.execute(f"INSERT OR REPLACE INTO {self.table} VALUES (?, ?, ?)", (key, data, expires_at))
+            self._conn.execute(f"DELETE FROM {self.table} WHERE expires_at < ?", (time.time(),))
+
+    def _get(self, key: str) -> Optional[str]:
+        row = self._get_row(key)
+        return row[0] if row else None
+
+    def _get_row(self, key: str) -> Optional[Tuple[str, float]]:
+        return self._conn.execute(
+            f"SELECT data, expires_at FROM {self.table} WHERE id = ? AND expires_at >= ?", (key, time.time())
+        ).fetchone()
+
+    async def set_data(self, key: str, data: Any, expire_seconds: int = 300) -> bool:
+        try:
+            loop = asyncio.get_running_loop()
+            async with self._lock:
+                await loop.run_in_executor(None, self._set, key, json.dumps(data, ensure_ascii=False),
+                                           time.time() + expire_seconds)
+            return True
+        except Exception as e:
+            logger.error(f"保存会话失败 - key: {key}, error: {str(e)}")
+            return False
+
+    async def get_data(self, key: str) -> Optional[Any]:
+        try:
+            loop = asyncio.get_running_loop()
+            async with self._lock:
+                data = await loop.run_in_executor(None, self._get, key)
+            return json.loads(data) if data else None
+        except Exception as e:
+            logger.error(f"读取会话失败 - key: {key}, error: {str(e)}")
+            return None
+
+    async def get_with_ttl(self, key: str) -> Tuple[Optional[Any], Optional[float]]:
+        """读取数据及其剩余有效期（秒）"""
+        try:
+            loop = asyncio.get_running_loop()
+            async with self._lock:
+                row = await loop.run_in_executor(None, self._get_row, key)
+            if not row:
+                return None, None
+            return json.loads(row[0]), row[1] - time.time()
+        except Exception as e:
+            logger.error(f"读取会话失败 - key: {key}, error: {str(e)}")
+            return None, None
+
+    async def delete_data(self, key: str) -> None:
+        loop = asyncio.get_running_loop()
+        async with self._lock:
+            await loop.run_in_executor(None, self._delete, key)
+
+    def _delete(self, key: str) -> None:
+        with self._conn:
+            self._conn.execute(f"DELETE FROM {self.table} WHERE id = ?", (key,))
+
+    async def close(self) -> None:
+        self._conn.close()
+
+
+class ConversationStore:
+    def __init__(self):
+        self.enabled = True
+        self.ttl = 86400
+        self.max_context_tokens = 3000
+        self.max_messages = 200
+        self.summarize: Optional[SummarizeFn] = None
+        self.memory = LRUCache(10000)
+        self.persistent = None
+        self.shared = None
+        self._summarizing: set = set()
+
+    def configure(self, settings: Optional[Dict[str, Any]], summarize: Optional[SummarizeFn] = None,
+                  shared: Optional[Any] = None) -> None:
+        """根据 settings.conversations 初始化，summarize 为None时不生成摘要
+
+        shared 为多进程共享的存储（见 shared_state），未配置持久化存储时使用它保存会话；
+        多worker时不使用进程内缓存，避免读到其他worker已更新过的旧会话。
+        """
+        settings = settings or {}
+        self.enabled = settings.get("enabled", True)
+        self.ttl = settings.get("ttl", 86400)
+        self.max_context_tokens = settings.get("max_context_tokens", 3000)
+        self.max_messages = settings.get("max_messages", 200)
+        self.summarize = summarize if settings.get("summarize", False) else None
+        self.memory = LRUCache(settings.get("max_sessions", 10000))
+        self.persistent = None
+        self.shared = shared
+        storage = settings.get("storage", "memory")
+        if storage == "redis":
+            if aioredis is None:
+                logger.warning("未安装redis，会话仅保存在内存中")
+            else:
+                self.persistent = RedisCache(dict({"prefix": "llm:conv:"}, **settings.get("redis", {})))
+        elif storage == "sqlite":
+            self.persistent = SQLiteSessions(settings.get("sqlite", {}))
+        if shared is not None:
+            self.memory = LRUCache(0)
+            if self.persistent is None:
+                self.persistent = shared
+
+    def budget(self, model_config: Dict[str, Any]) -> int:
+        return model_config.get("context_budget", self.max_context_tokens)
+
+    async def get(self, conversation_id: str) -> Dict[str, Any]:
+        """读取会话，不存在时返回空会话"""
+        session = self.memory.get(conversation_id)
+        if session is None and self.persistent is not None:
+            session = await self.persistent.get_data(conversation_id)
+            if session is not None:
+                self.memory.set(conversation_id, session, self.ttl)
+        return session or {"messages": [], "summary": None, "summarized": 0}
+
+    def context(self, session: Dict[str, Any], new_messages: List[Dict[str, str]],
+                budget: int) -> Tuple[List[Dict[str, str]], int]:
+        """返回(发送给模型的消息, 历史中第一条被保留的位置)
+
+        开头的system消息和本轮新消息始终保留，其余按从新到旧的顺序在预算内尽量保留。
+        """
+        history = session["messages"]
+        pinned = self._pinned(history)
+        head = list(history[:pinned])
+        if session.get("summary"):
+            head.append({"role": "system", "content": f"以下是之前对话的摘要：\n{session['summary']}"})
+
+        used = tokenizer.count_messages(head) + tokenizer.count_messages(new_messages)
+        start = len(history)
+        while start > max(pinned, session.get("summarized", 0)):
+            cost = tokenizer.count(history[start - 1]["content"]) + 4
+            if used + cost > budget:
+                break
+            used += cost
+            start -= 1
+        return head + history[start:] + new_messages, start
+
+    @staticmethod
+    def _pinned(messages: List[Dict[str, str]]) -> int:
+        """开头连续的system消息数量"""
+        pinned = 0
+        while pinned < len(messages) and messages[pinned]["role"] == "system":
+            pinned += 1
+        return pinned
+
+    async def append(self, conversation_id: str, session: Dict[str, Any], messages: List[Dict[str, str]],
+                     model_id: str, kept_from: int) -> None:
+        """追加本轮消息并保存；有消息超出预算时在后台生成摘要"""
+        history = session["messages"] + messages
+        excess = len(history) - self.max_messages
+        if excess > 0:
+            # 超出条数上限时丢弃最旧的消息（保留开头的system消息）
+            pinned = self._pinned(history)
+            history = history[:pinned] + history[pinned + excess:]
+            session["summarized"] = max(pinned, session.get("summarized", 0) - excess)
+            kept_from = max(pinned, kept_from - excess)
+        session["messages"] = history
+        session["updated_at"] = time.time()
+        await self._save(conversation_id, session)
+        summarized = max(self._pinned(history), session.get("summarized", 0))
+        if self.summarize is not None and kept_from > summarized and conversation_id not in self._summarizing:
+            self._summarizing.add(conversation_id)
+            asyncio.ensure_future(self._summarize(conversation_id, session, model_id, kept_from))
+
+    async def _save(self, conversation_id: str, session: Dict[str, Any]) -> None:
+        self.memory.set(conversation_id, session, self.ttl)
+        if self.persistent is not None:
+            await self.persistent.set_data(conversation_id, session, self.ttl)
+
+    async def _summarize(self, conversation_id: str, session: Dict[str, Any], model_id: str, kept_from: int) -> None:
+        try:
+            pinned = self._pinned(session["messages"])
+            start = max(pinned, session.get("summarized", 0))
+            dropped = session["messages"][start:kept_from]
+            if not dropped:
+                return
+            summary = await self.summarize(model_id, session.get("summary"), dropped)
+            # 生成摘要期间可能有新消息追加，按对象重新定位已合并的最后一条
+            history = session["messages"]
+            cut = next((i + 1 for i, message in enumerate(history) if message is dropped[-1]), None)
+            if cut is None:
+                return
+            # 已合并进摘要的消息不再保存
+            session["summary"] = summary
+            session["messages"] = history[:pinned] + history[cut:]
+            session["summarized"] = pinned
+            await self._save(conversation_id, session)
+        except Exception as e:
+            logger.error(f"生成对话摘要失败 {conversation_id}: {str(e)}")
+        finally:
+            self._summarizing.discard(conversation_id)
+
+    async def delete(self, conversation_id: str) -> None:
+        self.memory.delete(conversation_id)
+        if self.persistent is not None:
+            await self.persistent.delete_data(conversation_id)
+
+    async def close(self) -> None:
+        # 共享存储由 shared_state 关闭
+        if self.persistent is not None and self.persistent is not self.shared:
+            await self.persistent.close()
+
+
+# 全局会话存储
+conversation_store = ConversationStore()
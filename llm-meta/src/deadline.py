@@ -0,0 +1,147 @@
+"""请求截止时间与客户端断开
+
+客户端可以用请求头（默认 X-Request-Timeout，单位秒）限定整个请求的处理时间：
+限流排队、上游调用、重试、故障切换和对冲都计入其中，超时返回504
+（流式请求以 error 事件返回）。
+客户端断开连接时取消正在进行的处理，上游HTTP请求随之中断；
+合并的相同请求只有在所有等待者都离开后才会取消上游调用。
+"""
+import asyncio
+import time
+from contextvars import ContextVar
+from typing import Any, AsyncIterator, Awaitable, Dict, Optional
+
+# 当前请求的截止时间（time.monotonic()），None表示不限
+current_deadline: ContextVar[Optional[float]] = ContextVar("current_deadline", default=None)
+
+
+class DeadlineExceeded(Exception):
+    """超过请求的截止时间"""
+
+
+class ClientDisconnected(Exception):
+    """客户端在处理完成前断开了连接"""
+
+
+def remaining() -> Optional[float]:
+    """距截止时间的秒数，未设置截止时间时返回None"""
+    deadline = current_deadline.get()
+    return None if deadline is None else deadline - time.monotonic()
+
+
+class deadline_scope:
+    """在截止时间到达时取消当前任务中的等待并抛出 DeadlineExceeded（未设置截止时间时无开销）
+
+    与 asyncio.timeout 相同的做法，兼容 Python 3.10；范围内不能包含 yield。
+    """
+
+    def __init__(self):
+        self._handle: Optional[asyncio.TimerHandle] = None
+        self._task: Optional["asyncio.Task"] = None
+        self._expired = False
+
+    async def __aenter__(self) -> "deadline_scope":
+        left = remaining()
+        if left is None:
+            return self
+        if left <= 0:
+            raise DeadlineExceeded("已超过请求的截止时间")
+        self._task = asyncio.current_task()
+        self._handle = asyncio.get_running_loop().call_later(left, self._expire)
+        return self
+
+    def _expire(self) -> None:
+        self._expired = True
+        self._task.cancel()
+
+    async def __aexit__(self, exc_type, exc, tb) -> bool:
+        if self._handle is not None:
+            self._handle.cancel()
+        if self._expired and exc_type is asyncio.CancelledError:
+            uncancel = getattr(self._task, "uncancel", None)
+            if uncancel is not None:
+                uncancel()
+            raise DeadlineExceeded("已超过请求的截止时间") from None
+        return False
+
+
+class RequestDeadlines:
+    def __init__(self):
+        self.header = "X-Request-Timeout"
+        self.default_timeout = 0.0
+        self.max_timeout = 300.0
+
+    def configure(self, settings: Optional[Dict[str, Any]]) -> None:
+        """根据 settings.deadline 初始化"""
+        settings = settings or {}
+        self.header = settings.get("header", "X-Request-Timeout")
+        self.default_timeout = settings.get("default_timeout", 0)
+        self.max_timeout = settings.get("max_timeout", 300)
+
+    def begin(self, headers: Any) -> Optional[float]:
+        """按请求头（不区分大小写）设置当前请求的截止时间，请求头格式错误时抛出 ValueError"""
+        value = headers.get(self.header)
+        if value is None:
+            timeout = self.default_timeout
+        else:
+            try:
+                timeout = float(value)
+            except ValueError:
+                raise ValueError(f"{self.header} 必须是秒数: {value}")
+            if timeout <= 0:
+                raise ValueError(f"{self.header} 必须大于0")
+        if not timeout:
+            return None
+        deadline = time.monotonic() + min(timeout, self.max_timeout)
+        current_deadline.set(deadline)
+        return deadline
+
+
+async def until_disconnected(request: Any) -> None:
+    """等待客户端断开（请求体已读取完毕后，下一条ASGI消息只会是 http.disconnect）"""
+    while True:
+        message = await request.receive()
+        if message["type"] == "http.disconnect":
+            return
+
+
+async def guard(request: Any, work: Awaitable[Any]) -> Any:
+    """执行work；客户端断开时取消并抛出 ClientDisconnected，超过截止时间时取消并抛出 DeadlineExceeded"""
+    task = asyncio.ensure_future(work)
+    watcher = asyncio.ensure_future(until_disconnected(request))
+    try:
+        done, _ = await asyncio.wait({task, watcher}, timeout=remaining(), return_when=asyncio.FIRST_COMPLETED)
+        if task in done:
+            return task.result()
+        if watcher in done:
+            raise ClientDisconnected("客户端已断开")
+        raise DeadlineExceeded("已超过请求的截止时间")
+    finally:
+        for pending in (task, watcher):
+            if not pending.done():
+                pending.cancel()
+
+
+async def guard_stream(request: Any, events: AsyncIterator[Any]) -> AsyncIterator[Any]:
+    """转发流式响应；客户端断开时取消正在等待上游的迭代"""
+    consumer = asyncio.current_task()
+    disconnected = False
+
+    async def watch():
+        nonlocal disconnected
+        await until_disconnected(request)
+        disconnected = True
+        consumer.cancel()
+
+    watcher = asyncio.ensure_future(watch())
+    try:
+        async for event in events:
+            yield event
+    finally:
+        watcher.cancel()
+        if not disconnected:
+            await asyncio.gather(watcher, return_exceptions=True)
+
+
+# 全局请求截止时间设置
+request_deadlines = RequestDeadlines()
@@ -0,0 +1,147 @@
+"""模型健康探测
+
+并发向每个模型的每个后端发送一个极小的流式请求（max_tokens=1），记录是否可用、
+总延迟和首个token延迟。结果按后端缓存 ttl 秒：
+  - 缓存过期但仍有旧结果时直接返回旧结果，同时在后台刷新，调用方不必等待超时
+  - 同一后端同时只有一个探测在进行
+  - 探测失败的后端在路由中冷却 failure_cooldown 秒，请求优先发往其他后端（不计入请求的错误统计）
+  - 探测与正常请求一样受API密钥的限流约束
+可选按 interval 定期在后台探测全部模型。
+"""
+import asyncio
+import logging
+import time
+from typing import Any, Callable, Dict, Mapping, Optional
+
+from .providers import PROVIDER_LABELS, ProviderError, build_chat_payload, stream_chat_completion
+from .ratelimit import RateLimitExceeded, estimate_tokens, rate_limits
+from .router import router
+
+logger = logging.getLogger(__name__)
+
+
+class HealthProber:
+    def __init__(self):
+        self.ttl = 300
+        self.timeout = 10.0
+        self.prompt = "Hello"
+        self.failure_cooldown = 60
+        self.interval = 0
+        self._semaphore = asyncio.Semaphore(16)
+        self._results: Dict[str, Dict[str, Any]] = {}
+        self._probing: Dict[str, "asyncio.Future"] = {}
+        self._task: Optional["asyncio.Task"] = None
+
+    def configure(self, settings: Optional[Dict[str, Any]]) -> None:
+        """根据 settings.health 初始化"""
+        settings = settings or {}
+        self.ttl = settings.get("ttl", 300)
+        self.timeout = settings.get("timeout", 10.0)
+        self.prompt = settings.get("prompt", "Hello")
+        self.failure_cooldown = settings.get("failure_cooldown", 60)
+        self.interval = settings.get("interval", 0)
+        self._semaphore = asyncio.Semaphore(settings.get("concurrency", 16))
+
+    async def _probe(self, backend: Mapping[str, Any]) -> Dict[str, Any]:
+        """向单个后端发送探测请求"""
+        messages = [{"role": "user", "content": self.prompt}]
+        data = build_chat_payload(messages, backend, {"max_tokens": 1, "temperature": 0})
+        result: Dict[str, Any] = {"backend": backend.get("name", backend["model_name"]), "ok": False,
+                                  "status": None, "latency_ms": None, "ttft_ms": None, "error": None}
+        start = time.perf_counter()
+
+        async def consume():
+            async for _ in stream_chat_completion(backend, data, PROVIDER_LABELS[backend["provider"]]):
+                if result["ttft_ms"] is None:
+                    result["ttft_ms"] = round((time.perf_counter() - start) * 1000, 1)
+
+        limited = False
+        async with self._semaphore:
+            try:
+                # 探测同样消耗上游额度，与正常请求一样经过API密钥的限流，排队时间不计入延迟
+                limiter = rate_limits.key_limiter(backend)
+                async with rate_limits.hold(limiter, estimate_tokens(messages, {"max_tokens": 1})):
+                    start = time.perf_counter()
+                    try:
+                        await asyncio.wait_for(consume(), self.timeout)
+                        result["ok"] = True
+                        result["status"] = 200
+                    except asyncio.TimeoutError:
+                        result["error"] = f"{self.timeout}s内未响应"
+                    except ProviderError as e:
+                        result["status"] = e.status_code
+                        result["error"] = str(e)
+                    except Exception as e:
+                        result["error"] = f"{type(e).__name__}: {str(e)}"
+            except RateLimitExceeded as e:
+                # 本地额度不足，未发送探测，不据此判断后端不可用
+                limited = True
+                result["status"] = 429
+                result["error"] = f"未发送探测: {str(e)}"
+        result["latency_ms"] = round((time.perf_counter() - start) * 1000, 1)
+        result["checked_at"] = time.time()
+        if not limited:
+            # 路由时把探测失败的后端排在最后，在冷却结束或下次探测成功前不优先使用；
+            # 探测结果单独记录，不计入真实请求的错误率和错误数
+            router.stats_for(backend).record_probe(result["ok"], self.failure_cooldown)
+        return result
+
+    def _refresh(self, key: str, backend: Mapping[str, Any]) -> "asyncio.Future":
+        future = self._probing.get(key)
+        if future is None:
+            future = asyncio.ensure_future(self._probe(backend))
+            self._probing[key] = future
+
+            def done(f: "asyncio.Future") -> None:
+                self._probing.pop(key, None)
+                if not f.cancelled():
+                    self._results[key] = f.result()
+
+            future.add_done_callback(done)
+        return future
+
+    async def _backend(self, backend: Mapping[str, Any], force: bool) -> Dict[str, Any]:
+        key = router.backend_key(backend)
+        cached = self._results.get(key)
+        if cached is not None and not force:
+            if time.time() - cached["checked_at"] >= self.ttl:
+                self._refresh(key, backend)  # 先返回旧结果，后台刷新
+            return cached
+        return await asyncio.shield(self._refresh(key, backend))
+
+    async def check(self, models: Mapping[str, Mapping[str, Any]], force: bool = False) -> Dict[str, Dict[str, Any]]:
+        """并发探测所有模型，返回 {模型ID: {"healthy": ..., "backends": [...]}}"""
+        pairs = [(model_id, backend) for model_id, model_config in models.items()
+                 for backend in router.backends(model_config)]
+        results = await asyncio.gather(*(self._backend(backend, force) for _, backend in pairs))
+        health: Dict[str, Dict[str, Any]] = {model_id: {"healthy": False, "backends": []} for model_id in models}
+        for (model_id, _), result in zip(pairs, results):
+            health[model_id]["backends"].append(result)
+            health[model_id]["healthy"] = health[model_id]["healthy"] or result["ok"]
+        return health
+
+    def start(self, models: Callable[[], Mapping[str, Mapping[str, Any]]]) -> None:
+        """interval大于0时定期在后台探测，models返回当前的模型配置"""
+        if self.interval > 0:
+            self._task = asyncio.ensure_future(self._loop(models))
+
+    async def _loop(self, models: Callable[[], Mapping[str, Mapping[str, Any]]]) -> None:
+        while True:
+            try:
+                await self.check(models(), force=True)
+            except Exception as e:
+                logger.error(f"模型健康探测失败: {str(e)}")
+            await asyncio.sleep(self.interval)
+
+    async def stop(self) -> None:
+        tasks = list(self._probing.values())
+        if self._task is not None:
+            tasks.append(self._task)
+            self._task = None
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+# 全局健康探测器
+health_prober = HealthProber()
@@ -1,16 +1,36 @@
-from fastapi import FastAPI, HTTPException, Depends
+from fastapi import FastAPI, HTTPException, Depends, UploadFile, File, Form, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse, FileResponse, PlainTextResponse
 from pydantic import BaseModel
 from typing import List, Optional, Dict, Any
-import yaml
 import logging
-import requests
-import markdown
 import json
 import os
+import time
+import math
+import asyncio
 from datetime import datetime
 from dotenv import load_dotenv
 
+from .providers import ProviderError, client_pool, call_llm_api, call_chat_api, stream_llm_api, stream_chat_api
+from .response_cache import response_cache, request_fingerprint
+from .semantic_cache import semantic_cache
+from .coalesce import single_flight
+from .batch import batch_runner
+from .router import router
+from .call_log import api_call_log
+from .ratelimit import rate_limits, RateLimitExceeded, ClientContextMiddleware, estimate_tokens
+from .tokenizer import tokenizer, ContextOverflow
+from .usage import usage_store, INTERVALS
+from .registry import registry
+from .templates import TemplateError
+from .conversations import conversation_store
+from .render import markdown_renderer
+from .health import health_prober
+from .shared_state import shared_state
+from .metrics import metrics, MetricsMiddleware
+from .deadline import request_deadlines, current_deadline, guard, guard_stream, DeadlineExceeded, ClientDisconnected
+
 # 加载环境变量
 load_dotenv()
 
@@ -35,32 +55,74 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Prompt-Truncated"],
 )
+app.add_middleware(ClientContextMiddleware)
+app.add_middleware(MetricsMiddleware)
 
 # 加载配置
 def get_config():
-    if not hasattr(get_config, "config"):
-        config_path = os.path.join("config", "config.yaml")
-        try:
-            with open(config_path, "r", encoding="utf-8") as f:
-                config = yaml.safe_load(f)
-                # 替换环境变量
-                for model in config["models"].values():
-                    if "api_key" in model:
-                        model["api_key"] = os.path.expandvars(model["api_key"])
-                get_config.config = config
-                logger.info(f"配置加载成功: {config_path}")
-        except Exception as e:
-            logger.error(f"配置加载失败: {str(e)}")
-            get_config.config = {"models": {}, "prompt_templates": []}
-    return get_config.config
+    """当前配置文件内容，配置文件修改或收到SIGHUP后自动更新"""
+    return registry.current.raw
+
+# 初始化上游连接池
+@app.on_event("startup")
+async def startup_event():
+    settings = registry.current.settings
+    shared_state.configure(settings.get("shared_state"))
+    metrics.configure(settings.get("metrics"))
+    api_call_log.configure(settings.get("logging"))
+    tokenizer.configure(settings.get("tokenizer"))
+    usage_store.configure(settings.get("usage"))
+    client_pool.configure(settings.get("http_client"))
+    response_cache.configure(settings.get("response_cache"), shared_state.kv("response_cache"))
+    semantic_cache.configure(settings.get("semantic_cache"), shared_state.workers)
+    single_flight.configure(settings.get("coalescing"))
+    router.configure(settings.get("routing"))
+    rate_limits.configure(settings.get("rate_limit"), registry.current.models)
+    request_deadlines.configure(settings.get("deadline"))
+    batch_runner.configure(settings.get("batch"), registry.current.models, process_batch_item)
+    # 多worker时只由一个worker继续执行未完成的批量任务
+    if shared_state.lead("batch"):
+        batch_runner.resume_jobs()
+    conversation_store.configure(settings.get("conversations"), summarize_conversation,
+                                 shared_state.kv("conversations"))
+    markdown_renderer.configure(settings.get("markdown"))
+    health_prober.configure(settings.get("health"))
+    health_prober.start(lambda: registry.current.models)
+    # 配置重新加载后更新限流默认值和按密钥合并的限额，限额有变化的限流器在下次使用时重建
+    registry.on_reload(lambda snapshot: rate_limits.configure(snapshot.settings.get("rate_limit"), snapshot.models))
+    # 在线worker数变化后按新的份额调整限流额度
+    shared_state.on_share_change(rate_limits.rescale)
+    shared_state.start()
+    metrics.add_collector(collect_metrics)
+    metrics.start(shared_state.dir if shared_state.workers > 1 else None)
+    registry.start(settings.get("config_reload"))
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await registry.stop()
+    await metrics.stop()
+    await health_prober.stop()
+    await batch_runner.close()
+    await client_pool.aclose()
+    await response_cache.close()
+    semantic_cache.close()
+    await conversation_store.close()
+    await shared_state.close()
+    markdown_renderer.close()
+    api_call_log.close()
+    usage_store.close()
 
 # 模型请求
 class GenerateRequest(BaseModel):
-    prompt: str
+    prompt: Optional[str] = None
+    template_id: Optional[str] = None  # 使用服务端提示词模板，与prompt二选一
+    variables: Optional[Dict[str, Any]] = None  # 模板变量
     model_id: str = "default"
     parameters: Optional[Dict[str, Any]] = None
-    format: str = "markdown"  # 支持markdown和text
+    format: str = "markdown"  # 支持markdown、text和html（服务端渲染为HTML）
+    stream: bool = False  # 为true时以SSE逐段返回
 
 # 对话消息
 class Message(BaseModel):
@@ -70,82 +132,455 @@ class Message(BaseModel):
 # 对话历史请求
 class ChatRequest(BaseModel):
     messages: List[Message]
+    conversation_id: Optional[str] = None  # 使用服务端会话时messages只需包含本轮新消息
     model_id: str = "default"
     parameters: Optional[Dict[str, Any]] = None
     format: str = "markdown"
+    stream: bool = False
+
+# token计数请求
+class TokenizeRequest(BaseModel):
+    texts: List[str] = []
+    messages: Optional[List[Message]] = None  # 按对话消息计数（含每条消息的格式开销）
+    model_id: Optional[str] = None  # 指定时同时返回该模型的上下文长度
+
+# 批量生成中的单条请求
+class BatchItem(BaseModel):
+    id: Optional[Any] = None
+    prompt: Optional[str] = None
+    variables: Optional[Dict[str, Any]] = None  # 与请求的template_id配合使用
+    parameters: Optional[Dict[str, Any]] = None
+
+# 批量生成请求
+class BatchGenerateRequest(BaseModel):
+    items: List[BatchItem]
+    model_id: str = "default"
+    template_id: Optional[str] = None  # 对所有条目使用同一模板
+    variables: Optional[Dict[str, Any]] = None  # 所有条目共享的模板变量，条目自身变量优先
+    parameters: Optional[Dict[str, Any]] = None  # 对所有条目生效，条目自身参数优先
+    format: str = "markdown"  # 为html时每条结果附带渲染后的html
+
+def begin_deadline(http_request):
+    """按请求头设置本次请求的截止时间"""
+    try:
+        request_deadlines.begin(http_request.headers)
+    except ValueError as e:
+        raise HTTPException(400, str(e))
+
+def get_model_config(model_id):
+    """获取模型配置（只读），未找到时使用默认模型"""
+    start = time.perf_counter()
+    model_config = registry.current.model(model_id)
+    if model_config is None:
+        raise HTTPException(400, "模型未找到且无默认模型")
+    metrics.observe("config", model_config["name"], model_config["provider"], time.perf_counter() - start)
+    return model_config
+
+def resolve_prompt(prompt, template_id=None, variables=None):
+    """返回最终提示词：指定了template_id时用模板渲染，否则使用prompt"""
+    if template_id:
+        return registry.current.render_template(template_id, variables)
+    if not isinstance(prompt, str):
+        raise TemplateError("缺少prompt或template_id")
+    return prompt
+
+def merge_params(model_config, parameters):
+    """合并默认参数与请求参数"""
+    if parameters:
+        return {**model_config.get("default_params", {}), **parameters}
+    return dict(model_config.get("default_params", {}))
+
+def sse_event(data, event=None):
+    """格式化一条Server-Sent Events消息"""
+    prefix = f"event: {event}\n" if event else ""
+    return f"{prefix}data: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+async def cache_lookup(kind, messages, model_config, params, template=None):
+    """依次查询精确缓存和语义缓存
+
+    template 为(模板内容, 变量)时，语义缓存只按变量检索
+    返回(缓存结果, 写回函数)，未命中且需要缓存时写回函数不为None
+    """
+    cache_ttl = response_cache.ttl_for(model_config, params)
+    cache_key = request_fingerprint(kind, model_config, messages, params) if cache_ttl else None
+    if cache_key:
+        cached = await response_cache.get(cache_key, cache_ttl)
+        if cached:
+            return cached, None
+    
+    use_semantic = semantic_cache.enabled_for(model_config, params)
+    semantic_key = semantic_cache.key_of(messages, *(template or ())) if use_semantic else None
+    if use_semantic:
+        cached = await semantic_cache.lookup(kind, model_config, params, semantic_key)
+        if cached:
+            if cache_key:
+                await response_cache.set(cache_key, {"text": cached["text"]}, cache_ttl)
+            return cached, None
+    
+    if not cache_key and not use_semantic:
+        return None, None
+    
+    async def store(text):
+        if cache_key:
+            await response_cache.set(cache_key, {"text": text}, cache_ttl)
+        if use_semantic:
+            await semantic_cache.add(kind, model_config, params, semantic_key, text)
+    return None, store
+
+async def replay_text(text):
+    """以单个增量的形式重放缓存结果"""
+    yield text
+
+async def stream_events(chunks, model_config, prompt, params, response_format, cache_hit=False, usage_of=None):
+    """将上游增量文本转发为SSE事件，结束（或中断）时记录日志
+
+    usage_of(完整文本) 返回本请求消耗的用量，缓存命中或被合并的请求不传；
+    format为html时，每当有完整的块到达就在事件中附带这些块的html，客户端依次拼接即可
+    """
+    start = time.perf_counter()
+    first_token_ms = None
+    parts = []
+    status = "ok"
+    renderer = markdown_renderer.stream() if response_format == "html" else None
+    try:
+        async for delta in chunks:
+            if first_token_ms is None:
+                first_token_ms = round((time.perf_counter() - start) * 1000, 1)
+            parts.append(delta)
+            event = {"delta": delta}
+            html = renderer.feed(delta) if renderer else None
+            if html:
+                event["html"] = html
+            yield sse_event(event)
+        done = {"done": True, "model": model_config["name"], "format": response_format}
+        html = renderer.finish() if renderer else None
+        if html:
+            done["html"] = html
+        yield sse_event(done)
+    except (asyncio.CancelledError, GeneratorExit):
+        # 客户端断开
+        status = "cancelled"
+        raise
+    except Exception as e:
+        status = "error"
+        logger.error(f"流式调用失败: {str(e)}")
+        error = upstream_error(e, "调用模型失败")
+        yield sse_event({"error": error.detail, "status": error.status_code}, event="error")
+    finally:
+        log_api_call(model_config, prompt, "".join(parts), params, {
+            "stream": True,
+            "status": status,
+            "cache_hit": cache_hit,
+            "chunks": len(parts),
+            "first_token_ms": first_token_ms,
+            "total_ms": round((time.perf_counter() - start) * 1000, 1),
+            "usage": usage_of("".join(parts)) if usage_of else None
+        })
+
+def upstream_error(e, message):
+    """将调用异常转换为HTTP错误，限流类错误返回429并带上Retry-After，超过截止时间返回504"""
+    if isinstance(e, DeadlineExceeded):
+        return HTTPException(504, f"{message}: {str(e)}")
+    retry_after = getattr(e, "retry_after", None)
+    if isinstance(e, RateLimitExceeded) or (isinstance(e, ProviderError) and e.status_code == 429):
+        headers = {"Retry-After": str(math.ceil(retry_after))} if retry_after else None
+        return HTTPException(429, f"{message}: {str(e)}", headers=headers)
+    return HTTPException(500, f"{message}: {str(e)}")
+
+async def upstream_call(model_config, messages, params, call):
+    """在模型和API密钥的限流许可内，经路由调用上游；call(backend)返回协程"""
+    tokens = estimate_tokens(messages, params)
+    
+    async def attempt(backend):
+        async with rate_limits.hold(rate_limits.key_limiter(backend), tokens, backend):
+            return await call(backend)
+    
+    async with rate_limits.hold(rate_limits.model_limiter(model_config), tokens, model_config):
+        return await router.call(model_config, attempt)
+
+async def upstream_stream(model_config, messages, params, factory):
+    """流式版本的upstream_call，许可在流结束时释放"""
+    tokens = estimate_tokens(messages, params)
+    
+    async def attempt(backend):
+        async with rate_limits.hold(rate_limits.key_limiter(backend), tokens, backend):
+            async for chunk in factory(backend):
+                yield chunk
+    
+    async with rate_limits.hold(rate_limits.model_limiter(model_config), tokens, model_config):
+        async for chunk in router.stream(model_config, attempt):
+            yield chunk
+
+def call_usage(messages, text, usage=None):
+    """上游返回的token用量；流式调用或上游未返回时按本地估算"""
+    if usage:
+        return {
+            "prompt_tokens": usage.get("prompt_tokens", 0),
+            "completion_tokens": usage.get("completion_tokens", 0)
+        }
+    return {
+        "prompt_tokens": tokenizer.count_messages(messages),
+        "completion_tokens": tokenizer.count(text),
+        "estimated": True
+    }
+
+def coalesced_stream(flight_key, model_config, messages, params, factory, store):
+    """经请求合并订阅上游流，返回(增量文本流, 用量函数)；被合并到他人请求的订阅者不计用量"""
+    leader = {}
+    
+    def upstream():
+        leader["called"] = True
+        return upstream_stream(model_config, messages, params, factory)
+    
+    chunks = single_flight.stream(flight_key, upstream, store)
+    return chunks, lambda text: call_usage(messages, text) if leader else None
+
+def sse_response(events, http_request, headers=None):
+    return StreamingResponse(
+        guard_stream(http_request, events),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no", **(headers or {})}
+    )
+
+def truncation_headers(truncated):
+    """提示词超出上下文长度被截断时，通过响应头告知客户端"""
+    return {"X-Prompt-Truncated": "true"} if truncated else {}
+
+async def generate_once(prompt, model_config, params, template=None):
+    """非流式生成：依次经过缓存、请求合并和上游调用，返回(文本, 用量, 是否命中缓存)
+
+    只有实际调用了上游的请求返回用量，缓存命中和被合并的请求用量为None
+    """
+    messages = [{"role": "user", "content": prompt}]
+    cached, store = await cache_lookup("generate", messages, model_config, params, template)
+    if cached:
+        return cached["text"], None, True
+    
+    leader = False
+    
+    async def fetch():
+        nonlocal leader
+        leader = True
+        response = await upstream_call(model_config, messages, params,
+                                       lambda backend: call_llm_api(prompt, backend, params))
+        if store:
+            await store(response.get("text", ""))
+        return response
+    
+    flight_key = request_fingerprint("generate", model_config, messages, params)
+    response = await single_flight.do(flight_key, fetch)
+    text = response.get("text", "")
+    return text, call_usage(messages, text, response.get("usage")) if leader else None, False
 
 # 文本生成端点
 @app.post("/api/generate")
-def generate_text(request: GenerateRequest):
-    config = get_config()
-    
-    # 获取模型配置
-    if request.model_id not in config["models"]:
-        if "default" not in config["models"]:
-            raise HTTPException(400, "模型未找到且无默认模型")
-        model_config = config["models"]["default"]
-    else:
-        model_config = config["models"][request.model_id]
+async def generate_text(request: GenerateRequest, http_request: Request, http_response: Response):
+    begin_deadline(http_request)
+    model_config = get_model_config(request.model_id)
+    params = merge_params(model_config, request.parameters)
+    try:
+        prompt = resolve_prompt(request.prompt, request.template_id, request.variables)
+        # 超出模型上下文长度时在本地拒绝或截断，不必等上游报错
+        messages, params, truncated = tokenizer.preflight(model_config, [{"role": "user", "content": prompt}], params)
+    except (TemplateError, ContextOverflow) as e:
+        raise HTTPException(400, str(e))
+    prompt = messages[-1]["content"]
+    headers = truncation_headers(truncated)
+    http_response.headers.update(headers)
+    # 截断后的提示词已不是模板的渲染结果
+    template = (registry.current.templates[request.template_id].content, request.variables) \
+        if request.template_id and not truncated else None
     
-    # 合并参数
-    params = model_config.get("default_params", {}).copy()
-    if request.parameters:
-        params.update(request.parameters)
+    if request.stream:
+        cached, store = await cache_lookup("generate", messages, model_config, params, template)
+        usage_of = None
+        if cached:
+            chunks = replay_text(cached["text"])
+        else:
+            flight_key = request_fingerprint("generate", model_config, messages, params)
+            chunks, usage_of = coalesced_stream(flight_key, model_config, messages, params,
+                                                lambda backend: stream_llm_api(prompt, backend, params), store)
+        return sse_response(stream_events(chunks, model_config, prompt, params, request.format,
+                                          cache_hit=cached is not None, usage_of=usage_of), http_request, headers)
     
     # 调用LLM API
+    start = time.perf_counter()
     try:
-        response = call_llm_api(request.prompt, model_config, params)
+        # 客户端断开或超过截止时间时取消，上游请求随之中断
+        text, usage, cache_hit = await guard(http_request, generate_once(prompt, model_config, params, template))
         
         # 返回结果，根据格式要求处理
-        text = response.get("text", "")
-        if request.format == "markdown":
+        if request.format in ("markdown", "html"):
             # 确保文本是有效的Markdown
             text = text.strip()
         
         # 记录日志
-        log_api_call(model_config["name"], request.prompt, text, params)
+        log_api_call(model_config, prompt, text, params, {
+            "cache_hit": cache_hit,
+            "usage": usage,
+            "total_ms": round((time.perf_counter() - start) * 1000, 1)
+        })
         
-        return {
+        result = {
             "text": text,
             "model": model_config["name"],
             "format": request.format
         }
+        if request.format == "html":
+            result["html"] = await markdown_renderer.render_async(text)
+        return result
+    except ClientDisconnected:
+        log_api_call(model_config, prompt, "", params, {
+            "status": "cancelled",
+            "total_ms": round((time.perf_counter() - start) * 1000, 1)
+        })
+        raise HTTPException(499, "客户端已断开")
     except Exception as e:
         logger.error(f"API调用失败: {str(e)}")
-        raise HTTPException(500, f"调用模型失败: {str(e)}")
+        log_api_call(model_config, prompt, "", params, {
+            "status": "error",
+            "total_ms": round((time.perf_counter() - start) * 1000, 1)
+        })
+        raise upstream_error(e, "调用模型失败")
 
-# 对话端点
-@app.post("/api/chat")
-def chat_completion(request: ChatRequest):
-    config = get_config()
+async def process_batch_item(model_id, item):
+    """处理批量生成中的一条"""
+    prompt = resolve_prompt(item.get("prompt"), item.get("template_id"), item.get("variables"))
+    model_config = get_model_config(model_id)
+    params = merge_params(model_config, item.get("parameters"))
+    messages, params, truncated = tokenizer.preflight(model_config, [{"role": "user", "content": prompt}], params)
+    prompt = messages[-1]["content"]
+    template = (registry.current.templates[item["template_id"]].content, item.get("variables")) \
+        if item.get("template_id") and not truncated else None
+    start = time.perf_counter()
+    text, usage, cache_hit = await generate_once(prompt, model_config, params, template)
+    log_api_call(model_config, prompt, text, params, {
+        "cache_hit": cache_hit,
+        "batch": True,
+        "usage": usage,
+        "total_ms": round((time.perf_counter() - start) * 1000, 1)
+    })
+    return text
+
+# 批量生成端点，结果按完成顺序以NDJSON返回
+@app.post("/api/generate/batch")
+async def generate_batch(request: BatchGenerateRequest):
+    get_model_config(request.model_id)
+    if request.template_id and request.template_id not in registry.current.templates:
+        raise HTTPException(400, f"提示词模板不存在: {request.template_id}")
+    items = [
+        (index, {
+            "id": item.id if item.id is not None else index,
+            "prompt": item.prompt,
+            "template_id": request.template_id if item.prompt is None else None,
+            "variables": {**(request.variables or {}), **(item.variables or {})},
+            "parameters": {**(request.parameters or {}), **(item.parameters or {})}
+        })
+        for index, item in enumerate(request.items)
+    ]
     
-    # 获取模型配置
-    if request.model_id not in config["models"]:
-        if "default" not in config["models"]:
-            raise HTTPException(400, "模型未找到且无默认模型")
-        model_config = config["models"]["default"]
-    else:
-        model_config = config["models"][request.model_id]
+    async def lines():
+        async for result in batch_runner.run(request.model_id, items):
+            if request.format == "html" and result["status"] == "ok":
+                result["html"] = await markdown_renderer.render_async(result["text"])
+            yield json.dumps(result, ensure_ascii=False) + "\n"
     
-    # 合并参数
-    params = model_config.get("default_params", {}).copy()
-    if request.parameters:
-        params.update(request.parameters)
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+# 创建批量任务：上传JSONL文件，每行 {"id": ..., "prompt": ..., "parameters": {...}}
+@app.post("/api/batch/jobs")
+async def create_batch_job(file: UploadFile = File(...), model_id: str = Form("default")):
+    get_model_config(model_id)
+    content = await file.read()
+    return batch_runner.create_job(model_id, content)
+
+# 查询批量任务进度
+@app.get("/api/batch/jobs/{job_id}")
+def get_batch_job(job_id: str):
+    job = batch_runner.get_job(job_id)
+    if job is None:
+        raise HTTPException(404, "批量任务不存在")
+    return job
+
+# 下载批量任务结果
+@app.get("/api/batch/jobs/{job_id}/results")
+def get_batch_job_results(job_id: str):
+    if batch_runner.get_job(job_id) is None:
+        raise HTTPException(404, "批量任务不存在")
+    output_path = batch_runner.output_path(job_id)
+    if not os.path.exists(output_path):
+        raise HTTPException(404, "暂无结果")
+    return FileResponse(output_path, media_type="application/x-ndjson", filename=f"{job_id}.jsonl")
+
+# 对话端点
+@app.post("/api/chat")
+async def chat_completion(request: ChatRequest, http_request: Request, http_response: Response):
+    begin_deadline(http_request)
+    model_config = get_model_config(request.model_id)
+    params = merge_params(model_config, request.parameters)
     
     # 格式化聊天历史
     chat_history = format_chat_history(request.messages)
+    prompt = request.messages[-1].content if request.messages else ""
+    
+    # 服务端会话：历史从会话中读取，按模型的token预算截取后与本轮消息一起发送
+    session = None
+    if request.conversation_id:
+        if not conversation_store.enabled:
+            raise HTTPException(400, "服务端会话未启用")
+        session = await conversation_store.get(request.conversation_id)
+        new_messages = chat_history
+        chat_history, kept_from = conversation_store.context(session, new_messages,
+                                                             conversation_store.budget(model_config))
     
     try:
-        response = call_chat_api(chat_history, model_config, params)
+        chat_history, params, truncated = tokenizer.preflight(model_config, chat_history, params)
+    except ContextOverflow as e:
+        raise HTTPException(400, str(e))
+    headers = truncation_headers(truncated)
+    http_response.headers.update(headers)
+    
+    cached, store = await cache_lookup("chat", chat_history, model_config, params)
+    flight_key = request_fingerprint("chat", model_config, chat_history, params)
+    
+    if request.stream:
+        usage_of = None
+        if cached:
+            chunks = replay_text(cached["text"])
+        else:
+            chunks, usage_of = coalesced_stream(flight_key, model_config, chat_history, params,
+                                                lambda backend: stream_chat_api(chat_history, backend, params), store)
+        if session is not None:
+            chunks = record_turn(chunks, request.conversation_id, session, new_messages, request.model_id, kept_from)
+        return sse_response(stream_events(chunks, model_config, prompt, params, request.format,
+                                          cache_hit=cached is not None, usage_of=usage_of), http_request, headers)
+    
+    leader = False
+    
+    async def fetch():
+        nonlocal leader
+        leader = True
+        response = await upstream_call(model_config, chat_history, params,
+                                       lambda backend: call_chat_api(chat_history, backend, params))
+        if store:
+            await store(response.get("text", ""))
+        return response
+    
+    start = time.perf_counter()
+    try:
+        response = cached or await guard(http_request, single_flight.do(flight_key, fetch))
         
         # 处理响应
         assistant_message = response.get("text", "")
         
         # 记录日志
-        prompt = request.messages[-1].content if request.messages else ""
-        log_api_call(model_config["name"], prompt, assistant_message, params)
+        log_api_call(model_config, prompt, assistant_message, params, {
+            "cache_hit": cached is not None,
+            "usage": call_usage(chat_history, assistant_message, response.get("usage")) if leader else None,
+            "total_ms": round((time.perf_counter() - start) * 1000, 1)
+        })
         
-        return {
+        result = {
             "message": {
                 "role": "assistant",
                 "content": assistant_message
@@ -153,108 +588,154 @@ def chat_completion(request: ChatRequest):
             "model": model_config["name"],
             "format": request.format
         }
+        if request.format == "html":
+            result["html"] = await markdown_renderer.render_async(assistant_message)
+        if session is not None:
+            await conversation_store.append(request.conversation_id, session,
+                                            new_messages + [result["message"]], request.model_id, kept_from)
+            result["conversation_id"] = request.conversation_id
+        return result
+    except ClientDisconnected:
+        log_api_call(model_config, prompt, "", params, {
+            "status": "cancelled",
+            "total_ms": round((time.perf_counter() - start) * 1000, 1)
+        })
+        raise HTTPException(499, "客户端已断开")
     except Exception as e:
         logger.error(f"聊天API调用失败: {str(e)}")
-        raise HTTPException(500, f"调用聊天失败: {str(e)}")
+        log_api_call(model_config, prompt, "", params, {
+            "status": "error",
+            "total_ms": round((time.perf_counter() - start) * 1000, 1)
+        })
+        raise upstream_error(e, "调用聊天失败")
+
+async def record_turn(chunks, conversation_id, session, new_messages, model_id, kept_from):
+    """流式输出完整结束后，把本轮消息和回复写入会话"""
+    parts = []
+    async for chunk in chunks:
+        parts.append(chunk)
+        yield chunk
+    reply = {"role": "assistant", "content": "".join(parts)}
+    await conversation_store.append(conversation_id, session, new_messages + [reply], model_id, kept_from)
+
+async def summarize_conversation(model_id, summary, messages):
+    """将超出上下文预算的旧消息合并进会话摘要"""
+    # 在后台任务中执行，不受触发它的请求的截止时间限制
+    current_deadline.set(None)
+    model_config = get_model_config(model_id)
+    params = merge_params(model_config, {"temperature": 0.3})
+    transcript = "\n".join(f"{m['role']}: {m['content']}" for m in messages)
+    prompt = "请将以下对话总结为简洁的摘要，保留关键事实、结论和用户提出的要求。\n"
+    if summary:
+        prompt += f"\n已有摘要：\n{summary}\n"
+    prompt += f"\n新增对话：\n{transcript}"
+    summary_messages = [{"role": "user", "content": prompt}]
+    
+    start = time.perf_counter()
+    response = await upstream_call(model_config, summary_messages, params,
+                                   lambda backend: call_llm_api(prompt, backend, params))
+    text = response.get("text", "").strip()
+    log_api_call(model_config, prompt, text, params, {
+        "summary": True,
+        "usage": call_usage(summary_messages, text, response.get("usage")),
+        "total_ms": round((time.perf_counter() - start) * 1000, 1)
+    })
+    return text
+
+# 查看服务端会话
+@app.get("/api/conversations/{conversation_id}")
+async def get_conversation(conversation_id: str):
+    session = await conversation_store.get(conversation_id)
+    return {
+        "conversation_id": conversation_id,
+        "messages": session["messages"],
+        "summary": session.get("summary")
+    }
+
+# 删除服务端会话
+@app.delete("/api/conversations/{conversation_id}")
+async def delete_conversation(conversation_id: str):
+    await conversation_store.delete(conversation_id)
+    return {"status": "ok"}
+
+# 本地token计数，支持一次传入多段文本
+@app.post("/api/tokenize")
+def tokenize(request: TokenizeRequest):
+    counts = tokenizer.count_many(request.texts)
+    result = {"encoding": tokenizer.name, "counts": counts, "total": sum(counts)}
+    if request.messages:
+        result["message_tokens"] = tokenizer.count_messages(format_chat_history(request.messages))
+    if request.model_id:
+        model_config = get_model_config(request.model_id)
+        result["context_window"] = model_config.get("context_window")
+        result["max_tokens"] = model_config.get("default_params", {}).get("max_tokens")
+    return result
 
 # 获取所有模型
 @app.get("/api/models")
-def get_models():
-    config = get_config()
+async def get_models(health: bool = False, refresh: bool = False):
+    """health=1 时附带各模型后端的探测结果（按TTL缓存），refresh=1 时忽略缓存重新探测"""
+    current = registry.current.models
+    status = await health_prober.check(current, force=refresh) if health else {}
     models = []
-    for model_id, model_config in config["models"].items():
-        models.append({
+    for model_id, model_config in current.items():
+        model = {
             "id": model_id,
             "name": model_config.get("display_name", model_id),
             "provider": model_config.get("provider", "unknown"),
             "description": model_config.get("description", "")
-        })
+        }
+        if health:
+            model["health"] = status[model_id]
+        models.append(model)
     return {"models": models}
 
+# 响应缓存统计（统计数据只在事件循环线程中更新，这类接口不能放到线程池中执行）
+@app.get("/api/cache/stats")
+async def get_cache_stats():
+    stats = response_cache.stats()
+    stats["semantic"] = semantic_cache.stats()
+    stats["coalescing"] = single_flight.stats()
+    stats["tokenizer"] = tokenizer.stats()
+    stats["markdown"] = markdown_renderer.stats()
+    return stats
+
+# 多后端路由统计
+@app.get("/api/routing/stats")
+async def get_routing_stats():
+    return {"backends": router.stats()}
+
+# 限流队列统计
+@app.get("/api/limits/stats")
+async def get_limit_stats():
+    return {"shared_state": shared_state.status(), "limiters": rate_limits.stats()}
+
+# 用量统计，start/end 为Unix时间戳（秒），默认最近24小时
+@app.get("/api/usage")
+def get_usage(start: Optional[float] = None, end: Optional[float] = None,
+              interval: str = "hour", model: Optional[str] = None):
+    if interval not in INTERVALS:
+        raise HTTPException(400, f"interval 只能是 {', '.join(INTERVALS)}")
+    end = end if end is not None else time.time()
+    start = start if start is not None else end - 86400
+    series = usage_store.query(start, end, interval, model)
+    totals = {}
+    for row in series:
+        total = totals.setdefault(row["model"], {"requests": 0, "errors": 0, "cancelled": 0, "cache_hits": 0,
+                                                 "prompt_tokens": 0, "completion_tokens": 0})
+        for field in total:
+            total[field] += row[field]
+    return {"start": start, "end": end, "interval": interval, "series": series, "totals": totals}
+
 # 获取提示词模板
 @app.get("/api/prompt-templates")
 def get_prompt_templates():
-    config = get_config()
-    return {"templates": config.get("prompt_templates", [])}
-
-# 调用LLM API
-def call_llm_api(prompt, model_config, params):
-    """统一的模型调用接口"""
-    if model_config["provider"] == "openai":
-        return call_openai_api(prompt, model_config, params)
-    elif model_config["provider"] == "minimax":
-        return call_minimax_api(prompt, model_config, params)
-    elif model_config["provider"] == "deepseek":
-        return call_deepseek_api(prompt, model_config, params)
-    else:
-        raise ValueError(f"不支持的提供商: {model_config['provider']}")
+    return {"templates": registry.current.prompt_templates}
 
-def call_openai_api(prompt, model_config, params):
-    """调用OpenAI兼容API"""
-    headers = {
-        "Authorization": f"Bearer {model_config['api_key']}",
-        "Content-Type": "application/json"
-    }
-    
-    data = {
-        "model": model_config["model_name"],
-        "messages": [{"role": "user", "content": prompt}],
-        "temperature": params.get("temperature", 0.7),
-        "max_tokens": params.get("max_tokens", 1000),
-        "top_p": params.get("top_p", 1.0),
-        "presence_penalty": params.get("presence_penalty", 0),
-        "frequency_penalty": params.get("frequency_penalty", 0)
-    }
-    
-    url = f"{model_config['base_url']}/chat/completions"
-    
-    response = requests.post(url, headers=headers, json=data, timeout=30)
-    
-    if response.status_code != 200:
-        raise Exception(f"OpenAI API调用失败: {response.status_code} {response.text}")
-    
-    result = response.json()
-    
-    return {
-        "text": result["choices"][0]["message"]["content"],
-        "model": model_config["model_name"],
-        "request_id": result.get("id", "")
-    }
-
-def call_deepseek_api(prompt, model_config, params):
-    """调用DeepSeek API"""
-    # DeepSeek API格式与OpenAI类似
-    return call_openai_api(prompt, model_config, params)
-
-def call_minimax_api(prompt, model_config, params):
-    """调用MiniMax API"""
-    headers = {
-        "Authorization": f"Bearer {model_config['api_key']}",
-        "Content-Type": "application/json"
-    }
-    
-    data = {
-        "model": model_config["model_name"],
-        "messages": [{"role": "user", "content": prompt}],
-        "temperature": params.get("temperature", 0.7),
-        "max_tokens": params.get("max_tokens", 1000),
-        "top_p": params.get("top_p", 1.0)
-    }
-    
-    url = f"{model_config['base_url']}/chat/completions"
-    
-    response = requests.post(url, headers=headers, json=data, timeout=30)
-    
-    if response.status_code != 200:
-        raise Exception(f"MiniMax API调用失败: {response.status_code} {response.text}")
-    
-    result = response.json()
-    
-    return {
-        "text": result["choices"][0]["message"]["content"],
-        "model": model_config["model_name"],
-        "request_id": result.get("id", "")
-    }
+# 配置加载状态（版本、加载时间和耗时）
+@app.get("/api/config/status")
+def get_config_status():
+    return registry.status()
 
 def format_chat_history(messages):
     """将消息历史转换为API需要的格式"""
@@ -266,38 +747,10 @@ def format_chat_history(messages):
         })
     return formatted_messages
 
-def call_chat_api(messages, model_config, params):
-    """调用聊天完成API"""
-    headers = {
-        "Authorization": f"Bearer {model_config['api_key']}",
-        "Content-Type": "application/json"
-    }
-    
-    data = {
-        "model": model_config["model_name"],
-        "messages": messages,
-        "temperature": params.get("temperature", 0.7),
-        "max_tokens": params.get("max_tokens", 1000),
-        "top_p": params.get("top_p", 1.0)
-    }
-    
-    url = f"{model_config['base_url']}/chat/completions"
-    
-    response = requests.post(url, headers=headers, json=data, timeout=30)
-    
-    if response.status_code != 200:
-        raise Exception(f"聊天API调用失败: {response.status_code} {response.text}")
-    
-    result = response.json()
-    
-    return {
-        "text": result["choices"][0]["message"]["content"],
-        "model": model_config["model_name"],
-        "request_id": result.get("id", "")
-    }
-
-def log_api_call(model_name, prompt, response, params):
+def log_api_call(model_config, prompt, response, params, extra=None):
     """记录API调用日志"""
+    start = time.perf_counter()
+    model_name = model_config["name"]
     log_entry = {
         "timestamp": datetime.now().isoformat(),
         "model": model_name,
@@ -305,13 +758,42 @@ def log_api_call(model_name, prompt, response, params):
         "response_length": len(response),
         "parameters": params
     }
+    if extra:
+        log_entry.update(extra)
     
-    logger.info(f"API调用: {json.dumps(log_entry, ensure_ascii=False)}")
+    # 由后台线程批量写入 logs/api_calls.log
+    api_call_log.record(log_entry)
     
-    # 也可以将日志写入专门的日志文件
-    os.makedirs("logs", exist_ok=True)
-    with open("logs/api_calls.log", "a", encoding="utf-8") as f:
-        f.write(json.dumps(log_entry, ensure_ascii=False) + "\n")
+    usage = log_entry.get("usage") or {}
+    usage_store.record(model_name, log_entry.get("status", "ok"), log_entry.get("cache_hit", False),
+                       usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0),
+                       log_entry.get("total_ms"))
+    metrics.observe("log", model_name, model_config["provider"], time.perf_counter() - start)
+
+def collect_metrics():
+    """已有的缓存和限流统计，输出 /metrics 时采集"""
+    caches = response_cache.stats(), semantic_cache.stats(), tokenizer.stats(), markdown_renderer.stats()
+    coalescing = single_flight.stats()
+    samples = []
+    for cache, hits, misses in (("response", caches[0]["hits"], caches[0]["misses"]),
+                                ("semantic", caches[1]["hits"], caches[1]["misses"]),
+                                ("tokenizer", caches[2]["cache_hits"], caches[2]["cache_misses"]),
+                                ("markdown", caches[3]["hits"], caches[3]["misses"]),
+                                ("coalescing", coalescing["coalesced"], coalescing["leaders"])):
+        samples.append(("llm_cache_hits_total", (cache,), hits))
+        samples.append(("llm_cache_misses_total", (cache,), misses))
+    for name, limiter in rate_limits.stats().items():
+        samples.append(("llm_ratelimit_active", (name,), limiter["active"]))
+        samples.append(("llm_ratelimit_queued", (name,), limiter["queued"]))
+    samples.append(("llm_coalescing_in_flight", (), coalescing["in_flight"]))
+    return samples
+
+# Prometheus指标（多worker时汇总本机所有worker）
+@app.get("/metrics")
+async def get_metrics():
+    if not metrics.enabled:
+        raise HTTPException(404, "指标未启用")
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
 
 # 健康检查端点
 @app.get("/health")
@@ -320,7 +802,22 @@ def health_check():
 
 # 主入口
 if __name__ == "__main__":
+    import sys
     import uvicorn
-    port = get_config().get("settings", {}).get("server", {}).get("port", 8000)
-    host = get_config().get("settings", {}).get("server", {}).get("host", "0.0.0.0")
-    uvicorn.run(app, host=host, port=port) 
\ No newline at end of file
+    from .shared_state import default_dir
+    # 启动前加载并校验一次配置，配置有误时直接退出，worker直接读取校验过的配置
+    try:
+        registry.preload(os.path.join(default_dir(), "config.json"))
+        server_settings = registry.current.settings.get("server", {})
+    except Exception as e:
+        logger.error(f"配置加载失败: {str(e)}")
+        sys.exit(1)
+    port = server_settings.get("port", 8000)
+    host = server_settings.get("host", "0.0.0.0")
+    workers = int(os.getenv("LLM_WORKERS", server_settings.get("workers", 1)))
+    if workers > 1:
+        # 多进程时uvicorn按导入路径在每个worker中加载应用
+        os.environ["LLM_WORKERS"] = str(workers)
+        uvicorn.run("src.main:app", host=host, port=port, workers=workers)
+    else:
+        uvicorn.run(app, host=host, port=port)
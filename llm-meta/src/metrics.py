@@ -0,0 +1,315 @@
+"""Prometheus指标
+
+GET /metrics 以Prometheus文本格式输出：
+  llm_phase_seconds        各阶段耗时直方图，按阶段、模型和提供商区分
+                             config   查找模型配置
+                             queue    等待限流许可（模型和API密钥）
+                             connect  建立上游连接（TCP和TLS，复用长连接时不记录）
+                             ttfb     发出请求到收到上游响应头
+                             parse    解析上游响应JSON（流式请求为所有增量的解析时间之和）
+                             log      记录调用日志和用量
+  llm_request_seconds      请求总耗时（流式请求到流结束）
+  llm_requests_in_flight   正在处理的请求数
+  llm_upstream_in_flight   正在进行的上游调用数
+  llm_cache_hit_ratio      各缓存的命中率，以及命中/未命中次数
+
+指标只在事件循环线程中更新，用普通的列表和整数计数、不加锁，每次记录约1微秒。
+多worker时每个worker定期把自己的指标写入共享目录，/metrics 汇总本机所有worker
+（其他worker的数据最多延迟 flush_interval 秒）。
+"""
+import asyncio
+import json
+import logging
+import os
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# 指标名 -> (类型, 标签名, 说明)
+FAMILIES = {
+    "llm_phase_seconds": ("histogram", ("phase", "model", "provider"), "请求各阶段耗时（秒）"),
+    "llm_request_seconds": ("histogram", ("endpoint",), "请求总耗时（秒），流式请求到流结束"),
+    "llm_requests_in_flight": ("gauge", ("endpoint",), "正在处理的请求数"),
+    "llm_upstream_in_flight": ("gauge", ("model", "provider"), "正在进行的上游调用数"),
+    "llm_cache_hits_total": ("counter", ("cache",), "缓存命中次数"),
+    "llm_cache_misses_total": ("counter", ("cache",), "缓存未命中次数"),
+    "llm_cache_hit_ratio": ("gauge", ("cache",), "缓存命中率"),
+    "llm_ratelimit_active": ("gauge", ("limiter",), "已获得限流许可的请求数"),
+    "llm_ratelimit_queued": ("gauge", ("limiter",), "等待限流许可的请求数"),
+    "llm_coalescing_in_flight": ("gauge", (), "正在进行的合并请求数"),
+}
+
+Labels = Tuple[str, ...]
+# 采集函数返回 (指标名, 标签值, 数值)
+Collector = Callable[[], Iterable[Tuple[str, Labels, float]]]
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _format_labels(names: Labels, values: Labels, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class Histogram:
+    __slots__ = ("counts", "sum")
+
+    def __init__(self, size: int):
+        # counts[i] 为落在第i个区间（不累计）的样本数，最后一个为+Inf
+        self.counts = [0] * size
+        self.sum = 0.0
+
+
+class UpstreamTrace:
+    """httpx的trace扩展：从连接和HTTP事件中取得建立连接和首字节的耗时"""
+
+    __slots__ = ("model", "provider", "_connecting", "_sent")
+
+    def __init__(self, model: str, provider: str):
+        self.model = model
+        self.provider = provider
+        self._connecting: Optional[float] = None
+        self._sent: Optional[float] = None
+
+    async def __call__(self, name: str, info: Dict[str, Any]) -> None:
+        if name == "connection.connect_tcp.started":
+            self._connecting = time.perf_counter()
+        elif name.endswith(".send_request_headers.started"):
+            now = time.perf_counter()
+            if self._connecting is not None:
+                metrics.observe("connect", self.model, self.provider, now - self._connecting)
+                self._connecting = None
+            self._sent = now
+        elif name.endswith(".receive_response_headers.complete") and self._sent is not None:
+            metrics.observe("ttfb", self.model, self.provider, time.perf_counter() - self._sent)
+            self._sent = None
+
+
+class Metrics:
+    def __init__(self):
+        self.enabled = True
+        self.buckets = DEFAULT_BUCKETS
+        self.tracked = ("/api/generate", "/api/chat", "/api/generate/batch")
+        self.flush_interval = 5.0
+        self.dir: Optional[str] = None
+        self._histograms: Dict[str, Dict[Labels, Histogram]] = {}
+        self._gauges: Dict[str, Dict[Labels, float]] = {}
+        self._collectors: List[Collector] = []
+        self._task: Optional["asyncio.Task"] = None
+
+    def configure(self, settings: Optional[Dict[str, Any]]) -> None:
+        """根据 settings.metrics 初始化"""
+        settings = settings or {}
+        self.enabled = settings.get("enabled", True)
+        self.buckets = tuple(sorted(settings.get("buckets", DEFAULT_BUCKETS)))
+        self.tracked = tuple(settings.get("endpoints", self.tracked))
+        self.flush_interval = settings.get("flush_interval", 5.0)
+        self._histograms = {}
+        self._gauges = {}
+        self._collectors = []
+
+    def _observe(self, family: str, labels: Labels, seconds: float) -> None:
+        series = self._histograms.get(family)
+        if series is None:
+            series = self._histograms[family] = {}
+        histogram = series.get(labels)
+        if histogram is None:
+            histogram = series[labels] = Histogram(len(self.buckets) + 1)
+        histogram.counts[bisect_left(self.buckets, seconds)] += 1
+        histogram.sum += seconds
+
+    def observe(self, phase: str, model: str, provider: str, seconds: float) -> None:
+        if self.enabled:
+            self._observe("llm_phase_seconds", (phase, model, provider), seconds)
+
+    def observe_request(self, endpoint: str, seconds: float) -> None:
+        if self.enabled:
+            self._observe("llm_request_seconds", (endpoint,), seconds)
+
+    @contextmanager
+    def timed(self, phase: str, model: str, provider: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(phase, model, provider, time.perf_counter() - start)
+
+    def add(self, family: str, labels: Labels, delta: float) -> None:
+        """调整gauge"""
+        if not self.enabled:
+            return
+        series = self._gauges.get(family)
+        if series is None:
+            series = self._gauges[family] = {}
+        series[labels] = series.get(labels, 0) + delta
+
+    def trace(self, model: str, provider: str) -> Optional[UpstreamTrace]:
+        """供上游请求使用的httpx trace扩展，未启用时返回None"""
+        return UpstreamTrace(model, provider) if self.enabled else None
+
+    def add_collector(self, collector: Collector) -> None:
+        """注册在输出指标时调用的采集函数（缓存命中数、限流队列等已有统计）"""
+        self._collectors.append(collector)
+
+    def snapshot(self) -> Dict[str, Any]:
+        """本worker当前的全部指标（可JSON序列化）"""
+        values = [[family, list(labels), value]
+                  for family, series in self._gauges.items() for labels, value in series.items()]
+        for collector in self._collectors:
+            try:
+                values += [[family, list(labels), value] for family, labels, value in collector()]
+            except Exception as e:
+                logger.error(f"采集指标失败: {str(e)}")
+        return {
+            "pid": os.getpid(),
+            "buckets": list(self.buckets),
+            "histograms": [[family, list(labels), histogram.counts, histogram.sum]
+                           for family, series in self._histograms.items()
+                           for labels, histogram in series.items()],
+            "values": values
+        }
+
+    def _worker_snapshots(self) -> List[Dict[str, Any]]:
+        """共享目录中其他仍在运行的worker写出的指标"""
+        snapshots = []
+        if self.dir is None or not os.path.isdir(self.dir):
+            return snapshots
+        for name in os.listdir(self.dir):
+            if not name.endswith(".json"):
+                continue
+            path = os.path.join(self.dir, name)
+            try:
+                pid = int(name[:-5])
+                if pid == os.getpid():
+                    continue
+                os.kill(pid, 0)
+            except ValueError:
+                continue
+            except ProcessLookupError:
+                # worker已退出
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                continue
+            except PermissionError:
+                pass
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    snapshots.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+        return snapshots
+
+    def render(self) -> str:
+        """汇总所有worker的指标，返回Prometheus文本格式"""
+        histograms: Dict[str, Dict[Labels, List[Any]]] = {}
+        values: Dict[str, Dict[Labels, float]] = {}
+        for snapshot in [self.snapshot()] + self._worker_snapshots():
+            if snapshot.get("buckets") != list(self.buckets):
+                continue  # 直方图区间不同的worker（配置修改后尚未重启）
+            for family, labels, counts, total in snapshot["histograms"]:
+                merged = histograms.setdefault(family, {}).setdefault(tuple(labels), [[0] * len(counts), 0.0])
+                merged[0] = [a + b for a, b in zip(merged[0], counts)]
+                merged[1] += total
+            for family, labels, value in snapshot["values"]:
+                series = values.setdefault(family, {})
+                series[tuple(labels)] = series.get(tuple(labels), 0) + value
+
+        # 命中率按汇总后的命中和未命中次数计算
+        hits = values.get("llm_cache_hits_total", {})
+        misses = values.get("llm_cache_misses_total", {})
+        values["llm_cache_hit_ratio"] = {
+            labels: hits[labels] / (hits[labels] + misses.get(labels, 0)) if hits[labels] + misses.get(labels, 0) else 0.0
+            for labels in hits
+        }
+
+        lines = []
+        for family, (kind, names, help_text) in FAMILIES.items():
+            if family not in histograms and family not in values:
+                continue
+            lines.append(f"# HELP {family} {help_text}")
+            lines.append(f"# TYPE {family} {kind}")
+            if kind == "histogram":
+                bounds = [f'le="{bound}"' for bound in self.buckets] + ['le="+Inf"']
+                for labels, (counts, total) in sorted(histograms[family].items()):
+                    cumulative = 0
+                    for bound, count in zip(bounds, counts):
+                        cumulative += count
+                        lines.append(f"{family}_bucket{_format_labels(names, labels, bound)} {cumulative}")
+                    lines.append(f"{family}_sum{_format_labels(names, labels)} {_format_value(total)}")
+                    lines.append(f"{family}_count{_format_labels(names, labels)} {cumulative}")
+            else:
+                for labels, value in sorted(values[family].items()):
+                    lines.append(f"{family}{_format_labels(names, labels)} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+    def start(self, shared_dir: Optional[str]) -> None:
+        """多worker时定期把本worker的指标写入 shared_dir/metrics"""
+        if not self.enabled or shared_dir is None:
+            return
+        self.dir = os.path.join(shared_dir, "metrics")
+        os.makedirs(self.dir, exist_ok=True)
+        self._task = asyncio.ensure_future(self._flush_loop())
+
+    def _flush(self) -> None:
+        path = os.path.join(self.dir, f"{os.getpid()}.json")
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(self.snapshot(), f, ensure_ascii=False)
+        os.replace(path + ".tmp", path)
+
+    async def _flush_loop(self) -> None:
+        while True:
+            try:
+                self._flush()
+            except Exception as e:
+                logger.error(f"写出指标失败: {str(e)}")
+            await asyncio.sleep(self.flush_interval)
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+        try:
+            os.remove(os.path.join(self.dir, f"{os.getpid()}.json"))
+        except OSError:
+            pass
+
+
+class MetricsMiddleware:
+    """记录正在处理的请求数和请求总耗时（未在 settings.metrics.endpoints 中的路径计为other）"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not metrics.enabled:
+            await self.app(scope, receive, send)
+            return
+        endpoint = scope["path"] if scope["path"] in metrics.tracked else "other"
+        metrics.add("llm_requests_in_flight", (endpoint,), 1)
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            metrics.add("llm_requests_in_flight", (endpoint,), -1)
+            metrics.observe_request(endpoint, time.perf_counter() - start)
+
+
+# 全局指标
+metrics = Metrics()
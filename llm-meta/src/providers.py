@@ -0,0 +1,276 @@
+"""大模型提供商调用层
+
+所有上游请求都通过按 base_url 复用的异步 HTTP 客户端发出，
+连接保持长连接（支持HTTP/2），避免每次请求重新握手。
+"""
+import json
+import logging
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Any, AsyncIterator, Dict, List, Optional
+
+import httpx
+
+from .metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+try:
+    import h2  # noqa: F401  httpx的HTTP/2支持依赖h2
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+
+class ProviderError(Exception):
+    """上游模型接口返回错误"""
+
+    def __init__(self, message: str, status_code: Optional[int] = None, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """解析Retry-After响应头（秒数或HTTP日期），返回需要等待的秒数"""
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max((retry_at - datetime.now(timezone.utc)).total_seconds(), 0.0)
+
+
+def provider_error(label: str, response: httpx.Response, body: str) -> ProviderError:
+    return ProviderError(
+        f"{label}调用失败: {response.status_code} {body}",
+        response.status_code,
+        parse_retry_after(response.headers.get("Retry-After"))
+    )
+
+
+class ClientPool:
+    """按 base_url 维护长连接 HTTP 客户端"""
+
+    def __init__(self):
+        self._clients: Dict[str, httpx.AsyncClient] = {}
+        self._settings: Dict[str, Any] = {}
+
+    def configure(self, settings: Optional[Dict[str, Any]]) -> None:
+        """设置连接池参数，对之后新建的客户端生效"""
+        self._settings = dict(settings or {})
+        if self._settings.get("http2", True) and not HTTP2_AVAILABLE:
+            logger.warning("未安装h2，上游连接将使用HTTP/1.1")
+
+    def get(self, base_url: str) -> httpx.AsyncClient:
+        """获取（必要时创建）指定 base_url 的客户端"""
+        client = self._clients.get(base_url)
+        if client is None or client.is_closed:
+            client = self._create_client(base_url)
+            self._clients[base_url] = client
+        return client
+
+    def _create_client(self, base_url: str) -> httpx.AsyncClient:
+        s = self._settings
+        # httpcore每次分配请求都会遍历池中全部连接，空闲长连接过多时这部分开销会随负载明显增加，
+        # 因此只保留少量空闲连接；HTTP/2时少量连接即可多路复用
+        limits = httpx.Limits(
+            max_connections=s.get("max_connections", 200),
+            max_keepalive_connections=s.get("max_keepalive_connections", 10),
+            keepalive_expiry=s.get("keepalive_expiry", 60),
+        )
+        timeout = httpx.Timeout(
+            s.get("timeout", 30),
+            connect=s.get("connect_timeout", 10),
+            pool=s.get("pool_timeout", 10),
+        )
+        logger.info(f"创建上游连接池: {base_url}")
+        return httpx.AsyncClient(
+            base_url=base_url,
+            http2=s.get("http2", True) and HTTP2_AVAILABLE,
+            limits=limits,
+            timeout=timeout,
+        )
+
+    async def aclose(self) -> None:
+        """关闭所有客户端"""
+        for client in self._clients.values():
+            await client.aclose()
+        self._clients.clear()
+
+
+# 全局连接池
+client_pool = ClientPool()
+
+
+def build_headers(model_config: Dict[str, Any]) -> Dict[str, str]:
+    if "request_headers" in model_config:
+        return model_config["request_headers"]  # 注册表预生成
+    return {
+        "Authorization": f"Bearer {model_config['api_key']}",
+        "Content-Type": "application/json"
+    }
+
+
+async def post_chat_completion(model_config: Dict[str, Any], data: Dict[str, Any], label: str) -> Dict[str, Any]:
+    """向 /chat/completions 发送请求并解析结果"""
+    client = client_pool.get(model_config["base_url"])
+    model, provider = model_config["name"], model_config["provider"]
+    trace = metrics.trace(model, provider)
+    metrics.add("llm_upstream_in_flight", (model, provider), 1)
+    try:
+        response = await client.post(model_config.get("chat_url", "/chat/completions"),
+                                     headers=build_headers(model_config), json=data,
+                                     extensions={"trace": trace} if trace else None)
+    finally:
+        metrics.add("llm_upstream_in_flight", (model, provider), -1)
+
+    if response.status_code != 200:
+        raise provider_error(label, response, response.text)
+
+    with metrics.timed("parse", model, provider):
+        result = response.json()
+        text = result["choices"][0]["message"]["content"]
+
+    return {
+        "text": text,
+        "model": model_config["model_name"],
+        "request_id": result.get("id", ""),
+        "usage": result.get("usage")
+    }
+
+
+async def stream_chat_completion(model_config: Dict[str, Any], data: Dict[str, Any], label: str) -> AsyncIterator[str]:
+    """以 stream=true 调用 /chat/completions，逐段产出增量文本"""
+    client = client_pool.get(model_config["base_url"])
+    data = dict(data, stream=True)
+    url = model_config.get("chat_url", "/chat/completions")
+    model, provider = model_config["name"], model_config["provider"]
+    trace = metrics.trace(model, provider)
+    parse_seconds = 0.0
+    metrics.add("llm_upstream_in_flight", (model, provider), 1)
+    try:
+        async with client.stream("POST", url, headers=build_headers(model_config), json=data,
+                                 extensions={"trace": trace} if trace else None) as response:
+            if response.status_code != 200:
+                body = (await response.aread()).decode("utf-8", errors="replace")
+                raise provider_error(label, response, body)
+
+            async for line in response.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                payload = line[5:].strip()
+                if payload == "[DONE]":
+                    break
+                if not payload:
+                    continue
+                start = time.perf_counter()
+                chunk = json.loads(payload)
+                choices = chunk.get("choices") or []
+                content = (choices[0].get("delta") or {}).get("content") if choices else None
+                parse_seconds += time.perf_counter() - start
+                if content:
+                    yield content
+    finally:
+        metrics.add("llm_upstream_in_flight", (model, provider), -1)
+        if parse_seconds:
+            metrics.observe("parse", model, provider, parse_seconds)
+
+
+def build_openai_payload(messages, model_config, params):
+    """OpenAI/DeepSeek 单轮生成请求体"""
+    return {
+        "model": model_config["model_name"],
+        "messages": messages,
+        "temperature": params.get("temperature", 0.7),
+        "max_tokens": params.get("max_tokens", 1000),
+        "top_p": params.get("top_p", 1.0),
+        "presence_penalty": params.get("presence_penalty", 0),
+        "frequency_penalty": params.get("frequency_penalty", 0)
+    }
+
+
+def build_chat_payload(messages, model_config, params):
+    """MiniMax 及多轮对话请求体"""
+    return {
+        "model": model_config["model_name"],
+        "messages": messages,
+        "temperature": params.get("temperature", 0.7),
+        "max_tokens": params.get("max_tokens", 1000),
+        "top_p": params.get("top_p", 1.0)
+    }
+
+
+PROVIDER_LABELS = {
+    "openai": "OpenAI API",
+    "deepseek": "OpenAI API",
+    "minimax": "MiniMax API",
+}
+
+
+def check_provider(model_config) -> None:
+    if model_config["provider"] not in PROVIDER_LABELS:
+        raise ValueError(f"不支持的提供商: {model_config['provider']}")
+
+
+# 调用LLM API
+async def call_llm_api(prompt, model_config, params):
+    """统一的模型调用接口"""
+    if model_config["provider"] == "openai":
+        return await call_openai_api(prompt, model_config, params)
+    elif model_config["provider"] == "minimax":
+        return await call_minimax_api(prompt, model_config, params)
+    elif model_config["provider"] == "deepseek":
+        return await call_deepseek_api(prompt, model_config, params)
+    else:
+        raise ValueError(f"不支持的提供商: {model_config['provider']}")
+
+
+async def call_openai_api(prompt, model_config, params):
+    """调用OpenAI兼容API"""
+    data = build_openai_payload([{"role": "user", "content": prompt}], model_config, params)
+    return await post_chat_completion(model_config, data, "OpenAI API")
+
+
+async def call_deepseek_api(prompt, model_config, params):
+    """调用DeepSeek API"""
+    # DeepSeek API格式与OpenAI类似
+    return await call_openai_api(prompt, model_config, params)
+
+
+async def call_minimax_api(prompt, model_config, params):
+    """调用MiniMax API"""
+    data = build_chat_payload([{"role": "user", "content": prompt}], model_config, params)
+    return await post_chat_completion(model_config, data, "MiniMax API")
+
+
+async def call_chat_api(messages: List[Dict[str, str]], model_config, params):
+    """调用聊天完成API"""
+    data = build_chat_payload(messages, model_config, params)
+    return await post_chat_completion(model_config, data, "聊天API")
+
+
+def stream_llm_api(prompt, model_config, params) -> AsyncIterator[str]:
+    """流式版本的 call_llm_api"""
+    check_provider(model_config)
+    messages = [{"role": "user", "content": prompt}]
+    if model_config["provider"] == "minimax":
+        data = build_chat_payload(messages, model_config, params)
+    else:
+        data = build_openai_payload(messages, model_config, params)
+    return stream_chat_completion(model_config, data, PROVIDER_LABELS[model_config["provider"]])
+
+
+def stream_chat_api(messages: List[Dict[str, str]], model_config, params) -> AsyncIterator[str]:
+    """流式版本的 call_chat_api"""
+    check_provider(model_config)
+    data = build_chat_payload(messages, model_config, params)
+    return stream_chat_completion(model_config, data, "聊天API")
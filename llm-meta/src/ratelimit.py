@@ -0,0 +1,333 @@
+"""上游限流
+
+按模型（rate_limit）和按上游API密钥（key_rate_limit）分别限制：
+  rpm              每分钟请求数
+  tpm              每分钟token数（按本地计数的提示词和max_tokens预估）
+  max_concurrency  同时进行的请求数
+超出额度的请求进入队列等待，不同客户端之间轮询调度，避免单个客户端占满额度；
+队列长度和排队时间都有上限，超出时返回429并给出Retry-After。
+多worker部署时额度由所有worker共享，见 shared_state。
+"""
+import asyncio
+import contextvars
+import hashlib
+import logging
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from typing import Any, Deque, Dict, List, Mapping, Optional
+
+from .deadline import DeadlineExceeded, remaining
+from .metrics import metrics
+from .router import Router
+from .shared_state import SharedTokenBucket, shared_state
+from .tokenizer import tokenizer
+
+logger = logging.getLogger(__name__)
+
+# 当前请求的客户端标识（X-Client-Id 或客户端IP），用于公平调度
+current_client: contextvars.ContextVar = contextvars.ContextVar("current_client", default="-")
+
+
+class RateLimitExceeded(Exception):
+    """排队超时或队列已满"""
+
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class ClientContextMiddleware:
+    """记录请求的客户端标识"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http":
+            client = dict(scope["headers"]).get(b"x-client-id", b"").decode("latin-1")
+            if not client and scope.get("client"):
+                client = scope["client"][0]
+            current_client.set(client or "-")
+        await self.app(scope, receive, send)
+
+
+def estimate_tokens(messages: List[Dict[str, str]], params: Dict[str, Any]) -> int:
+    """估算一次调用消耗的token：提示词加上max_tokens"""
+    return tokenizer.count_messages(messages) + params.get("max_tokens", 1000)
+
+
+class TokenBucket:
+    def __init__(self, per_minute: float):
+        self.capacity = per_minute
+        self.rate = per_minute / 60.0
+        self.tokens = per_minute
+        self.updated = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_take(self, amount: float) -> float:
+        """尝试取出amount个令牌，成功返回0，否则返回需要等待的秒数"""
+        self._refill()
+        if self.tokens >= amount:
+            self.tokens -= amount
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+    def refund(self, amount: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+
+def make_bucket(key: str, per_minute: float) -> Any:
+    """共享内存可用时返回worker间共享的令牌桶，否则返回按本worker份额缩放的进程内令牌桶"""
+    if shared_state.buckets is not None:
+        return SharedTokenBucket(shared_state.buckets, key, per_minute)
+    return TokenBucket(per_minute * shared_state.share)
+
+
+class _Waiter:
+    def __init__(self, tokens: float, future: asyncio.Future):
+        self.tokens = tokens
+        self.future = future
+        self.enqueued = time.monotonic()
+
+
+class Limiter:
+    def __init__(self, name: str, settings: Dict[str, Any], max_queue: int, max_wait: float):
+        self.name = name
+        self.settings = settings
+        # 创建时使用的全局默认值，配置重新加载后据此判断是否需要重建
+        self.defaults = (max_queue, max_wait)
+        self.rescale()
+        self.max_queue = settings.get("max_queue", max_queue)
+        self.max_wait = settings.get("max_wait", max_wait)
+        self.active = 0
+        self.queued = 0
+        self._queues: "OrderedDict[str, Deque[_Waiter]]" = OrderedDict()
+        self._timer: Optional[asyncio.TimerHandle] = None
+        # 统计
+        self.granted = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.max_queued = 0
+        self._waits: Deque[float] = deque(maxlen=1000)
+
+    def rescale(self) -> None:
+        """按本worker的份额重新创建令牌桶和并发上限（在线worker数变化时调用）"""
+        settings = self.settings
+        self.rpm = make_bucket(f"{self.name}:rpm", settings["rpm"]) if settings.get("rpm") else None
+        self.tpm = make_bucket(f"{self.name}:tpm", settings["tpm"]) if settings.get("tpm") else None
+        self.max_concurrency = settings.get("max_concurrency")
+        if self.max_concurrency:
+            self.max_concurrency = max(1, round(self.max_concurrency * shared_state.share))
+
+    def _try_grant(self, tokens: float) -> Optional[float]:
+        """尝试发放一个许可：成功返回0，令牌不足时返回需要等待的秒数，并发已满时返回None
+
+        共享令牌桶可能同时被其他worker扣减，所以检查和扣减在一步中完成。
+        """
+        if self.max_concurrency and self.active >= self.max_concurrency:
+            return None
+        if self.rpm is not None:
+            wait = self.rpm.try_take(1)
+            if wait > 0:
+                return wait
+        if self.tpm is not None:
+            wait = self.tpm.try_take(min(tokens, self.tpm.capacity))
+            if wait > 0:
+                if self.rpm is not None:
+                    self.rpm.refund(1)
+                return wait
+        self.active += 1
+        self.granted += 1
+        return 0.0
+
+    async def acquire(self, client: str, tokens: float) -> None:
+        if not self.queued and self._try_grant(tokens) == 0.0:
+            self._waits.append(0.0)
+            return
+
+        if self.queued >= self.max_queue:
+            self.rejected += 1
+            raise RateLimitExceeded(f"模型请求排队已满: {self.name}", self._retry_after())
+
+        waiter = _Waiter(tokens, asyncio.get_running_loop().create_future())
+        self._queues.setdefault(client, deque()).append(waiter)
+        self.queued += 1
+        self.max_queued = max(self.max_queued, self.queued)
+        self._dispatch()
+        # 排队时间不超过请求剩余的截止时间
+        left = remaining()
+        max_wait = self.max_wait if left is None else max(0.0, min(self.max_wait, left))
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter.future), max_wait)
+        except asyncio.TimeoutError:
+            if waiter.future.done() and not waiter.future.cancelled():
+                # 超时与发放许可同时发生，许可已计入active，需要归还
+                self.release()
+            else:
+                self._remove(client, waiter)
+            self.timed_out += 1
+            if max_wait < self.max_wait:
+                raise DeadlineExceeded(f"排队期间超过请求的截止时间: {self.name}")
+            raise RateLimitExceeded(f"模型请求排队超时: {self.name}", self._retry_after())
+        except asyncio.CancelledError:
+            if waiter.future.done() and not waiter.future.cancelled():
+                # 已获得许可但调用方被取消，归还许可
+                self.release()
+            else:
+                self._remove(client, waiter)
+            raise
+        self._waits.append(time.monotonic() - waiter.enqueued)
+
+    def _remove(self, client: str, waiter: _Waiter) -> None:
+        queue = self._queues.get(client)
+        if queue is not None and waiter in queue:
+            queue.remove(waiter)
+            self.queued -= 1
+            if not queue:
+                del self._queues[client]
+        waiter.future.cancel()
+
+    def release(self) -> None:
+        self.active -= 1
+        self._dispatch()
+
+    def _dispatch(self) -> None:
+        """按客户端轮询，尽可能多地发放许可；额度不足时定时重试"""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        while self._queues:
+            client, queue = next(iter(self._queues.items()))
+            waiter = queue[0]
+            wait = self._try_grant(waiter.tokens)
+            if wait is None:
+                return  # 等待release
+            if wait > 0:
+                self._timer = asyncio.get_running_loop().call_later(wait, self._dispatch)
+                return
+            queue.popleft()
+            self.queued -= 1
+            # 该客户端移到队尾，实现轮询
+            del self._queues[client]
+            if queue:
+                self._queues[client] = queue
+            waiter.future.set_result(None)
+
+    def _retry_after(self) -> float:
+        """按当前排队的需求估算额度恢复所需的时间"""
+        retry_after = 1.0
+        if self.rpm is not None:
+            retry_after = max(retry_after, (self.queued + 1) / self.rpm.rate)
+        if self.tpm is not None:
+            demand = sum(waiter.tokens for queue in self._queues.values() for waiter in queue)
+            retry_after = max(retry_after, demand / self.tpm.rate)
+        return retry_after
+
+    def stats(self) -> Dict[str, Any]:
+        waits = sorted(self._waits)
+        return {
+            "active": self.active,
+            "queued": self.queued,
+            "max_queued": self.max_queued,
+            "granted": self.granted,
+            "rejected": self.rejected,
+            "timed_out": self.timed_out,
+            "wait_ms_avg": round(sum(waits) / len(waits) * 1000, 1) if waits else 0.0,
+            "wait_ms_p95": round(waits[min(int(len(waits) * 0.95), len(waits) - 1)] * 1000, 1) if waits else 0.0
+        }
+
+
+class RateLimits:
+    def __init__(self):
+        self.max_queue = 100
+        self.max_wait = 30.0
+        self._limiters: Dict[str, Limiter] = {}
+        # API密钥摘要 -> 合并后的 key_rate_limit
+        self._key_settings: Dict[str, Dict[str, Any]] = {}
+
+    def configure(self, settings: Optional[Dict[str, Any]],
+                  models: Optional[Mapping[str, Mapping[str, Any]]] = None) -> None:
+        """根据 settings.rate_limit 设置默认的队列长度和排队时间上限，并按密钥合并 key_rate_limit
+
+        配置重新加载时也调用，已有的限流器保留令牌桶、队列和统计，
+        之后使用时若限额或默认值有变化才重新创建。
+        """
+        settings = settings or {}
+        self.max_queue = settings.get("max_queue", 100)
+        self.max_wait = settings.get("max_wait", 30.0)
+        self._key_settings = self._merge_key_limits(models or {})
+
+    @staticmethod
+    def _digest(api_key: str) -> str:
+        return hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:12]
+
+    @classmethod
+    def _merge_key_limits(cls, models: Mapping[str, Mapping[str, Any]]) -> Dict[str, Dict[str, Any]]:
+        """同一个密钥在多个模型或后端中配置了 key_rate_limit 时，每一项取最严格（最小）的值
+
+        合并结果只在配置加载时计算一次，使用该密钥的所有模型（包括自身未配置
+        key_rate_limit 的）共用同一个限流器，不会因模型之间的配置不同而反复重建。
+        """
+        merged: Dict[str, Dict[str, Any]] = {}
+        for model_id in sorted(models):
+            for backend in Router.backends(models[model_id]):
+                limits = backend.get("key_rate_limit")
+                if not limits or not backend.get("api_key"):
+                    continue
+                target = merged.setdefault(cls._digest(backend["api_key"]), {})
+                for name, value in limits.items():
+                    target[name] = value if name not in target else min(target[name], value)
+        return merged
+
+    def _limiter(self, key: str, settings: Optional[Dict[str, Any]]) -> Optional[Limiter]:
+        if not settings:
+            return None
+        limiter = self._limiters.get(key)
+        if limiter is None or limiter.settings != settings or limiter.defaults != (self.max_queue, self.max_wait):
+            # 旧的限流器由已持有或正在等待许可的请求继续使用，直到它们结束
+            limiter = Limiter(key, settings, self.max_queue, self.max_wait)
+            self._limiters[key] = limiter
+        return limiter
+
+    def model_limiter(self, model_config: Dict[str, Any]) -> Optional[Limiter]:
+        return self._limiter(f"model:{model_config['name']}", model_config.get("rate_limit"))
+
+    def key_limiter(self, backend: Dict[str, Any]) -> Optional[Limiter]:
+        # 同一个API密钥的额度由所有使用它的模型共享，统计中只显示密钥摘要
+        digest = self._digest(backend["api_key"])
+        # 未随配置加载的密钥（如直接传入的后端）按自身的 key_rate_limit 限流
+        settings = self._key_settings.get(digest) or backend.get("key_rate_limit")
+        return self._limiter(f"key:{digest}", settings)
+
+    @asynccontextmanager
+    async def hold(self, limiter: Optional[Limiter], tokens: float, backend: Optional[Dict[str, Any]] = None):
+        """在限流许可内执行，backend 为模型或后端配置，用于记录排队耗时"""
+        if limiter is None:
+            yield
+            return
+        start = time.perf_counter()
+        await limiter.acquire(current_client.get(), tokens)
+        if backend is not None:
+            metrics.observe("queue", backend["name"], backend["provider"], time.perf_counter() - start)
+        try:
+            yield
+        finally:
+            limiter.release()
+
+    def rescale(self, share: float) -> None:
+        for limiter in self._limiters.values():
+            limiter.rescale()
+            if limiter.queued:
+                limiter._dispatch()
+
+    def stats(self) -> Dict[str, Any]:
+        return {key: limiter.stats() for key, limiter in self._limiters.items()}
+
+
+# 全局限流器
+rate_limits = RateLimits()
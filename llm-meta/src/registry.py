@@ -0,0 +1,232 @@
+"""模型注册表
+
+从 config/config.yaml 构建只读的配置快照：加载时完成环境变量替换和校验，
+展开每个模型的后端列表并预先生成请求头和接口地址，编译提示词模板，请求处理时直接使用。
+配置文件修改或收到SIGHUP时重新加载，校验通过后整体替换快照；
+正在处理的请求继续使用它们拿到的旧配置。校验失败时保留当前配置。
+
+注意：只有 models 和 prompt_templates 会热加载，settings 中的其他设置仍需重启生效。
+
+多worker启动时由主进程加载并校验一次配置，写出JSON快照（preload），
+worker启动时配置文件未修改则直接读取快照，不再解析YAML。
+"""
+import asyncio
+import json
+import logging
+import os
+import signal
+import time
+from types import MappingProxyType
+from typing import Any, Callable, Dict, List, Mapping, Optional
+
+import yaml
+
+from .providers import PROVIDER_LABELS, build_headers
+from .router import Router
+from .templates import CompiledTemplate, TemplateError, compile_templates
+
+logger = logging.getLogger(__name__)
+
+REQUIRED_FIELDS = ("name", "provider", "model_name", "base_url", "api_key")
+
+# 主进程写出的配置快照路径
+PRELOAD_ENV = "LLM_CONFIG_PRELOADED"
+
+
+def freeze(value: Any) -> Any:
+    """递归转换为只读结构：dict -> MappingProxyType，list -> tuple"""
+    if isinstance(value, dict):
+        return MappingProxyType({k: freeze(v) for k, v in value.items()})
+    if isinstance(value, list):
+        return tuple(freeze(v) for v in value)
+    return value
+
+
+def _expand(config: Dict[str, Any]) -> Dict[str, Any]:
+    if "api_key" in config:
+        config = dict(config, api_key=os.path.expandvars(config["api_key"]))
+    return config
+
+
+def compile_model(model_id: str, config: Dict[str, Any]) -> Mapping[str, Any]:
+    """校验模型配置，展开后端并预先生成请求头和接口地址"""
+    config = _expand(dict(config))
+    if config.get("backends"):
+        config["backends"] = [_expand(backend) for backend in config["backends"]]
+
+    backends = []
+    for backend in Router.backends(config):
+        missing = [field for field in REQUIRED_FIELDS if not backend.get(field)]
+        if missing:
+            raise ValueError(f"模型 {model_id} 缺少配置: {', '.join(missing)}")
+        if backend["provider"] not in PROVIDER_LABELS:
+            raise ValueError(f"模型 {model_id} 使用了不支持的提供商: {backend['provider']}")
+        backend["request_headers"] = build_headers(backend)
+        backend["chat_url"] = backend["base_url"].rstrip("/") + "/chat/completions"
+        backends.append(backend)
+
+    # 单后端模型本身即为其唯一后端，同样带上预生成的字段
+    if not config.get("backends"):
+        config = dict(backends[0])
+    config["resolved_backends"] = backends
+    return freeze(config)
+
+
+class ConfigSnapshot:
+    """某一时刻的完整配置，创建后不再修改"""
+
+    def __init__(self, raw: Dict[str, Any], path: str, mtime: float, version: int, load_ms: float):
+        self.raw = raw
+        self.path = path
+        self.mtime = mtime
+        self.version = version
+        self.loaded_at = time.time()
+        self.load_ms = load_ms
+        self.models: Mapping[str, Mapping[str, Any]] = MappingProxyType({
+            model_id: compile_model(model_id, model_config)
+            for model_id, model_config in (raw.get("models") or {}).items()
+        })
+        self.settings: Dict[str, Any] = raw.get("settings") or {}
+        self.prompt_templates: List[Dict[str, Any]] = raw.get("prompt_templates") or []
+        self.templates: Mapping[str, CompiledTemplate] = MappingProxyType(compile_templates(self.prompt_templates))
+
+    def model(self, model_id: str) -> Optional[Mapping[str, Any]]:
+        """按ID查找模型，未找到时返回默认模型"""
+        return self.models.get(model_id) or self.models.get("default")
+
+    def render_template(self, template_id: str, variables: Optional[Mapping[str, Any]]) -> str:
+        template = self.templates.get(template_id)
+        if template is None:
+            raise TemplateError(f"提示词模板不存在: {template_id}")
+        return template.render(variables or {})
+
+
+class ModelRegistry:
+    def __init__(self, path: Optional[str] = None):
+        # 环境变量 LLM_CONFIG_PATH 可指定其他配置文件（如基准测试使用的配置）
+        self.path = path or os.getenv("LLM_CONFIG_PATH", os.path.join("config", "config.yaml"))
+        self.snapshot: Optional[ConfigSnapshot] = None
+        self.last_error: Optional[str] = None
+        self.reloads = 0
+        self._listeners: List[Callable[[ConfigSnapshot], None]] = []
+        self._watch_task: Optional["asyncio.Task"] = None
+
+    @property
+    def current(self) -> ConfigSnapshot:
+        if self.snapshot is None:
+            self.load()
+        return self.snapshot
+
+    def _preloaded(self, mtime: float) -> Optional[Dict[str, Any]]:
+        """主进程写出的配置快照，与当前配置文件不一致时返回None"""
+        path = os.getenv(PRELOAD_ENV)
+        if not path:
+            return None
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                preloaded = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if preloaded.get("path") != os.path.abspath(self.path) or preloaded.get("mtime") != mtime:
+            return None
+        return preloaded["raw"]
+
+    def _build(self) -> ConfigSnapshot:
+        start = time.perf_counter()
+        mtime = os.path.getmtime(self.path)
+        raw = self._preloaded(mtime)
+        if raw is None:
+            with open(self.path, "r", encoding="utf-8") as f:
+                raw = yaml.safe_load(f) or {}
+        version = self.snapshot.version + 1 if self.snapshot else 1
+        snapshot = ConfigSnapshot(raw, self.path, mtime, version, 0.0)
+        snapshot.load_ms = round((time.perf_counter() - start) * 1000, 2)
+        return snapshot
+
+    def load(self) -> bool:
+        """加载配置并替换当前快照，失败时保留原配置"""
+        try:
+            snapshot = self._build()
+        except Exception as e:
+            self.last_error = str(e)
+            logger.error(f"配置加载失败: {str(e)}")
+            if self.snapshot is None:
+                self.snapshot = ConfigSnapshot({"models": {}, "prompt_templates": []}, self.path, 0.0, 0, 0.0)
+            return False
+        previous = self.snapshot
+        self.snapshot = snapshot
+        self.last_error = None
+        if previous is not None:
+            self.reloads += 1
+            for listener in self._listeners:
+                try:
+                    listener(snapshot)
+                except Exception as e:
+                    logger.error(f"配置重新加载回调失败: {str(e)}")
+        logger.info(f"配置加载成功: {self.path}（版本 {snapshot.version}，耗时 {snapshot.load_ms}ms）")
+        return True
+
+    def preload(self, path: str) -> None:
+        """加载并校验配置（失败时抛出异常），把原始配置写入path供worker进程读取"""
+        snapshot = self._build()
+        self.snapshot = snapshot
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "w", encoding="utf-8") as f:
+            json.dump({"path": os.path.abspath(self.path), "mtime": snapshot.mtime, "raw": snapshot.raw},
+                      f, ensure_ascii=False)
+        os.environ[PRELOAD_ENV] = path
+
+    def on_reload(self, listener: Callable[[ConfigSnapshot], None]) -> None:
+        self._listeners.append(listener)
+
+    def start(self, settings: Optional[Dict[str, Any]]) -> None:
+        """根据 settings.config_reload 监视配置文件修改，并注册SIGHUP"""
+        settings = settings or {}
+        if not settings.get("enabled", True):
+            return
+        loop = asyncio.get_running_loop()
+        try:
+            loop.add_signal_handler(signal.SIGHUP, self.load)
+        except (AttributeError, NotImplementedError, RuntimeError, ValueError):
+            # Windows 或非主线程中无法注册信号
+            logger.info("当前环境不支持SIGHUP重新加载配置")
+        self._watch_task = asyncio.ensure_future(self._watch(settings.get("interval", 2.0)))
+
+    async def _watch(self, interval: float) -> None:
+        seen = self.current.mtime
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                mtime = os.path.getmtime(self.path)
+            except OSError:
+                continue
+            # 每次修改只尝试加载一次，加载失败时等待下一次修改
+            if mtime != seen:
+                seen = mtime
+                self.load()
+
+    async def stop(self) -> None:
+        if self._watch_task is not None:
+            self._watch_task.cancel()
+            await asyncio.gather(self._watch_task, return_exceptions=True)
+            self._watch_task = None
+        try:
+            asyncio.get_running_loop().remove_signal_handler(signal.SIGHUP)
+        except (AttributeError, NotImplementedError, RuntimeError, ValueError):
+            pass
+
+    def status(self) -> Dict[str, Any]:
+        snapshot = self.current
+        return {
+            "path": self.path,
+            "version": snapshot.version,
+            "loaded_at": snapshot.loaded_at,
+            "load_ms": snapshot.load_ms,
+            "reloads": self.reloads,
+            "models": len(snapshot.models),
+            "last_error": self.last_error
+        }
+
+
+# 全局模型注册表
+registry = ModelRegistry()
@@ -0,0 +1,233 @@
+"""Markdown 转 HTML
+
+format 为 html 时在服务端渲染模型输出：
+  - 渲染结果按内容哈希缓存，相同答案只渲染一次
+  - 较长的文本和批量结果在进程池中渲染，不阻塞事件循环
+  - 流式输出时按块（空行分隔，代码块、列表和引用块内不切分）增量渲染，已完成的块只渲染一次
+"""
+import asyncio
+import hashlib
+import logging
+import re
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+import markdown
+
+from .response_cache import LRUCache
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_EXTENSIONS = ["extra", "sane_lists"]
+
+_FENCE = re.compile(r"^\s*(```|~~~)", re.MULTILINE)
+# 列表项或引用块的开始
+_CONTAINER = re.compile(r" {0,3}([*+-]|\d+[.)])(\s|$)| {0,3}>")
+# 引用式链接（以及缩写）的定义行
+_DEFINITION = re.compile(r"^ {0,3}\*?\[[^\]^][^\]]*\]:.*$", re.MULTILINE)
+_DEFINITION_LABEL = re.compile(r"^ {0,3}\*?\[([^\]^][^\]]*)\]:", re.MULTILINE)
+_REFERENCE = re.compile(r"\[([^\]^][^\]]*)\](?:[ ]?\[([^\]]*)\]|(?![(:]))")
+_FOOTNOTE = re.compile(r"\[\^[^\]]+\]")
+_CODE_SPAN = re.compile(r"`[^`\n]*`")
+
+# 每个进程（包括进程池中的子进程）各自复用一个Markdown实例
+_converters: Dict[Tuple[str, ...], markdown.Markdown] = {}
+
+
+def render_html(text: str, extensions: Tuple[str, ...] = tuple(DEFAULT_EXTENSIONS)) -> str:
+    converter = _converters.get(extensions)
+    if converter is None:
+        converter = markdown.Markdown(extensions=list(extensions))
+        _converters[extensions] = converter
+    return converter.reset().convert(text)
+
+
+class MarkdownRenderer:
+    def __init__(self):
+        self.extensions: Tuple[str, ...] = tuple(DEFAULT_EXTENSIONS)
+        self.offload_threshold = 20000
+        self.workers = 2
+        self.cache = LRUCache(2000, 32 * 1024 * 1024)
+        self.ttl = 86400
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self.hits = 0
+        self.misses = 0
+
+    def configure(self, settings: Optional[Dict[str, Any]]) -> None:
+        """根据 settings.markdown 初始化"""
+        settings = settings or {}
+        self.extensions = tuple(settings.get("extensions", DEFAULT_EXTENSIONS))
+        self.offload_threshold = settings.get("offload_threshold", 20000)
+        self.workers = settings.get("workers", 2)
+        self.ttl = settings.get("cache_ttl", 86400)
+        self.cache = LRUCache(settings.get("cache_entries", 2000), settings.get("cache_bytes", 32 * 1024 * 1024))
+
+    def _pool_executor(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=self.workers)
+        return self._pool
+
+    @staticmethod
+    def _key(text: str) -> str:
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def _cached(self, text: str) -> Tuple[str, Optional[str]]:
+        key = self._key(text)
+        html = self.cache.get(key)
+        if html is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return key, html
+
+    def render(self, text: str) -> str:
+        """在当前线程渲染（用于短文本）"""
+        key, html = self._cached(text)
+        if html is None:
+            html = render_html(text, self.extensions)
+            self.cache.set(key, html, self.ttl, len(html))
+        return html
+
+    async def render_async(self, text: str, offload: bool = False) -> str:
+        """渲染单段文本；超过阈值或offload为true时在进程池中执行"""
+        if not offload and len(text) < self.offload_threshold:
+            return self.render(text)
+        key, html = self._cached(text)
+        if html is None:
+            loop = asyncio.get_running_loop()
+            html = await loop.run_in_executor(self._pool_executor(), render_html, text, self.extensions)
+            self.cache.set(key, html, self.ttl, len(html))
+        return html
+
+    def stream(self) -> "IncrementalRenderer":
+        return IncrementalRenderer(self)
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            "entries": len(self.cache)
+        }
+
+    def close(self) -> None:
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+
+class IncrementalRenderer:
+    """流式增量渲染：每当一个或多个块完整到达时返回这些块的HTML
+
+    为使拼接结果与整篇渲染一致：列表和引用块在空行之后可能继续，要等到下一行确定不属于它们才切分；
+    引用式链接的定义在后续块中仍然有效，已出现的定义会附加到之后的每个块前面，
+    引用了尚未出现的定义时暂不切分；脚注汇总在文末，出现脚注后剩余内容在结束时一并渲染。
+    """
+
+    def __init__(self, renderer: MarkdownRenderer):
+        self.renderer = renderer
+        self.buffer = ""
+        self.definitions: List[str] = []
+        self._defined: Set[str] = set()
+        self._footnotes = False
+
+    def feed(self, delta: str) -> Optional[str]:
+        self.buffer += delta
+        if self._footnotes:
+            return None
+        cut = self._boundary()
+        if cut <= 0:
+            return None
+        block, self.buffer = self.buffer[:cut], self.buffer[cut:]
+        return self._render(block)
+
+    def _render(self, block: str) -> str:
+        html = self.renderer.render("".join(self.definitions) + "\n" + block if self.definitions else block)
+        for line in _DEFINITION.findall(_prose(block)):
+            self.definitions.append(line + "\n")
+            self._defined.add(_label(_DEFINITION_LABEL.match(line).group(1)))
+        return html
+
+    def _boundary(self) -> int:
+        """最后一个可以安全切分的位置，没有时返回0
+
+        只检查最后一个候选位置：之前的候选位置在它们是最后一个时已经检查过。
+        """
+        cuts = self._candidates()
+        if not cuts:
+            return 0
+        text = _prose(self.buffer[:cuts[-1]])
+        if _FOOTNOTE.search(text):
+            self._footnotes = True
+            return 0
+        defined = self._defined | {_label(label) for label in _DEFINITION_LABEL.findall(text)}
+        if all(_label(label) in defined for label in _references(text)):
+            return cuts[-1]
+        return 0
+
+    def _candidates(self) -> List[int]:
+        """代码块之外、不在列表或引用块中的空行之后，以及代码块结束处的位置"""
+        cuts: List[int] = []
+        in_fence = False
+        container = False  # 上一个块是列表或引用块
+        blank_at: Optional[int] = None  # 空行结束的位置，要等到下一行才能确定是否可以切分
+        position = 0
+        for line in self.buffer.splitlines(keepends=True):
+            start, position = position, position + len(line)
+            if not line.endswith("\n"):
+                break  # 最后一行尚未结束
+            if in_fence:
+                if _FENCE.match(line):
+                    in_fence = False
+                    if not container:
+                        cuts.append(position)  # 代码块结束
+                continue
+            if not line.strip():
+                blank_at = position
+                continue
+            if blank_at is not None or start == 0:
+                if container and (_CONTAINER.match(line) or line[0] in " \t"):
+                    blank_at = None  # 列表或引用块在空行之后继续
+                else:
+                    if blank_at is not None:
+                        cuts.append(blank_at)
+                    blank_at = None
+                    container = bool(_CONTAINER.match(line))
+            if _FENCE.match(line):
+                in_fence = True
+        if blank_at is not None and not container:
+            cuts.append(blank_at)
+        return cuts
+
+    def finish(self) -> Optional[str]:
+        if not self.buffer.strip():
+            return None
+        block, self.buffer = self.buffer, ""
+        return self._render(block)
+
+
+def _prose(text: str) -> str:
+    """去掉代码块和行内代码，只保留可能包含链接引用的文本"""
+    lines = []
+    in_fence = False
+    for line in text.splitlines(keepends=True):
+        if _FENCE.match(line):
+            in_fence = not in_fence
+        elif not in_fence:
+            lines.append(line)
+    return _CODE_SPAN.sub("", "".join(lines))
+
+
+def _references(text: str) -> List[str]:
+    """引用式链接和图片使用的标签：[文本][标签]、[标签][] 和 [标签]"""
+    text = _DEFINITION.sub("", text)
+    return [label or text_label for text_label, label in _REFERENCE.findall(text)]
+
+
+def _label(label: str) -> str:
+    return " ".join(label.lower().split())
+
+
+# 全局Markdown渲染器
+markdown_renderer = MarkdownRenderer()
@@ -0,0 +1,248 @@
+"""模型响应缓存
+
+对确定性调用（默认 temperature 为 0）按请求指纹做精确匹配缓存，
+进程内 LRU 为一级缓存，可选 Redis 为二级缓存；
+多worker部署时未配置Redis则使用共享状态的存储作为二级缓存，worker之间共享缓存结果。
+"""
+import hashlib
+import json
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+try:
+    import redis.asyncio as aioredis
+except ImportError:
+    aioredis = None
+
+
+def request_fingerprint(kind: str, model_config: Dict[str, Any], messages: List[Dict[str, str]], params: Dict[str, Any]) -> str:
+    """根据模型、规范化后的消息和参数计算请求指纹"""
+    normalized = [
+        {"role": m["role"], "content": m["content"].strip()}
+        for m in messages
+    ]
+    payload = json.dumps({
+        "kind": kind,
+        "model": f"{model_config['name']}|{model_config.get('provider')}:{model_config.get('model_name')}",
+        "messages": normalized,
+        "params": params
+    }, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def _value_size(value: Dict[str, Any]) -> int:
+    return len(value.get("text", "").encode("utf-8"))
+
+
+class LRUCache:
+    """进程内LRU缓存，按TTL、条目数和总字节数淘汰"""
+
+    def __init__(self, max_entries: int = 1000, max_bytes: int = 64 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self.evictions = 0
+        self._data: "OrderedDict[str, tuple]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: str) -> Optional[Any]:
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        expires_at, size, value = entry
+        if expires_at < time.monotonic():
+            self._remove(key)
+            return None
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key: str, value: Any, ttl: int, size: int = 0) -> None:
+        if key in self._data:
+            self._remove(key)
+        self._data[key] = (time.monotonic() + ttl, size, value)
+        self.total_bytes += size
+        while self._data and (len(self._data) > self.max_entries or self.total_bytes > self.max_bytes):
+            oldest = next(iter(self._data))
+            self._remove(oldest)
+            self.evictions += 1
+
+    def delete(self, key: str) -> None:
+        if key in self._data:
+            self._remove(key)
+
+    def clear(self) -> None:
+        self._data.clear()
+        self.total_bytes = 0
+
+    def _remove(self, key: str) -> None:
+        _, size, _ = self._data.pop(key)
+        self.total_bytes -= size
+
+
+class RedisCache:
+    def __init__(self, settings: Dict[str, Any]):
+        self.prefix = settings.get("prefix", "llm:resp:")
+        self.redis = aioredis.Redis(
+            host=settings.get("host", "localhost"),
+            port=settings.get("port", 6379),
+            password=settings.get("password") or None,
+            db=settings.get("db", 0),
+            socket_timeout=settings.get("socket_timeout", 0.5),
+            decode_responses=True
+        )
+
+    async def set_data(self, key: str, data: Any, expire_seconds: int = 300) -> bool:
+        """
+        设置缓存数据
+        :param key: 缓存键
+        :param data: 要缓存的数据
+        :param expire_seconds: 过期时间（秒）
+        :return: 是否成功
+        """
+        try:
+            serialized_data = json.dumps(data, ensure_ascii=False)
+            return bool(await self.redis.setex(self.prefix + key, expire_seconds, serialized_data))
+        except Exception as e:
+            logger.error(f"设置缓存失败 - key: {key}, error: {str(e)}")
+            return False
+
+    async def get_data(self, key: str) -> Optional[Any]:
+        """
+        获取缓存数据
+        :param key: 缓存键
+        :return: 缓存的数据，如果不存在则返回None
+        """
+        try:
+            data = await self.redis.get(self.prefix + key)
+            return json.loads(data) if data else None
+        except Exception as e:
+            logger.error(f"获取缓存失败 - key: {key}, error: {str(e)}")
+            return None
+
+    async def get_with_ttl(self, key: str) -> Tuple[Optional[Any], Optional[float]]:
+        """获取缓存数据及其剩余有效期（秒），没有过期时间时剩余有效期为None"""
+        try:
+            pipe = self.redis.pipeline(transaction=False)
+            pipe.get(self.prefix + key)
+            pipe.pttl(self.prefix + key)
+            data, pttl = await pipe.execute()
+            if not data:
+                return None, None
+            return json.loads(data), pttl / 1000 if pttl >= 0 else None
+        except Exception as e:
+            logger.error(f"获取缓存失败 - key: {key}, error: {str(e)}")
+            return None, None
+
+    async def delete_data(self, key: str) -> None:
+        try:
+            await self.redis.delete(self.prefix + key)
+        except Exception as e:
+            logger.error(f"删除缓存失败 - key: {key}, error: {str(e)}")
+
+    async def close(self) -> None:
+        await self.redis.close()
+
+
+class ResponseCache:
+    """两级响应缓存，附带命中统计"""
+
+    def __init__(self):
+        self.enabled = False
+        self.default_ttl = 3600
+        self.local = LRUCache()
+        self.remote: Optional[RedisCache] = None
+        self.shared = None
+        self.hits = 0
+        self.remote_hits = 0
+        self.misses = 0
+        self.stores = 0
+
+    def configure(self, settings: Optional[Dict[str, Any]], shared: Optional[Any] = None) -> None:
+        """根据 settings.response_cache 初始化缓存，shared 为多进程共享的存储（见 shared_state）"""
+        settings = settings or {}
+        self.enabled = settings.get("enabled", False)
+        self.default_ttl = settings.get("ttl", 3600)
+        self.local = LRUCache(
+            max_entries=settings.get("max_entries", 1000),
+            max_bytes=settings.get("max_bytes", 64 * 1024 * 1024)
+        )
+        self.remote = None
+        self.shared = shared
+        redis_settings = settings.get("redis") or {}
+        if self.enabled and redis_settings.get("enabled"):
+            if aioredis is None:
+                logger.warning("未安装redis，响应缓存仅使用进程内缓存")
+            else:
+                self.remote = RedisCache(redis_settings)
+                logger.info("响应缓存已启用Redis二级缓存")
+        if self.enabled and self.remote is None and shared is not None:
+            self.remote = shared
+
+    def ttl_for(self, model_config: Dict[str, Any], params: Dict[str, Any]) -> int:
+        """返回该请求可用的缓存时间，0表示不缓存"""
+        if not self.enabled:
+            return 0
+        model_cache = model_config.get("cache")
+        if not model_cache:
+            return 0
+        if not isinstance(model_cache, dict):
+            model_cache = {}
+        # 默认只缓存确定性调用
+        if model_cache.get("deterministic_only", True) and params.get("temperature", 0.7) != 0:
+            return 0
+        return model_cache.get("ttl", self.default_ttl)
+
+    async def get(self, key: str, ttl: int) -> Optional[Dict[str, Any]]:
+        """ttl 为该请求的缓存时间（见 ttl_for），从二级缓存读到的条目在本地最多保留到二级缓存中的过期时间"""
+        value = self.local.get(key)
+        if value is not None:
+            self.hits += 1
+            return value
+        if self.remote is not None:
+            value, remaining = await self.remote.get_with_ttl(key)
+            if value is not None:
+                self.hits += 1
+                self.remote_hits += 1
+                if remaining is not None:
+                    ttl = min(ttl, remaining)
+                self.local.set(key, value, ttl, _value_size(value))
+                return value
+        self.misses += 1
+        return None
+
+    async def set(self, key: str, value: Dict[str, Any], ttl: int) -> None:
+        self.stores += 1
+        self.local.set(key, value, ttl, _value_size(value))
+        if self.remote is not None:
+            await self.remote.set_data(key, value, ttl)
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "hits": self.hits,
+            "remote_hits": self.remote_hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            "stores": self.stores,
+            "entries": len(self.local),
+            "bytes": self.local.total_bytes,
+            "evictions": self.local.evictions,
+            "redis": isinstance(self.remote, RedisCache),
+            "shared": self.remote is not None
+        }
+
+    async def close(self) -> None:
+        # 共享存储由 shared_state 关闭
+        if self.remote is not None and self.remote is not self.shared:
+            await self.remote.close()
+
+
+# 全局响应缓存
+response_cache = ResponseCache()
@@ -0,0 +1,293 @@
+"""多后端路由
+
+模型可以在 backends 中配置多个上游（例如 DeepSeek 官方接口和一个OpenAI兼容镜像），
+路由器按观测到的延迟和错误率（EWMA）选择后端：
+  - 请求超过该后端历史延迟的指定分位数仍未返回时，向下一个后端发起对冲请求，取先返回的结果
+  - 遇到可重试错误（429、5xx、连接失败、超时）时切换后端重试，退避时间带随机抖动并遵守Retry-After
+流式请求只在收到第一段内容之前做故障切换。
+请求设置了截止时间时，重试和对冲都在截止时间内进行，剩余时间不够退避时不再重试。
+"""
+import asyncio
+import logging
+import random
+import time
+from collections import deque
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional
+
+import httpx
+
+from .deadline import deadline_scope, remaining
+from .providers import ProviderError
+
+logger = logging.getLogger(__name__)
+
+RETRYABLE_STATUS = {408, 429, 500, 502, 503, 504}
+
+
+def is_retryable(error: BaseException) -> bool:
+    if isinstance(error, ProviderError):
+        return error.status_code in RETRYABLE_STATUS
+    return isinstance(error, (httpx.TransportError, asyncio.TimeoutError))
+
+
+class BackendStats:
+    """单个后端的延迟和错误率统计"""
+
+    def __init__(self, alpha: float, window: int):
+        self.alpha = alpha
+        self.latency_ewma: Optional[float] = None
+        self.error_ewma = 0.0
+        self.latencies: deque = deque(maxlen=window)
+        self.cooldown_until = 0.0
+        # 健康探测失败后的冷却，与请求的错误统计分开记录
+        self.probe_down_until = 0.0
+        self.requests = 0
+        self.errors = 0
+
+    def record_latency(self, latency: float) -> None:
+        self.latencies.append(latency)
+        if self.latency_ewma is None:
+            self.latency_ewma = latency
+        else:
+            self.latency_ewma += self.alpha * (latency - self.latency_ewma)
+
+    def record_success(self, latency: float) -> None:
+        self.requests += 1
+        self.record_latency(latency)
+        self.error_ewma *= 1 - self.alpha
+
+    def record_error(self, retry_after: Optional[float] = None) -> None:
+        self.requests += 1
+        self.errors += 1
+        self.error_ewma += self.alpha * (1 - self.error_ewma)
+        if retry_after:
+            self.cooldown_until = max(self.cooldown_until, time.monotonic() + retry_after)
+
+    def record_probe(self, ok: bool, cooldown: float) -> None:
+        """记录健康探测结果：失败时冷却cooldown秒，成功时解除探测造成的冷却"""
+        self.probe_down_until = 0.0 if ok else time.monotonic() + cooldown
+
+    def cooling_down(self, now: float) -> bool:
+        return max(self.cooldown_until, self.probe_down_until) > now
+
+    def percentile(self, q: float) -> Optional[float]:
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+
+    def score(self, error_penalty: float) -> float:
+        # 没有样本的后端得分为0，优先试探
+        latency = self.latency_ewma or 0.0
+        return latency * (1 + error_penalty * self.error_ewma) + self.error_ewma
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "latency_ewma_ms": round(self.latency_ewma * 1000, 1) if self.latency_ewma is not None else None,
+            "error_rate_ewma": round(self.error_ewma, 4),
+            "requests": self.requests,
+            "errors": self.errors,
+            "cooling_down": self.cooling_down(time.monotonic())
+        }
+
+
+class Router:
+    def __init__(self):
+        self.settings: Dict[str, Any] = {}
+        self._stats: Dict[str, BackendStats] = {}
+
+    def configure(self, settings: Optional[Dict[str, Any]]) -> None:
+        """根据 settings.routing 初始化"""
+        self.settings = dict(settings or {})
+
+    def _setting(self, name: str, default: Any) -> Any:
+        return self.settings.get(name, default)
+
+    @staticmethod
+    def backends(model_config: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """展开模型的后端列表，后端未配置的字段继承模型配置；注册表已展开的直接使用"""
+        resolved = model_config.get("resolved_backends")
+        if resolved:
+            return list(resolved)
+        base = {k: v for k, v in model_config.items() if k != "backends"}
+        backends = model_config.get("backends")
+        if not backends:
+            return [base]
+        return [{**base, **backend} for backend in backends]
+
+    @staticmethod
+    def backend_key(backend: Dict[str, Any]) -> str:
+        return f"{backend['provider']}:{backend['base_url']}:{backend['model_name']}"
+
+    def stats_for(self, backend: Dict[str, Any]) -> BackendStats:
+        key = self.backend_key(backend)
+        stats = self._stats.get(key)
+        if stats is None:
+            stats = BackendStats(self._setting("ewma_alpha", 0.2), self._setting("latency_window", 200))
+            self._stats[key] = stats
+        return stats
+
+    def rank(self, backends: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """按得分排序，冷却中的后端排在最后"""
+        now = time.monotonic()
+        penalty = self._setting("error_penalty", 4.0)
+        return sorted(backends, key=lambda b: (
+            self.stats_for(b).cooling_down(now),
+            self.stats_for(b).score(penalty)
+        ))
+
+    def _candidates(self, backends: List[Dict[str, Any]], tried: set) -> List[Dict[str, Any]]:
+        """本次请求尚未尝试过的后端优先，全部尝试过后重新从最优的开始"""
+        ranked = self.rank(backends)
+        untried = [b for b in ranked if self.backend_key(b) not in tried]
+        if not untried:
+            tried.clear()
+            return ranked
+        return untried + [b for b in ranked if self.backend_key(b) in tried]
+
+    def _backoff(self, attempt: int, error: BaseException) -> float:
+        base = self._setting("backoff_base", 0.2)
+        cap = self._setting("backoff_max", 5.0)
+        # full jitter
+        delay = random.uniform(0, min(cap, base * (2 ** attempt)))
+        retry_after = getattr(error, "retry_after", None)
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        return delay
+
+    async def _attempt(self, backend: Dict[str, Any], fn: Callable[[Dict[str, Any]], Awaitable[Any]]) -> Any:
+        stats = self.stats_for(backend)
+        start = time.monotonic()
+        try:
+            # 对冲落败被取消时（CancelledError）不记录延迟：截断的耗时会让较慢的后端显得更快
+            result = await fn(backend)
+        except Exception as e:
+            if is_retryable(e):
+                stats.record_error(getattr(e, "retry_after", None))
+            raise
+        stats.record_success(time.monotonic() - start)
+        return result
+
+    def _hedge_delay(self, backend: Dict[str, Any]) -> Optional[float]:
+        if not self._setting("hedge", True):
+            return None
+        stats = self.stats_for(backend)
+        if len(stats.latencies) < self._setting("hedge_min_samples", 20):
+            return None
+        delay = stats.percentile(self._setting("hedge_percentile", 0.95))
+        return max(delay, self._setting("hedge_min_delay", 0.5))
+
+    async def _hedged(self, primary: Dict[str, Any], secondary: Optional[Dict[str, Any]],
+                      fn: Callable[[Dict[str, Any]], Awaitable[Any]]) -> Any:
+        """调用主后端，超过分位数延迟仍未返回时向备用后端发起对冲请求"""
+        delay = self._hedge_delay(primary) if secondary is not None else None
+        tasks = [asyncio.ensure_future(self._attempt(primary, fn))]
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if not done:
+                logger.info(f"请求超过 {delay:.2f}s 未返回，对冲到 {self.backend_key(secondary)}")
+                tasks.append(asyncio.ensure_future(self._attempt(secondary, fn)))
+            pending = set(tasks)
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = error or task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+
+    async def call(self, model_config: Dict[str, Any], fn: Callable[[Dict[str, Any]], Awaitable[Any]]) -> Any:
+        """在模型的后端之间路由一次非流式调用"""
+        async with deadline_scope():
+            return await self._call(model_config, fn)
+
+    async def _call(self, model_config: Dict[str, Any], fn: Callable[[Dict[str, Any]], Awaitable[Any]]) -> Any:
+        backends = self.backends(model_config)
+        max_attempts = self._setting("max_attempts", 3)
+        tried = set()
+        for attempt in range(max_attempts):
+            ranked = self._candidates(backends, tried)
+            primary = ranked[0]
+            secondary = ranked[1] if len(ranked) > 1 else None
+            tried.add(self.backend_key(primary))
+            try:
+                return await self._hedged(primary, secondary, fn)
+            except Exception as e:
+                if not is_retryable(e) or attempt == max_attempts - 1:
+                    raise
+                delay = self._failover_delay(attempt, e, backends)
+                if delay is None:
+                    raise
+                logger.warning(f"{self.backend_key(primary)} 调用失败，{delay:.2f}s后重试: {str(e)}")
+                await asyncio.sleep(delay)
+
+    def _failover_delay(self, attempt: int, error: BaseException, backends: List[Dict[str, Any]]) -> Optional[float]:
+        """计算重试前的等待时间；Retry-After超过上限时返回None（不再重试）"""
+        now = time.monotonic()
+        if len(backends) > 1 and any(not self.stats_for(b).cooling_down(now) for b in backends):
+            # 还有可用的后端，只做短暂抖动后切换
+            return random.uniform(0, self._setting("backoff_base", 0.2))
+        delay = self._backoff(attempt, error)
+        if delay > self._setting("max_retry_after", 10.0):
+            return None
+        left = remaining()
+        if left is not None and delay >= left:
+            return None
+        return delay
+
+    async def stream(self, model_config: Dict[str, Any],
+                     factory: Callable[[Dict[str, Any]], AsyncIterator[str]]) -> AsyncIterator[str]:
+        """流式调用：收到第一段内容之前可以切换后端，之后的错误直接抛出"""
+        backends = self.backends(model_config)
+        max_attempts = self._setting("max_attempts", 3)
+        tried = set()
+        for attempt in range(max_attempts):
+            backend = self._candidates(backends, tried)[0]
+            tried.add(self.backend_key(backend))
+            stats = self.stats_for(backend)
+            chunks = factory(backend)
+            start = time.monotonic()
+            try:
+                async with deadline_scope():
+                    first = await chunks.__anext__()
+            except StopAsyncIteration:
+                stats.record_success(time.monotonic() - start)
+                return
+            except Exception as e:
+                if is_retryable(e):
+                    stats.record_error(getattr(e, "retry_after", None))
+                if not is_retryable(e) or attempt == max_attempts - 1:
+                    raise
+                delay = self._failover_delay(attempt, e, backends)
+                if delay is None:
+                    raise
+                logger.warning(f"{self.backend_key(backend)} 流式调用失败，{delay:.2f}s后重试: {str(e)}")
+                await asyncio.sleep(delay)
+                continue
+
+            # 以首段延迟作为流式请求的延迟样本
+            stats.record_success(time.monotonic() - start)
+            try:
+                yield first
+                while True:
+                    try:
+                        async with deadline_scope():
+                            chunk = await chunks.__anext__()
+                    except StopAsyncIteration:
+                        break
+                    yield chunk
+            finally:
+                await chunks.aclose()
+            return
+
+    def stats(self) -> Dict[str, Any]:
+        return {key: stats.snapshot() for key, stats in self._stats.items()}
+
+
+# 全局路由器
+router = Router()
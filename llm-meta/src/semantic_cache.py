@@ -0,0 +1,337 @@
+"""语义响应缓存
+
+对提示词做本地向量化（默认使用字符n-gram哈希，无需下载模型），
+在历史提示词向量中做内积检索，相似度超过阈值时直接返回缓存答案。
+向量以内存映射文件保存在磁盘上，重启后无需重建索引。
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+import zlib
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+_WHITESPACE = re.compile(r"\s+")
+_PUNCTUATION = re.compile(r"[\s\W_]+")
+_NUMBER = re.compile(r"\d+(?:\.\d+)?")
+
+
+def _bigrams(text: str) -> set:
+    return {text[i:i + 2] for i in range(len(text) - 1)} or {text}
+
+
+def near_duplicate(a: str, b: str, min_overlap: float) -> bool:
+    """向量相似之外的字面检查：数字必须完全相同，字符二元组的重合度不低于min_overlap
+
+    哈希向量对整段文本打分，只差一个地名或数字的两个问题也能超过阈值，而答案完全不同
+    """
+    if _NUMBER.findall(a) != _NUMBER.findall(b):
+        return False
+    a, b = _PUNCTUATION.sub("", a.lower()), _PUNCTUATION.sub("", b.lower())
+    if a == b:
+        return True
+    grams_a, grams_b = _bigrams(a), _bigrams(b)
+    return len(grams_a & grams_b) / len(grams_a | grams_b) >= min_overlap
+
+
+class HashingEmbedder:
+    """字符n-gram哈希向量化，中英文混合文本均可使用"""
+
+    def __init__(self, dim: int = 1024, ngrams=(2, 3)):
+        self.dim = dim
+        self.ngrams = tuple(ngrams)
+
+    def embed(self, text: str) -> np.ndarray:
+        text = _WHITESPACE.sub(" ", text.strip().lower())
+        hashes = [
+            zlib.crc32(text[i:i + n].encode("utf-8"))
+            for n in self.ngrams
+            for i in range(max(len(text) - n + 1, 1))
+        ]
+        hashes = np.asarray(hashes, dtype=np.uint32)
+        # 低位决定维度，最高位决定符号，减小哈希冲突带来的偏差
+        signs = np.where(hashes >> 31, -1.0, 1.0)
+        vector = np.bincount(hashes % self.dim, weights=signs, minlength=self.dim).astype(np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+
+class SentenceEmbedder:
+    """本地 sentence-transformers 模型（CPU），需安装 sentence-transformers"""
+
+    def __init__(self, model_name: str):
+        from sentence_transformers import SentenceTransformer
+        self.model = SentenceTransformer(model_name, device="cpu")
+        self.dim = self.model.get_sentence_embedding_dimension()
+
+    def embed(self, text: str) -> np.ndarray:
+        return self.model.encode(text, normalize_embeddings=True).astype(np.float32)
+
+
+class VectorIndex:
+    """固定容量的向量索引，容量写满后循环覆盖最旧的条目
+
+    磁盘文件:
+      vectors.f32    容量 x 维度 的float32矩阵（内存映射）
+      entries.jsonl  每个槽位对应的模型、提示词和答案，后写覆盖先写
+      meta.json      维度、容量、已用数量和写入位置
+    """
+
+    def __init__(self, path: str, dim: int, capacity: int):
+        self.path = path
+        self.dim = dim
+        self.capacity = capacity
+        self.size = 0
+        self.cursor = 0
+        self.entries: List[Optional[Dict[str, Any]]] = [None] * capacity
+        self.namespaces = np.full(capacity, -1, dtype=np.int32)
+        self.created = np.zeros(capacity, dtype=np.float64)
+        self._namespace_ids: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._journal_lines = 0
+        os.makedirs(path, exist_ok=True)
+        self.vectors = self._open()
+
+    def _file(self, name: str) -> str:
+        return os.path.join(self.path, name)
+
+    def _open(self) -> np.memmap:
+        meta_path = self._file("meta.json")
+        vectors_path = self._file("vectors.f32")
+        meta = None
+        if os.path.exists(meta_path) and os.path.exists(vectors_path):
+            with open(meta_path, "r", encoding="utf-8") as f:
+                meta = json.load(f)
+            if meta.get("dim") != self.dim or meta.get("capacity") != self.capacity:
+                logger.warning("语义缓存索引维度或容量已变更，重新创建索引")
+                meta = None
+
+        if meta is None:
+            vectors = np.memmap(vectors_path, dtype=np.float32, mode="w+", shape=(self.capacity, self.dim))
+            open(self._file("entries.jsonl"), "w", encoding="utf-8").close()
+            self._write_meta()
+            return vectors
+
+        self.size = meta["size"]
+        self.cursor = meta["cursor"]
+        self._load_entries()
+        # meta.json按批刷新，进程退出前最后几条只记录在条目日志中
+        self.size = max(self.size, sum(entry is not None for entry in self.entries))
+        logger.info(f"语义缓存索引已加载: {self.size}条")
+        return np.memmap(vectors_path, dtype=np.float32, mode="r+", shape=(self.capacity, self.dim))
+
+    def _load_entries(self) -> None:
+        with open(self._file("entries.jsonl"), "r", encoding="utf-8") as f:
+            for line in f:
+                self._journal_lines += 1
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue  # 进程异常退出时最后一行可能不完整
+                slot = entry.pop("slot")
+                if slot < self.capacity:
+                    self._set_entry(slot, entry)
+                    self.cursor = (slot + 1) % self.capacity
+
+    def _set_entry(self, slot: int, entry: Dict[str, Any]) -> None:
+        namespace = entry["namespace"]
+        if namespace not in self._namespace_ids:
+            self._namespace_ids[namespace] = len(self._namespace_ids)
+        self.entries[slot] = entry
+        self.namespaces[slot] = self._namespace_ids[namespace]
+        self.created[slot] = entry["ts"]
+
+    def _write_meta(self) -> None:
+        tmp_path = self._file("meta.json.tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"dim": self.dim, "capacity": self.capacity, "size": self.size, "cursor": self.cursor}, f)
+        os.replace(tmp_path, self._file("meta.json"))
+
+    def search(self, namespace: str, vector: np.ndarray, min_created: float):
+        """返回 (相似度, 条目)，没有候选时返回 (0.0, None)"""
+        namespace_id = self._namespace_ids.get(namespace)
+        if namespace_id is None or self.size == 0:
+            return 0.0, None
+        with self._lock:
+            scores = self.vectors[:self.size] @ vector
+            valid = (self.namespaces[:self.size] == namespace_id) & (self.created[:self.size] >= min_created)
+            if not valid.any():
+                return 0.0, None
+            scores = np.where(valid, scores, -1.0)
+            best = int(np.argmax(scores))
+            return float(scores[best]), self.entries[best]
+
+    def add(self, namespace: str, vector: np.ndarray, text: str, answer: str, flush_every: int = 64) -> None:
+        entry = {"namespace": namespace, "prompt": text[:500], "answer": answer, "ts": time.time()}
+        with self._lock:
+            slot = self.cursor
+            self.vectors[slot] = vector
+            self._set_entry(slot, entry)
+            with open(self._file("entries.jsonl"), "a", encoding="utf-8") as f:
+                f.write(json.dumps(dict(entry, slot=slot), ensure_ascii=False) + "\n")
+            self._journal_lines += 1
+            self.cursor = (self.cursor + 1) % self.capacity
+            self.size = min(self.size + 1, self.capacity)
+            self._pending += 1
+            if self._pending >= flush_every:
+                self._flush()
+            if self._journal_lines > self.capacity * 2:
+                self._compact()
+
+    def _flush(self) -> None:
+        self.vectors.flush()
+        self._write_meta()
+        self._pending = 0
+
+    def _compact(self) -> None:
+        """槽位被覆盖后条目日志会不断增长，定期只保留当前有效的条目"""
+        tmp_path = self._file("entries.jsonl.tmp")
+        live = [(entry["ts"], slot, entry) for slot, entry in enumerate(self.entries) if entry is not None]
+        # 按写入时间排序，加载时最后一行即为最新槽位
+        live.sort(key=lambda item: item[0])
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for _, slot, entry in live:
+                f.write(json.dumps(dict(entry, slot=slot), ensure_ascii=False) + "\n")
+        os.replace(tmp_path, self._file("entries.jsonl"))
+        self._journal_lines = self.size
+
+    def flush(self) -> None:
+        with self._lock:
+            self._flush()
+
+
+class SemanticCache:
+    """语义缓存入口，负责配置、向量化和统计"""
+
+    def __init__(self):
+        self.enabled = False
+        self.threshold = 0.95
+        self.min_overlap = 0.8
+        self.ttl = 86400
+        self.embedder = None
+        self.index: Optional[VectorIndex] = None
+        self.hits = 0
+        self.misses = 0
+
+    def configure(self, settings: Optional[Dict[str, Any]], workers: int = 1) -> None:
+        """根据 settings.semantic_cache 初始化
+
+        索引文件的写入位置和条目列表保存在各进程内存中，多个worker共用同一目录会互相覆盖，
+        因此多worker时不开启。
+        """
+        settings = settings or {}
+        self.enabled = settings.get("enabled", False)
+        if self.enabled and workers > 1:
+            logger.warning(f"语义缓存不支持多个worker共用索引，当前{workers}个worker，已关闭语义缓存")
+            self.enabled = False
+        if not self.enabled:
+            return
+        self.threshold = settings.get("threshold", 0.95)
+        self.min_overlap = settings.get("min_overlap", 0.8)
+        self.ttl = settings.get("ttl", 86400)
+        self.embedder = self._create_embedder(settings)
+        self.index = VectorIndex(
+            settings.get("path", "data/semantic_cache"),
+            self.embedder.dim,
+            settings.get("capacity", 50000)
+        )
+
+    @staticmethod
+    def _create_embedder(settings: Dict[str, Any]):
+        if settings.get("embedder", "hashing") == "sentence-transformers":
+            try:
+                return SentenceEmbedder(settings["model_name"])
+            except Exception as e:
+                logger.warning(f"本地向量模型加载失败，改用哈希向量: {str(e)}")
+        return HashingEmbedder(settings.get("dim", 1024))
+
+    def enabled_for(self, model_config: Dict[str, Any], params: Dict[str, Any]) -> bool:
+        model_semantic = model_config.get("semantic_cache")
+        if not self.enabled or not model_semantic:
+            return False
+        if not isinstance(model_semantic, dict):
+            model_semantic = {}
+        # 与精确缓存一致，默认只缓存确定性调用
+        return not (model_semantic.get("deterministic_only", True) and params.get("temperature", 0.7) != 0)
+
+    @staticmethod
+    def namespace(kind: str, model_config: Dict[str, Any], params: Dict[str, Any], context: str) -> str:
+        """只在上下文完全相同、输出形式相同的请求之间复用答案：max_tokens不同或一个采样一个不采样时不共用"""
+        sampled = "sampled" if params.get("temperature", 0.7) != 0 else "greedy"
+        return (f"{kind}|{model_config['name']}|{model_config.get('provider')}:{model_config.get('model_name')}"
+                f"|{params.get('max_tokens')}|{sampled}|{context}")
+
+    @staticmethod
+    def key_of(messages: List[Dict[str, Any]], template: Optional[str] = None,
+               variables: Optional[Dict[str, Any]] = None) -> Tuple[str, str]:
+        """拆分为(上下文摘要, 可变部分)，只对可变部分做向量检索，上下文须完全相同
+
+        使用模板时可变部分为模板变量，上下文为模板内容；否则可变部分为最后一条消息，
+        上下文为之前的消息（含system）和各条消息的角色。模板等固定前缀不参与打分，不会掩盖问题本身的差别。
+        """
+        if template is not None:
+            context = f"template:{template}"
+            text = "\n".join(f"{name}: {value}" for name, value in sorted((variables or {}).items()))
+        else:
+            context = "\n".join(f"{m['role']}: {m['content']}" for m in messages[:-1])
+            context += f"\n{messages[-1]['role']}:" if messages else ""
+            text = messages[-1]["content"] if messages else ""
+        return hashlib.sha256(context.encode("utf-8")).hexdigest()[:16], text
+
+    def _lookup(self, namespace: str, text: str):
+        vector = self.embedder.embed(text)
+        score, entry = self.index.search(namespace, vector, time.time() - self.ttl)
+        return vector, score, entry
+
+    async def lookup(self, kind: str, model_config: Dict[str, Any], params: Dict[str, Any],
+                     key: Tuple[str, str]) -> Optional[Dict[str, Any]]:
+        """查找相似提示词的缓存答案，key 由 key_of 得到"""
+        context, text = key
+        loop = asyncio.get_running_loop()
+        namespace = self.namespace(kind, model_config, params, context)
+        _, score, entry = await loop.run_in_executor(None, self._lookup, namespace, text)
+        if (entry is not None and score >= self.threshold
+                and near_duplicate(text[:500], entry["prompt"], self.min_overlap)):
+            self.hits += 1
+            return {"text": entry["answer"], "similarity": round(score, 4)}
+        self.misses += 1
+        return None
+
+    def _add(self, namespace: str, text: str, answer: str) -> None:
+        self.index.add(namespace, self.embedder.embed(text), text, answer)
+
+    async def add(self, kind: str, model_config: Dict[str, Any], params: Dict[str, Any],
+                  key: Tuple[str, str], answer: str) -> None:
+        if not answer:
+            return
+        context, text = key
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self._add, self.namespace(kind, model_config, params, context), text, answer)
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            "entries": self.index.size if self.index else 0,
+            "threshold": self.threshold
+        }
+
+    def close(self) -> None:
+        if self.index is not None:
+            self.index.flush()
+
+
+# 全局语义缓存
+semantic_cache = SemanticCache()
@@ -0,0 +1,270 @@
+"""多进程共享状态
+
+settings.server.workers 大于1时启动多个worker进程，限流额度、响应缓存和会话需要在进程间共享。
+共享方式由 settings.shared_state.backend 决定：
+  local  各进程各自维护；多个worker时每个worker的限流额度为配置值的 1/workers
+  shm    同一台机器上的worker通过 /dev/shm 共享：限流令牌桶放在mmap共享内存中，
+         用文件锁保证原子性（每次几微秒，不阻塞事件循环）；响应缓存二级存储和会话使用同目录下的SQLite
+  redis  多台机器共享：响应缓存二级存储和会话使用Redis；worker定期在Redis中登记心跳，
+         限流额度按在线worker数均分
+用量统计写入 data/usage.db，同一台机器上的worker共用该文件。
+"""
+import asyncio
+import hashlib
+import logging
+import mmap
+import os
+import socket
+import struct
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, List, Optional
+
+from .conversations import SQLiteSessions
+from .response_cache import RedisCache, aioredis
+
+logger = logging.getLogger(__name__)
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+
+def default_dir() -> str:
+    if os.path.isdir("/dev/shm"):
+        return os.path.join("/dev/shm", "llm-meta")
+    return os.path.join("data", "shared")
+
+
+@contextmanager
+def file_lock(path: str):
+    """跨进程互斥（不支持文件锁的平台上不加锁）"""
+    if fcntl is None:
+        yield
+        return
+    with open(path, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class ShmBuckets:
+    """放在共享内存文件中的令牌桶表，每个桶一个32字节的槽位：(键哈希, 令牌数, 更新时间, 容量)"""
+
+    SLOT = struct.Struct("<Qddd")
+
+    def __init__(self, path: str, slots: int = 4096):
+        self.path = path
+        self.slots = slots
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        size = slots * self.SLOT.size
+        if os.fstat(self._fd).st_size < size:
+            os.ftruncate(self._fd, size)
+        self._mem = mmap.mmap(self._fd, size)
+        self._offsets: Dict[str, int] = {}
+
+    @contextmanager
+    def _locked(self):
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def _offset(self, key: str) -> int:
+        """键对应的槽位（开放寻址），调用方需持有锁"""
+        offset = self._offsets.get(key)
+        if offset is not None:
+            return offset
+        digest = int.from_bytes(hashlib.sha1(key.encode("utf-8")).digest()[:8], "little") | 1
+        index = digest % self.slots
+        for _ in range(self.slots):
+            offset = index * self.SLOT.size
+            slot_hash = self.SLOT.unpack_from(self._mem, offset)[0]
+            if slot_hash == digest:
+                break
+            if slot_hash == 0:
+                self.SLOT.pack_into(self._mem, offset, digest, -1.0, 0.0, 0.0)
+                break
+            index = (index + 1) % self.slots
+        else:
+            raise RuntimeError("共享令牌桶槽位已满")
+        self._offsets[key] = offset
+        return offset
+
+    def try_take(self, key: str, capacity: float, rate: float, amount: float) -> float:
+        """尝试取出amount个令牌，成功返回0，否则返回需要等待的秒数"""
+        with self._locked():
+            offset = self._offset(key)
+            digest, tokens, updated, _ = self.SLOT.unpack_from(self._mem, offset)
+            now = time.monotonic()
+            if tokens < 0:
+                tokens = capacity  # 新建的桶
+            else:
+                tokens = min(capacity, tokens + max(0.0, now - updated) * rate)
+            wait = 0.0
+            if tokens >= amount:
+                tokens -= amount
+            else:
+                wait = (amount - tokens) / rate
+            self.SLOT.pack_into(self._mem, offset, digest, tokens, now, capacity)
+            return wait
+
+    def refund(self, key: str, capacity: float, amount: float) -> None:
+        with self._locked():
+            offset = self._offset(key)
+            digest, tokens, updated, _ = self.SLOT.unpack_from(self._mem, offset)
+            self.SLOT.pack_into(self._mem, offset, digest, min(capacity, tokens + amount), updated, capacity)
+
+    def close(self) -> None:
+        self._mem.close()
+        os.close(self._fd)
+
+
+class SharedTokenBucket:
+    """与 ratelimit.TokenBucket 接口相同，令牌存放在共享内存中"""
+
+    def __init__(self, store: ShmBuckets, key: str, per_minute: float):
+        self.store = store
+        self.key = key
+        self.capacity = per_minute
+        self.rate = per_minute / 60.0
+
+    def try_take(self, amount: float) -> float:
+        return self.store.try_take(self.key, self.capacity, self.rate, amount)
+
+    def refund(self, amount: float) -> None:
+        self.store.refund(self.key, self.capacity, amount)
+
+
+class SharedState:
+    def __init__(self):
+        self.backend = "local"
+        # 由主进程在启动worker前设置
+        self.workers = int(os.getenv("LLM_WORKERS", "1"))
+        self.dir = default_dir()
+        self.share = 1.0
+        self.buckets: Optional[ShmBuckets] = None
+        self.redis = None
+        self.redis_settings: Dict[str, Any] = {}
+        self.heartbeat_interval = 5.0
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        self._kv: Dict[str, Any] = {}
+        self._leases: Dict[str, Any] = {}
+        self._listeners: List[Callable[[float], None]] = []
+        self._task: Optional["asyncio.Task"] = None
+
+    def configure(self, settings: Optional[Dict[str, Any]]) -> None:
+        """根据 settings.shared_state 初始化"""
+        settings = settings or {}
+        self.backend = settings.get("backend", "local")
+        self.dir = settings.get("dir") or default_dir()
+        self.heartbeat_interval = settings.get("heartbeat_interval", 5.0)
+        self.redis_settings = dict(settings.get("redis") or {})
+        os.makedirs(self.dir, exist_ok=True)
+        if self.backend == "shm" and fcntl is None:
+            logger.warning("当前平台不支持文件锁，共享状态改为local")
+            self.backend = "local"
+        if self.backend == "redis" and aioredis is None:
+            logger.warning("未安装redis，共享状态改为local")
+            self.backend = "local"
+        if self.backend == "shm":
+            self.buckets = ShmBuckets(os.path.join(self.dir, "buckets"), settings.get("bucket_slots", 4096))
+        elif self.backend == "redis":
+            self.redis = RedisCache(dict({"prefix": "llm:"}, **self.redis_settings)).redis
+        # 本worker在全部worker中的份额：进程内令牌桶和并发上限按它缩放（shm的令牌桶是共享的，不缩放）；
+        # redis时先按本机启动的worker数估计，收到心跳后按在线worker数调整
+        self.share = 1.0 / max(1, self.workers)
+
+    @property
+    def multi_worker(self) -> bool:
+        return self.workers > 1 or self.backend == "redis"
+
+    def kv(self, name: str) -> Optional[Any]:
+        """进程间共享的键值存储（RedisCache接口），local时返回None"""
+        store = self._kv.get(name)
+        if store is not None:
+            return store
+        if self.backend == "shm":
+            store = SQLiteSessions({"path": os.path.join(self.dir, "state.db"), "table": name})
+        elif self.backend == "redis":
+            store = RedisCache(dict(self.redis_settings, prefix=f"{self.redis_settings.get('prefix', 'llm:')}{name}:"))
+        if store is not None:
+            self._kv[name] = store
+        return store
+
+    def lead(self, name: str) -> bool:
+        """争取本机上名为name的唯一执行权（如续跑批量任务），进程退出后自动释放"""
+        if fcntl is None or not self.multi_worker:
+            return True
+        if name in self._leases:
+            return True
+        f = open(os.path.join(self.dir, f"{name}.lock"), "a")
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            f.close()
+            return False
+        self._leases[name] = f
+        return True
+
+    def on_share_change(self, listener: Callable[[float], None]) -> None:
+        self._listeners.append(listener)
+
+    def start(self) -> None:
+        if self.backend == "redis":
+            self._task = asyncio.ensure_future(self._heartbeat())
+
+    async def _heartbeat(self) -> None:
+        key = f"{self.redis_settings.get('prefix', 'llm:')}workers"
+        while True:
+            try:
+                now = time.time()
+                pipe = self.redis.pipeline()
+                pipe.zadd(key, {self.worker_id: now})
+                pipe.zremrangebyscore(key, "-inf", now - 3 * self.heartbeat_interval)
+                pipe.zcard(key)
+                workers = (await pipe.execute())[-1]
+                share = 1.0 / max(1, workers)
+                if share != self.share:
+                    logger.info(f"在线worker数: {workers}，限流额度按 1/{workers} 分配")
+                    self.share = share
+                    for listener in self._listeners:
+                        listener(share)
+            except Exception as e:
+                logger.error(f"共享状态心跳失败: {str(e)}")
+            await asyncio.sleep(self.heartbeat_interval)
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+            try:
+                await self.redis.zrem(f"{self.redis_settings.get('prefix', 'llm:')}workers", self.worker_id)
+            except Exception:
+                pass
+        for store in self._kv.values():
+            await store.close()
+        self._kv = {}
+        if self.redis is not None:
+            await self.redis.close()
+            self.redis = None
+        if self.buckets is not None:
+            self.buckets.close()
+            self.buckets = None
+        for f in self._leases.values():
+            f.close()
+        self._leases = {}
+
+    def status(self) -> Dict[str, Any]:
+        return {"backend": self.backend, "workers": self.workers, "share": round(self.share, 4),
+                "worker_id": self.worker_id, "leases": sorted(self._leases)}
+
+
+# 全局共享状态
+shared_state = SharedState()
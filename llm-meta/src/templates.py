@@ -0,0 +1,72 @@
+"""提示词模板
+
+prompt_templates 中的 {{变量}} 占位符在配置加载时预编译为片段列表，渲染时只做拼接。
+同一模板的批量请求通常只有最后一个变量（如 input）不同，
+因此最后一个占位符之前的部分按变量取值缓存，重复渲染时直接复用。
+"""
+import re
+from collections import OrderedDict
+from typing import Any, Dict, List, Mapping, Tuple
+
+_PLACEHOLDER = re.compile(r"\{\{\s*(\w+)\s*\}\}")
+
+
+class TemplateError(ValueError):
+    """模板不存在或缺少变量"""
+
+
+class CompiledTemplate:
+    def __init__(self, template_id: str, content: str, title: str = "", prefix_cache_size: int = 256):
+        self.id = template_id
+        self.title = title
+        self.content = content
+        # split后偶数位置为文本，奇数位置为变量名
+        parts = _PLACEHOLDER.split(content)
+        self.variables: Tuple[str, ...] = tuple(dict.fromkeys(parts[1::2]))
+        if len(parts) == 1:
+            self._prefix_parts: List[str] = []
+            self._last = None
+            self._suffix = content
+        else:
+            self._prefix_parts = parts[:-2]
+            self._last = parts[-2]
+            self._suffix = parts[-1]
+        self._prefix_names = tuple(parts[1:-2:2])
+        self._prefix_cache: "OrderedDict[Tuple[str, ...], str]" = OrderedDict()
+        self._prefix_cache_size = prefix_cache_size
+
+    def _prefix(self, variables: Mapping[str, Any]) -> str:
+        key = tuple(str(variables[name]) for name in self._prefix_names)
+        prefix = self._prefix_cache.get(key)
+        if prefix is not None:
+            self._prefix_cache.move_to_end(key)
+            return prefix
+        prefix = "".join(
+            part if index % 2 == 0 else str(variables[part])
+            for index, part in enumerate(self._prefix_parts)
+        )
+        self._prefix_cache[key] = prefix
+        if len(self._prefix_cache) > self._prefix_cache_size:
+            self._prefix_cache.popitem(last=False)
+        return prefix
+
+    def render(self, variables: Mapping[str, Any]) -> str:
+        missing = [name for name in self.variables if name not in variables]
+        if missing:
+            raise TemplateError(f"模板 {self.id} 缺少变量: {', '.join(missing)}")
+        if self._last is None:
+            return self._suffix
+        return self._prefix(variables) + str(variables[self._last]) + self._suffix
+
+
+def compile_templates(templates: List[Dict[str, Any]]) -> Dict[str, CompiledTemplate]:
+    """编译配置中的 prompt_templates，模板ID重复或缺少内容时报错"""
+    compiled: Dict[str, CompiledTemplate] = {}
+    for template in templates:
+        template_id = template.get("id")
+        if not template_id or not isinstance(template.get("content"), str):
+            raise ValueError(f"提示词模板缺少id或content: {template}")
+        if template_id in compiled:
+            raise ValueError(f"提示词模板ID重复: {template_id}")
+        compiled[template_id] = CompiledTemplate(template_id, template["content"], template.get("title", ""))
+    return compiled
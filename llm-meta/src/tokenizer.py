@@ -0,0 +1,168 @@
+"""本地token计数
+
+安装了 tiktoken 时使用其BPE编码计数，否则按字符估算
+（中日韩字符按1个token，其他字符按4个字符1个token）。
+计数结果按文本的哈希缓存，系统提示词、模板等重复出现的文本只计算一次。
+
+发送请求前用 preflight 检查提示词加 max_tokens 是否超出模型的 context_window：
+超出时按 settings.tokenizer.overflow 拒绝请求，或截断最旧的消息并缩小 max_tokens。
+"""
+import hashlib
+import logging
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# 每条消息的角色和分隔符开销
+MESSAGE_OVERHEAD = 4
+
+
+class ContextOverflow(ValueError):
+    """提示词超出模型的上下文长度"""
+
+
+def estimate_text_tokens(text: str) -> int:
+    """粗略估算文本的token数：中日韩字符按1个token，其他字符按4个字符1个token"""
+    wide = sum(1 for ch in text if ord(ch) > 0x2E80)
+    return wide + (len(text) - wide) // 4
+
+
+def _truncate_estimated(text: str, max_tokens: int) -> str:
+    """按估算规则保留不超过max_tokens的前缀"""
+    wide = narrow = 0
+    for index, ch in enumerate(text):
+        if ord(ch) > 0x2E80:
+            wide += 1
+        else:
+            narrow += 1
+        if wide + narrow // 4 > max_tokens:
+            return text[:index]
+    return text
+
+
+class Tokenizer:
+    def __init__(self):
+        self.encoding = None
+        self.overflow = "truncate"
+        self.min_completion_tokens = 256
+        # 键为文本的哈希而不是文本本身，内存占用只与条目数有关，与提示词长度无关
+        self.cache_size = 4096
+        self._cache: "OrderedDict[bytes, int]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def configure(self, settings: Optional[Dict[str, Any]]) -> None:
+        """根据 settings.tokenizer 加载编码，失败时使用估算"""
+        settings = settings or {}
+        self.encoding = None
+        self.overflow = settings.get("overflow", "truncate")
+        self.min_completion_tokens = settings.get("min_completion_tokens", 256)
+        self.cache_size = settings.get("cache_size", 4096)
+        self._cache.clear()
+        if tiktoken is None or settings.get("encoding") == "estimate":
+            return
+        try:
+            self.encoding = tiktoken.get_encoding(settings.get("encoding", "cl100k_base"))
+        except Exception as e:
+            # 编码文件需要首次下载，离线环境下退回估算
+            logger.warning(f"tiktoken 编码加载失败，改用估算: {str(e)}")
+
+    @property
+    def name(self) -> str:
+        return self.encoding.name if self.encoding is not None else "estimate"
+
+    def _count_uncached(self, text: str) -> int:
+        if self.encoding is not None:
+            return len(self.encoding.encode(text, disallowed_special=()))
+        return estimate_text_tokens(text)
+
+    def count(self, text: str) -> int:
+        key = hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+        tokens = self._cache.get(key)
+        if tokens is not None:
+            self._cache.move_to_end(key)
+            self.hits += 1
+            return tokens
+        self.misses += 1
+        tokens = self._count_uncached(text)
+        self._cache[key] = tokens
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return tokens
+
+    def count_many(self, texts: List[str]) -> List[int]:
+        """批量计数；文本较多时用 tiktoken 的多线程批量编码"""
+        if self.encoding is None or len(texts) < 16:
+            return [self.count(text) for text in texts]
+        return [len(tokens) for tokens in self.encoding.encode_batch(texts, disallowed_special=())]
+
+    def count_messages(self, messages: List[Dict[str, str]]) -> int:
+        return sum(self.count(message["content"]) + MESSAGE_OVERHEAD for message in messages)
+
+    def truncate(self, text: str, max_tokens: int) -> str:
+        """保留文本开头不超过max_tokens的部分"""
+        if max_tokens <= 0:
+            return ""
+        if self.encoding is not None:
+            tokens = self.encoding.encode(text, disallowed_special=())
+            return text if len(tokens) <= max_tokens else self.encoding.decode(tokens[:max_tokens])
+        return _truncate_estimated(text, max_tokens)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"encoding": self.name, "cache_hits": self.hits, "cache_misses": self.misses, "cached": len(self._cache)}
+
+    def preflight(self, model_config: Dict[str, Any], messages: List[Dict[str, str]],
+                  params: Dict[str, Any]) -> Tuple[List[Dict[str, str]], Dict[str, Any], bool]:
+        """检查请求是否超出模型的 context_window，返回(可能截断后的消息, 可能调整后的参数, 消息是否被截断)"""
+        window = model_config.get("context_window")
+        if not window:
+            return messages, params, False
+        max_tokens = params.get("max_tokens", 1000)
+        prompt_tokens = self.count_messages(messages)
+        if prompt_tokens + max_tokens <= window:
+            return messages, params, False
+
+        available = window - self.min_completion_tokens
+        truncated = prompt_tokens > available
+        if truncated:
+            if self.overflow != "truncate":
+                raise ContextOverflow(
+                    f"提示词约 {prompt_tokens} tokens，超出模型上下文长度 {window}（需为输出保留 {self.min_completion_tokens}）"
+                )
+            original_tokens, original_count = prompt_tokens, len(messages)
+            messages, prompt_tokens = self._truncate_messages(messages, available)
+            logger.warning(
+                f"{model_config['name']} 提示词约 {original_tokens} tokens，超出上下文长度 {window}，"
+                f"已丢弃 {original_count - len(messages)} 条消息并截断为 {prompt_tokens} tokens"
+            )
+        # 输出长度缩小到剩余空间
+        return messages, dict(params, max_tokens=min(max_tokens, window - prompt_tokens)), truncated
+
+    def _truncate_messages(self, messages: List[Dict[str, str]], budget: int) -> Tuple[List[Dict[str, str]], int]:
+        """先丢弃最旧的非system消息，仍超出时截断最后一条消息的内容"""
+        messages = list(messages)
+        total = self.count_messages(messages)
+        index = 0
+        while total > budget and index < len(messages) - 1:
+            if messages[index]["role"] == "system":
+                index += 1
+                continue
+            total -= self.count(messages.pop(index)["content"]) + MESSAGE_OVERHEAD
+        if total > budget:
+            last = messages[-1]
+            room = budget - (total - self.count(last["content"]))
+            if room <= 0:
+                raise ContextOverflow("system消息已超出模型上下文长度")
+            messages[-1] = dict(last, content=self.truncate(last["content"], room))
+            total = self.count_messages(messages)
+        return messages, total
+
+
+# 全局分词器
+tokenizer = Tokenizer()
@@ -0,0 +1,213 @@
+"""用量统计
+
+每次调用的模型、状态、是否命中缓存、token数和耗时先放入内存，由后台线程批量写入SQLite：
+  usage_events  明细，保留 raw_retention_days 天
+  usage_minute  按（分钟, 模型）预聚合的计数，查询按小时/天汇总时只需扫描该表
+"""
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+INTERVALS = {"minute": 1, "hour": 60, "day": 1440}
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS usage_events (
+    ts REAL NOT NULL,
+    model TEXT NOT NULL,
+    status TEXT NOT NULL,
+    cache_hit INTEGER NOT NULL,
+    prompt_tokens INTEGER NOT NULL,
+    completion_tokens INTEGER NOT NULL,
+    latency_ms REAL
+);
+CREATE INDEX IF NOT EXISTS idx_usage_events_ts ON usage_events (ts);
+CREATE TABLE IF NOT EXISTS usage_minute (
+    minute INTEGER NOT NULL,
+    model TEXT NOT NULL,
+    requests INTEGER NOT NULL,
+    errors INTEGER NOT NULL,
+    cancelled INTEGER NOT NULL,
+    cache_hits INTEGER NOT NULL,
+    prompt_tokens INTEGER NOT NULL,
+    completion_tokens INTEGER NOT NULL,
+    latency_ms_sum REAL NOT NULL,
+    latency_ms_max REAL NOT NULL,
+    PRIMARY KEY (minute, model)
+) WITHOUT ROWID;
+"""
+
+_UPSERT_MINUTE = """
+INSERT INTO usage_minute VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (minute, model) DO UPDATE SET
+    requests = requests + excluded.requests,
+    errors = errors + excluded.errors,
+    cancelled = cancelled + excluded.cancelled,
+    cache_hits = cache_hits + excluded.cache_hits,
+    prompt_tokens = prompt_tokens + excluded.prompt_tokens,
+    completion_tokens = completion_tokens + excluded.completion_tokens,
+    latency_ms_sum = latency_ms_sum + excluded.latency_ms_sum,
+    latency_ms_max = MAX(latency_ms_max, excluded.latency_ms_max)
+"""
+
+# (ts, model, status, cache_hit, prompt_tokens, completion_tokens, latency_ms)
+Event = Tuple[float, str, str, int, int, int, Optional[float]]
+
+
+class UsageStore:
+    def __init__(self):
+        self.enabled = False
+        self.path = os.path.join("data", "usage.db")
+        self.flush_interval = 2.0
+        self.raw_retention_days = 7
+        self.dropped = 0
+        self._buffer: Deque[Event] = deque(maxlen=100000)
+        self._cond = threading.Condition()
+        self._closing = False
+        self._thread: Optional[threading.Thread] = None
+        self._last_prune = 0.0
+
+    def configure(self, settings: Optional[Dict[str, Any]]) -> None:
+        """根据 settings.usage 初始化并启动后台写入线程"""
+        settings = settings or {}
+        self.enabled = settings.get("enabled", True)
+        if not self.enabled:
+            return
+        self.path = settings.get("path", os.path.join("data", "usage.db"))
+        self.flush_interval = settings.get("flush_interval", 2.0)
+        self.raw_retention_days = settings.get("raw_retention_days", 7)
+        self._buffer = deque(maxlen=settings.get("buffer_size", 100000))
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with self._connect() as conn:
+            conn.executescript(_SCHEMA)
+        self._closing = False
+        self._thread = threading.Thread(target=self._run, name="usage-store", daemon=True)
+        self._thread.start()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=10)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def record(self, model: str, status: str, cache_hit: bool, prompt_tokens: int,
+               completion_tokens: int, latency_ms: Optional[float]) -> None:
+        """记录一次调用，不做任何I/O"""
+        if not self.enabled:
+            return
+        if len(self._buffer) == self._buffer.maxlen:
+            self.dropped += 1
+        self._buffer.append((time.time(), model, status, int(cache_hit),
+                             prompt_tokens or 0, completion_tokens or 0, latency_ms))
+
+    def _drain(self) -> List[Event]:
+        events = []
+        while True:
+            try:
+                events.append(self._buffer.popleft())
+            except IndexError:
+                return events
+
+    def _run(self) -> None:
+        conn = self._connect()
+        try:
+            while True:
+                with self._cond:
+                    if not self._closing:
+                        self._cond.wait(self.flush_interval)
+                    closing = self._closing
+                events = self._drain()
+                try:
+                    if events:
+                        self._write(conn, events)
+                    self._prune(conn)
+                except Exception as e:
+                    logger.error(f"写入用量统计失败: {str(e)}")
+                if closing:
+                    return
+        finally:
+            conn.close()
+
+    @staticmethod
+    def _rollup(events: List[Event]) -> List[tuple]:
+        """在内存中先按（分钟, 模型）聚合，减少写入的行数"""
+        rows: Dict[Tuple[int, str], list] = {}
+        for ts, model, status, cache_hit, prompt_tokens, completion_tokens, latency_ms in events:
+            row = rows.setdefault((int(ts // 60), model), [0, 0, 0, 0, 0, 0, 0.0, 0.0])
+            row[0] += 1
+            row[1] += status == "error"
+            row[2] += status == "cancelled"
+            row[3] += cache_hit
+            row[4] += prompt_tokens
+            row[5] += completion_tokens
+            row[6] += latency_ms or 0.0
+            row[7] = max(row[7], latency_ms or 0.0)
+        return [(minute, model, *row) for (minute, model), row in rows.items()]
+
+    def _write(self, conn: sqlite3.Connection, events: List[Event]) -> None:
+        with conn:
+            conn.executemany("INSERT INTO usage_events VALUES (?, ?, ?, ?, ?, ?, ?)", events)
+            conn.executemany(_UPSERT_MINUTE, self._rollup(events))
+
+    def _prune(self, conn: sqlite3.Connection) -> None:
+        """每小时清理一次过期明细，分钟汇总长期保留"""
+        now = time.time()
+        if now - self._last_prune < 3600:
+            return
+        self._last_prune = now
+        with conn:
+            conn.execute("DELETE FROM usage_events WHERE ts < ?", (now - self.raw_retention_days * 86400,))
+
+    def query(self, start: float, end: float, interval: str = "hour",
+              model: Optional[str] = None) -> List[Dict[str, Any]]:
+        """按时间段和模型汇总，interval 为 minute/hour/day（按UTC划分）"""
+        if not self.enabled:
+            return []
+        step = INTERVALS[interval]
+        sql = (
+            "SELECT (minute / ?) * ? AS bucket, model, SUM(requests), SUM(errors), SUM(cancelled), "
+            "SUM(cache_hits), SUM(prompt_tokens), SUM(completion_tokens), SUM(latency_ms_sum), "
+            "MAX(latency_ms_max) FROM usage_minute WHERE minute >= ? AND minute < ?"
+        )
+        args: list = [step, step, int(start // 60), int(end // 60) + 1]
+        if model:
+            sql += " AND model = ?"
+            args.append(model)
+        sql += " GROUP BY bucket, model ORDER BY bucket, model"
+        conn = self._connect()
+        try:
+            rows = conn.execute(sql, args).fetchall()
+        finally:
+            conn.close()
+        return [{
+            "time": bucket * 60,
+            "model": model_name,
+            "requests": requests,
+            "errors": errors,
+            "cancelled": cancelled,
+            "cache_hits": cache_hits,
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "avg_latency_ms": round(latency_sum / requests, 1) if requests else 0.0,
+            "max_latency_ms": round(latency_max, 1)
+        } for bucket, model_name, requests, errors, cancelled, cache_hits,
+            prompt_tokens, completion_tokens, latency_sum, latency_max in rows]
+
+    def close(self) -> None:
+        """写出内存中剩余的记录"""
+        if self._thread is None:
+            return
+        with self._cond:
+            self._closing = True
+            self._cond.notify()
+        self._thread.join()
+        self._thread = None
+
+
+# 全局用量统计
+usage_store = UsageStore()
@@ -5,81 +5,130 @@ import os
 import yaml
 import requests
 import sys
+import json
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_KEYS = ["your_openai_api_key_here", "your_deepseek_api_key_here", "sk-xxxxxxxxxxxxxxxxxxxxxxxx"]
+
+def expand_backends(model_config):
+    """展开模型的后端列表，后端未配置的字段继承模型配置（与服务的路由规则一致）"""
+    base = {k: v for k, v in model_config.items() if k != "backends"}
+    backends = model_config.get("backends") or [{}]
+    expanded = []
+    for backend in backends:
+        backend = {**base, **backend}
+        backend["api_key"] = os.path.expandvars(backend.get("api_key", ""))
+        expanded.append(backend)
+    return expanded
+
+def test_api_key(model_id, backend, timeout):
+    """测试单个后端的API密钥，返回(是否成功, 总耗时ms, 首个token耗时ms, 错误信息)"""
+    api_key = backend.get("api_key", "")
+    if not api_key or api_key in DEFAULT_KEYS or api_key.startswith("${"):
+        return False, None, None, "API密钥未设置或仍为默认值"
 
-def test_api_key(model_config):
-    """测试API密钥是否有效"""
-    print(f"正在测试 {model_config['name']} 的API密钥...")
-    
     headers = {
-        "Authorization": f"Bearer {model_config['api_key']}",
+        "Authorization": f"Bearer {api_key}",
         "Content-Type": "application/json"
     }
-    
+
     data = {
-        "model": model_config["model_name"],
+        "model": backend["model_name"],
         "messages": [{"role": "user", "content": "Hello"}],
-        "max_tokens": 10
+        "max_tokens": 10,
+        "stream": True
     }
-    
-    url = f"{model_config['base_url']}/chat/completions"
-    
+
+    url = f"{backend['base_url'].rstrip('/')}/chat/completions"
+
+    start = time.perf_counter()
     try:
-        response = requests.post(url, headers=headers, json=data, timeout=10)
-        
-        if response.status_code == 200:
-            print(f"✅ {model_config['name']} API密钥验证成功！")
-            return True
-        else:
-            print(f"❌ {model_config['name']} API密钥验证失败: {response.status_code}")
-            print(f"错误信息: {response.text}")
-            return False
+        with requests.post(url, headers=headers, json=data, timeout=timeout, stream=True) as response:
+            if response.status_code != 200:
+                return False, None, None, f"{response.status_code} {response.text[:200]}"
+
+            # 以第一段返回内容的时间作为首个token延迟
+            ttft = None
+            for line in response.iter_lines(decode_unicode=True):
+                if ttft is None and line and line.startswith("data:") and line[5:].strip() != "[DONE]":
+                    ttft = (time.perf_counter() - start) * 1000
+            return True, (time.perf_counter() - start) * 1000, ttft, None
     except Exception as e:
-        print(f"❌ {model_config['name']} API请求出错: {str(e)}")
-        return False
+        return False, None, None, str(e)
 
 def main():
+    parser = argparse.ArgumentParser(description="大模型API密钥测试工具")
+    parser.add_argument("--timeout", type=float, default=10, help="单个请求的超时时间（秒）")
+    parser.add_argument("--workers", type=int, default=16, help="同时测试的后端数")
+    parser.add_argument("--json", action="store_true", help="以JSON输出结果")
+    args = parser.parse_args()
+
     # 加载配置文件
-    config_path = os.path.join("config", "config.yaml")
-    
+    config_path = os.getenv("LLM_CONFIG_PATH", os.path.join("config", "config.yaml"))
+
     if not os.path.exists(config_path):
         print(f"错误: 配置文件不存在 {config_path}")
         sys.exit(1)
-    
+
     with open(config_path, "r", encoding="utf-8") as f:
         config = yaml.safe_load(f)
-    
+
     if not config or "models" not in config:
         print("错误: 配置文件格式不正确，未找到models部分")
         sys.exit(1)
-    
-    print("=" * 50)
-    print("大模型API密钥测试工具")
-    print("=" * 50)
-    
-    # 检测API密钥是否是默认值
-    default_keys = ["your_openai_api_key_here", "your_deepseek_api_key_here", "sk-xxxxxxxxxxxxxxxxxxxxxxxx"]
-    success_count = 0
-    total_count = 0
-    
-    for model_id, model_config in config["models"].items():
-        total_count += 1
-        api_key = model_config.get("api_key", "")
-        
-        if api_key in default_keys or not api_key:
-            print(f"❌ {model_config['name']} API密钥未设置或仍为默认值")
-            continue
-        
-        if test_api_key(model_config):
-            success_count += 1
-    
-    print("\n" + "=" * 50)
-    print(f"测试结果: {success_count}/{total_count} 个模型API密钥配置正确")
-    
-    if success_count == 0:
-        print("❌ 没有任何模型配置正确的API密钥，请先设置API密钥后再启动服务")
-        sys.exit(1)
+
+    if not args.json:
+        print("=" * 50)
+        print("大模型API密钥测试工具")
+        print("=" * 50)
+
+    # 所有模型的所有后端并行测试，总耗时约等于最慢的一个
+    checks = [
+        (model_id, backend)
+        for model_id, model_config in config["models"].items()
+        for backend in expand_backends(model_config)
+    ]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(1, min(args.workers, len(checks)))) as executor:
+        futures = [executor.submit(test_api_key, model_id, backend, args.timeout) for model_id, backend in checks]
+        results = [future.result() for future in futures]
+    elapsed = time.perf_counter() - start
+
+    healthy = set()
+    report = []
+    for (model_id, backend), (ok, latency, ttft, error) in zip(checks, results):
+        if ok:
+            healthy.add(model_id)
+        report.append({
+            "model": model_id,
+            "backend": backend.get("name", model_id),
+            "ok": ok,
+            "latency_ms": round(latency, 1) if latency is not None else None,
+            "ttft_ms": round(ttft, 1) if ttft is not None else None,
+            "error": error
+        })
+
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
     else:
+        for item in report:
+            if item["ok"]:
+                print(f"✅ {item['model']} / {item['backend']} API密钥验证成功！"
+                      f" 耗时 {item['latency_ms']}ms，首个token {item['ttft_ms']}ms")
+            else:
+                print(f"❌ {item['model']} / {item['backend']} 验证失败: {item['error']}")
+
+        print("\n" + "=" * 50)
+        print(f"测试结果: {len(healthy)}/{len(config['models'])} 个模型API密钥配置正确（耗时 {elapsed:.1f}s）")
+
+    if not healthy:
+        if not args.json:
+            print("❌ 没有任何模型配置正确的API密钥，请先设置API密钥后再启动服务")
+        sys.exit(1)
+    elif not args.json:
         print("✅ 有可用的API密钥，可以启动服务")
 
 if __name__ == "__main__":
-    main() 
\ No newline at end of file
+    main()
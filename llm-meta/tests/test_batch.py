@@ -0,0 +1,67 @@
+"""JSONL批量任务"""
+import asyncio
+import json
+
+import pytest
+
+from src.batch import BatchRunner
+
+
+async def process(model_id, item):
+    if "prompt" not in item:
+        raise ValueError("缺少prompt")
+    return item["prompt"].upper()
+
+
+def make_runner(tmp_path):
+    runner = BatchRunner()
+    runner.configure({"jobs_dir": str(tmp_path), "max_concurrency": 2}, {}, process)
+    return runner
+
+
+def run_job(runner, content):
+    async def main():
+        job = runner.create_job("default", content)
+        await runner._tasks[job["job_id"]]
+        with open(runner.output_path(job["job_id"]), "r", encoding="utf-8") as f:
+            return job, [json.loads(line) for line in f]
+
+    return asyncio.run(main())
+
+
+def test_invalid_lines_become_item_errors(tmp_path):
+    runner = make_runner(tmp_path)
+    lines = ['[1]', '"x"', '{"id": [1], "prompt": "a"}', '{"id": {"k": 1}, "prompt": "b"}',
+             '{"id": "last", "prompt": "c"}']
+    job, results = run_job(runner, "\n".join(lines).encode("utf-8"))
+    assert job["state"] == "completed"
+    assert job["succeeded"] == 1 and job["failed"] == 4
+    statuses = {result["id"]: result["status"] for result in results}
+    assert statuses == {0: "error", 1: "error", 2: "error", 3: "error", "last": "ok"}
+
+
+def test_reader_failure_marks_job_failed(tmp_path):
+    runner = make_runner(tmp_path)
+
+    def broken_items(job_id, done_ids):
+        yield 0, {"id": "first", "prompt": "a"}
+        raise OSError("读取输入失败")
+
+    runner._pending_items = broken_items
+    job, _ = run_job(runner, b'{"id": "first", "prompt": "a"}\n')
+    assert job["state"] == "failed"
+    assert "读取输入失败" in job["error"]
+
+
+def test_run_reraises_item_source_errors(tmp_path):
+    runner = make_runner(tmp_path)
+
+    def items():
+        yield 0, {"prompt": "a"}
+        raise OSError("boom")
+
+    async def main():
+        return [result async for result in runner.run("default", items())]
+
+    with pytest.raises(OSError):
+        asyncio.run(main())
@@ -0,0 +1,104 @@
+"""相同请求合并：上游流中途失败时不应写入缓存"""
+import asyncio
+
+import pytest
+
+from src.coalesce import SingleFlight
+
+
+async def failing_stream():
+    yield "部分"
+    yield "内容"
+    raise RuntimeError("upstream reset")
+
+
+async def collect(chunks):
+    received = []
+    with pytest.raises(RuntimeError):
+        async for chunk in chunks:
+            received.append(chunk)
+    return received
+
+
+@pytest.mark.parametrize("enabled", [True, False])
+def test_failed_stream_is_not_stored(enabled):
+    stored = []
+
+    async def on_complete(text):
+        stored.append(text)
+
+    async def main():
+        flight = SingleFlight()
+        flight.enabled = enabled
+        first = flight.stream("k", failing_stream, on_complete)
+        second = flight.stream("k", failing_stream, on_complete)
+        results = await asyncio.gather(collect(first), collect(second))
+        # 让后台的 _pump 执行完
+        await asyncio.sleep(0)
+        return flight, results
+
+    flight, results = asyncio.run(main())
+    assert results == [["部分", "内容"], ["部分", "内容"]]
+    assert stored == []
+    assert flight._streams == {}
+
+
+def test_completed_stream_is_stored_once():
+    stored = []
+
+    async def ok_stream():
+        yield "a"
+        yield "b"
+
+    async def on_complete(text):
+        stored.append(text)
+
+    async def main():
+        flight = SingleFlight()
+        chunks = [c async for c in flight.stream("k", ok_stream, on_complete)]
+        await asyncio.sleep(0)
+        return chunks
+
+    assert asyncio.run(main()) == ["a", "b"]
+    assert stored == ["ab"]
+
+
+def test_join_after_last_subscriber_cancels_starts_new_stream():
+    calls = []
+
+    async def slow_stream():
+        calls.append(1)
+        yield "a"
+        await asyncio.sleep(10)
+        yield "b"
+
+    async def fast_stream():
+        calls.append(2)
+        yield "c"
+
+    async def main():
+        flight = SingleFlight()
+        first = flight.stream("k", slow_stream)
+        assert await first.__anext__() == "a"
+        await first.aclose()
+        # 最后一个订阅者离开后立即到达的相同请求，不应加入已取消的上游流
+        second = [c async for c in flight.stream("k", fast_stream)]
+        await asyncio.sleep(0)
+        return second, flight
+
+    second, flight = asyncio.run(main())
+    assert second == ["c"]
+    assert calls == [1, 2]
+    assert flight._streams == {}
+
+
+def test_call_after_last_waiter_cancels_starts_new_call():
+    async def main():
+        flight = SingleFlight()
+        first = asyncio.ensure_future(flight.do("k", lambda: asyncio.sleep(10, "old")))
+        await asyncio.sleep(0)
+        first.cancel()
+        await asyncio.sleep(0)
+        return await flight.do("k", lambda: asyncio.sleep(0, "new"))
+
+    assert asyncio.run(main()) == "new"
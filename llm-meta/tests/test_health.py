@@ -0,0 +1,38 @@
+"""健康探测不应影响真实请求的错误统计"""
+import asyncio
+
+from src import health
+from src.health import HealthProber
+from src.providers import ProviderError
+from src.router import router
+
+BACKEND = {"name": "probe-test", "provider": "openai", "base_url": "http://probe.test/v1",
+           "model_name": "m", "api_key": "probe-key"}
+
+
+def probe(monkeypatch, fail):
+    async def fake_stream(backend, data, label):
+        if fail:
+            raise ProviderError("unavailable", 503)
+        yield "x"
+
+    monkeypatch.setattr(health, "stream_chat_completion", fake_stream)
+
+    async def main():
+        prober = HealthProber()
+        prober.configure({"failure_cooldown": 60})
+        return await prober._probe(BACKEND)
+
+    return asyncio.run(main())
+
+
+def test_failed_probe_cools_down_without_request_errors(monkeypatch):
+    result = probe(monkeypatch, fail=True)
+    stats = router.stats_for(BACKEND)
+    assert not result["ok"] and result["status"] == 503
+    assert stats.snapshot()["cooling_down"]
+    assert stats.errors == 0 and stats.requests == 0 and stats.error_ewma == 0.0
+
+    result = probe(monkeypatch, fail=False)
+    assert result["ok"]
+    assert not stats.snapshot()["cooling_down"]
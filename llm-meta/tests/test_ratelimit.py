@@ -0,0 +1,40 @@
+"""按API密钥合并的限额和排队超时"""
+import asyncio
+
+from src.ratelimit import Limiter, RateLimitExceeded, RateLimits
+
+
+def test_key_limits_are_merged_once_per_key():
+    models = {
+        "a": {"name": "a", "api_key": "k", "key_rate_limit": {"rpm": 100, "max_concurrency": 5}},
+        "b": {"name": "b", "api_key": "k", "key_rate_limit": {"rpm": 50}},
+        "c": {"name": "c", "api_key": "k"},
+    }
+    limits = RateLimits()
+    limits.configure({}, models)
+    limiter = limits.key_limiter(models["a"])
+    assert limiter.settings == {"rpm": 50, "max_concurrency": 5}
+    # 限额不同或未配置的模型使用同一个限流器，不会重建
+    assert limits.key_limiter(models["b"]) is limiter
+    assert limits.key_limiter(models["c"]) is limiter
+
+
+def test_timeout_after_grant_releases_slot(monkeypatch):
+    limiter = Limiter("m", {"max_concurrency": 1}, max_queue=10, max_wait=1.0)
+
+    async def late_timeout(future, timeout):
+        # 超时与发放许可同时发生：许可已发给排队的请求，wait_for仍然抛出超时
+        future.cancel()
+        limiter.release()
+        raise asyncio.TimeoutError
+
+    async def main():
+        await limiter.acquire("x", 1)
+        monkeypatch.setattr(asyncio, "wait_for", late_timeout)
+        try:
+            await limiter.acquire("y", 1)
+        except RateLimitExceeded:
+            pass
+        return limiter.active
+
+    assert asyncio.run(main()) == 0
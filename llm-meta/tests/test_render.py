@@ -0,0 +1,42 @@
+"""流式增量渲染的拼接结果应与整篇渲染一致"""
+import re
+
+import markdown
+import pytest
+
+from src.render import DEFAULT_EXTENSIONS, MarkdownRenderer
+
+DOCUMENTS = {
+    "loose_list": "介绍\n\n- 第一项\n\n- 第二项\n\n  补充说明\n\n- 第三项\n\n结尾\n",
+    "ordered_list": "步骤：\n\n1. 安装\n\n2. 配置\n\n    ```\n    pip install x\n    ```\n\n3. 运行\n\n完成\n",
+    "blockquote": "> 第一段\n\n> 第二段\n\n正文\n",
+    "footnotes": "第一段[^1]\n\n第二段[^2]\n\n[^1]: 注释一\n\n[^2]: 注释二\n",
+    "reference_later": "参见[文档][docs]和[首页]\n\n中间段落\n\n[docs]: https://example.com/docs\n[首页]: https://example.com\n",
+    "reference_earlier": "[docs]: https://example.com/docs\n\n第一段\n\n再次参见[文档][docs]\n",
+    "code": "示例：\n\n```python\nx = [1]\n\ny = x[0]\n```\n\n结束\n",
+}
+
+
+def normalize(html):
+    return re.sub(r">\s+<", "><", html).strip()
+
+
+def render_stream(text, size):
+    renderer = MarkdownRenderer()
+    stream = renderer.stream()
+    parts = [stream.feed(text[i:i + size]) for i in range(0, len(text), size)]
+    parts.append(stream.finish())
+    return "".join(part for part in parts if part), sum(1 for part in parts if part)
+
+
+@pytest.mark.parametrize("name", sorted(DOCUMENTS))
+@pytest.mark.parametrize("size", [1, 7, 1000])
+def test_incremental_matches_full_render(name, size):
+    text = DOCUMENTS[name]
+    html, _ = render_stream(text, size)
+    assert normalize(html) == normalize(markdown.markdown(text, extensions=DEFAULT_EXTENSIONS))
+
+
+def test_plain_paragraphs_are_still_streamed():
+    _, blocks = render_stream("第一段\n\n第二段\n\n第三段\n", 3)
+    assert blocks == 3
@@ -0,0 +1,35 @@
+"""路由统计：对冲落败被取消的调用不计入延迟"""
+import asyncio
+
+from src.router import Router
+
+BACKEND = {"name": "b", "provider": "openai", "base_url": "http://b.test/v1", "model_name": "m"}
+
+
+def test_cancelled_attempt_does_not_record_latency():
+    router = Router()
+
+    async def slow(backend):
+        await asyncio.sleep(10)
+
+    async def main():
+        task = asyncio.ensure_future(router._attempt(BACKEND, slow))
+        await asyncio.sleep(0.01)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+    asyncio.run(main())
+    stats = router.stats_for(BACKEND)
+    assert stats.latency_ewma is None and not stats.latencies
+    assert stats.requests == 0
+
+
+def test_completed_attempt_records_latency():
+    router = Router()
+
+    async def fast(backend):
+        return "ok"
+
+    assert asyncio.run(router._attempt(BACKEND, fast)) == "ok"
+    stats = router.stats_for(BACKEND)
+    assert stats.latency_ewma is not None and len(stats.latencies) == 1
@@ -0,0 +1,57 @@
+"""语义缓存：只差地名或数字的问题不应命中彼此的答案"""
+import asyncio
+
+import pytest
+
+from src.semantic_cache import SemanticCache
+
+MODEL = {"name": "default", "provider": "openai", "model_name": "gpt", "semantic_cache": True}
+PARAMS = {"temperature": 0, "max_tokens": 100}
+
+
+@pytest.fixture
+def cache(tmp_path):
+    cache = SemanticCache()
+    cache.configure({"enabled": True, "path": str(tmp_path)})
+    yield cache
+    cache.close()
+
+
+def ask(cache, messages, template=None):
+    return asyncio.run(cache.lookup("chat", MODEL, PARAMS, cache.key_of(messages, *(template or ()))))
+
+
+def store(cache, messages, answer, template=None):
+    asyncio.run(cache.add("chat", MODEL, PARAMS, cache.key_of(messages, *(template or ())), answer))
+
+
+def user(text):
+    return [{"role": "system", "content": "你是一个乐于助人的助手，请简洁准确地回答用户的问题。"},
+            {"role": "user", "content": text}]
+
+
+@pytest.mark.parametrize("stored, asked", [
+    ("北京人口是多少", "上海人口是多少"),
+    ("2+2等于几", "2+3等于几"),
+])
+def test_near_miss_questions_do_not_hit(cache, stored, asked):
+    store(cache, user(stored), "answer")
+    assert ask(cache, user(asked)) is None
+
+
+def test_template_prefix_does_not_dominate(cache):
+    template = "请阅读以下很长的说明并据此回答问题。" * 20 + "{question}"
+    store(cache, [], "answer", (template, {"question": "北京人口是多少"}))
+    assert ask(cache, [], (template, {"question": "上海人口是多少"})) is None
+    assert ask(cache, [], (template, {"question": "北京人口是多少？"}))["text"] == "answer"
+
+
+def test_trivial_variation_hits(cache):
+    store(cache, user("What is the capital of France?"), "Paris")
+    assert ask(cache, user("what is the capital of france"))["text"] == "Paris"
+
+
+def test_different_context_does_not_hit(cache):
+    store(cache, user("北京人口是多少"), "answer")
+    other = [{"role": "system", "content": "只用英文回答。"}, {"role": "user", "content": "北京人口是多少"}]
+    assert ask(cache, other) is None
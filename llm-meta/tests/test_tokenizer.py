@@ -0,0 +1,35 @@
+"""发送前的上下文长度检查和token计数缓存"""
+from src.tokenizer import Tokenizer
+
+
+def make_tokenizer(**settings):
+    tokenizer = Tokenizer()
+    tokenizer.configure(dict({"encoding": "estimate", "min_completion_tokens": 10}, **settings))
+    return tokenizer
+
+
+def test_truncation_is_reported():
+    tokenizer = make_tokenizer()
+    model_config = {"name": "small", "context_window": 100}
+    messages = [{"role": "user", "content": "旧" * 80}, {"role": "user", "content": "新" * 80}]
+    kept, params, truncated = tokenizer.preflight(model_config, messages, {"max_tokens": 50})
+    assert truncated
+    assert len(kept) == 1 and kept[0]["content"].startswith("新")
+    assert tokenizer.count_messages(kept) + params["max_tokens"] <= 100
+
+
+def test_fitting_prompt_is_not_truncated():
+    tokenizer = make_tokenizer()
+    messages = [{"role": "user", "content": "你好"}]
+    kept, params, truncated = tokenizer.preflight({"name": "small", "context_window": 100}, messages, {"max_tokens": 50})
+    assert not truncated
+    assert kept is messages and params["max_tokens"] == 50
+
+
+def test_count_cache_is_bounded_by_entries():
+    tokenizer = make_tokenizer(cache_size=2)
+    for text in ("a" * 10000, "b" * 10000, "c" * 10000, "c" * 10000):
+        tokenizer.count(text)
+    stats = tokenizer.stats()
+    assert stats["cached"] == 2
+    assert stats["cache_hits"] == 1 and stats["cache_misses"] == 3
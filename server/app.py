@@ -2,6 +2,8 @@ from fastapi import FastAPI
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
 from .routes.system import router as system_router
+from .utils.system_monitor import sampler
+from .config import settings
 import logging
 from datetime import datetime
 
@@ -28,6 +30,16 @@ app.mount("/static", StaticFiles(directory="static"), name="static")
 # 注册系统监控路由
 app.include_router(system_router, prefix="/system", tags=["system"])
 
+# 后台按MONITOR_INTERVAL采集系统资源，/system 接口直接返回最近一次的结果
+@app.on_event("startup")
+async def startup_event():
+    sampler.interval = settings.MONITOR_INTERVAL
+    sampler.start()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await sampler.stop()
+
 @app.get("/health")
 async def health_check():
     """
@@ -1,105 +1,345 @@
-import redis
+import asyncio
 import json
 import logging
-from typing import Optional, Any, Dict
+import os
+import socket
+import time
+from collections import OrderedDict
+from typing import Optional, Any, Dict, Tuple
 from datetime import datetime, timedelta
 from config import settings
 
 logger = logging.getLogger(__name__)
 
+try:
+    import redis.asyncio as aioredis
+    from redis.asyncio.retry import Retry
+    from redis.backoff import NoBackoff
+except ImportError:  # 未安装redis时只使用进程内缓存
+    aioredis = None
+
+# 各worker通过该频道通知其他worker删除进程内缓存中已更新的键
+INVALIDATE_CHANNEL = "cache:invalidate"
+
+class LRUCache:
+    """
+    进程内缓存，按最近使用淘汰，每个条目有各自的过期时间
+    保存序列化后的JSON，读取时返回新的对象，与从Redis读取的行为一致
+    """
+
+    def __init__(self, max_entries: int = 1000):
+        self.max_entries = max_entries
+        self._data: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+
+    def get(self, key: str) -> Optional[str]:
+        item = self._data.get(key)
+        if item is None:
+            return None
+        if item[1] <= time.monotonic():
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return item[0]
+
+    def set(self, key: str, value: str, ttl: float) -> None:
+        self._data[key] = (value, time.monotonic() + ttl)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_entries:
+            self._data.popitem(last=False)
+
+    def ttl(self, key: str) -> Optional[float]:
+        """条目的剩余有效期（秒），不存在或已过期时返回None"""
+        item = self._data.get(key)
+        if item is None or item[1] <= time.monotonic():
+            return None
+        return item[1] - time.monotonic()
+
+    def delete(self, key: str) -> None:
+        self._data.pop(key, None)
+
+    def clear(self) -> None:
+        self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
 class RedisCache:
+    """
+    两级缓存：进程内LRU（L1）+ Redis（L2）
+    读取先查L1，未命中时查Redis并写入L1；写入和删除同时更新两级，并通过Redis发布订阅通知其他worker删除L1中的旧数据。
+    Redis不可用时只使用L1：请求失败后在REDIS_RETRY_INTERVAL秒内不再访问Redis，
+    期间的写入和删除在恢复后补写到Redis并通知其他worker；
+    订阅断开后由后台任务重连，重连后清空L1，避免使用断开期间错过失效通知的数据。
+    """
+
     def __init__(self):
+        self.l1 = LRUCache(settings.CACHE_L1_SIZE)
+        # L1条目的最长有效期，限制错过失效通知时读到旧数据的时间
+        self.l1_ttl = settings.CACHE_L1_TTL
+        self.retry_interval = settings.REDIS_RETRY_INTERVAL
+        self.instance_id = f"{socket.gethostname()}:{os.getpid()}"
+        self.hits = 0
+        self.misses = 0
+        self.redis = None
+        self._down_until = 0.0
+        self._outage = False
+        self._subscribed = False
+        # Redis不可用期间只写入L1的键：True为写入，False为删除
+        self._unsynced: Dict[str, bool] = {}
+        self._task: Optional[asyncio.Task] = None
+        self.subscriber = None
+        if aioredis is None:
+            logger.warning("未安装redis，只使用进程内缓存")
+            return
+        # 只创建连接池，第一次使用时才建立连接，Redis不可用时不影响启动
+        self.redis = aioredis.Redis(connection_pool=aioredis.ConnectionPool(
+            host=settings.REDIS_HOST,
+            port=settings.REDIS_PORT,
+            password=settings.REDIS_PASSWORD or None,
+            db=settings.REDIS_DB,
+            max_connections=settings.REDIS_MAX_CONNECTIONS,
+            socket_timeout=settings.REDIS_TIMEOUT,
+            socket_connect_timeout=settings.REDIS_TIMEOUT,
+            retry=Retry(NoBackoff(), 0),
+            decode_responses=True
+        ))
+        # 订阅使用单独的连接：没有读超时，空闲时不会被当作故障；定期发送PING检测断线
+        self.subscriber = aioredis.Redis(
+            host=settings.REDIS_HOST,
+            port=settings.REDIS_PORT,
+            password=settings.REDIS_PASSWORD or None,
+            db=settings.REDIS_DB,
+            socket_timeout=None,
+            socket_connect_timeout=settings.REDIS_TIMEOUT,
+            health_check_interval=self.retry_interval,
+            retry=Retry(NoBackoff(), 0),
+            decode_responses=True
+        )
+
+    @property
+    def available(self) -> bool:
+        """当前是否访问Redis；订阅任务运行时以订阅是否成功为准"""
+        if self.redis is None or time.monotonic() < self._down_until:
+            return False
+        return self._subscribed or self._task is None
+
+    def _mark_down(self, error: Exception) -> None:
+        if not self._outage:
+            logger.warning(f"Redis不可用，只使用进程内缓存，每{self.retry_interval}秒重试: {str(error)}")
+            self._outage = True
+        self._down_until = time.monotonic() + self.retry_interval
+
+    async def _recovered(self) -> None:
+        """Redis命令成功后调用：结束故障状态，并补写不可用期间只写入L1的数据"""
+        if not self._outage and not self._unsynced:
+            return
+        unsynced, self._unsynced = self._unsynced, {}
         try:
-            self.redis = redis.Redis(
-                host=settings.REDIS_HOST,
-                port=settings.REDIS_PORT,
-                password=settings.REDIS_PASSWORD,
-                decode_responses=True
-            )
-            logger.info("Redis连接成功")
-        except Exception as e:
-            logger.error(f"Redis连接失败: {str(e)}")
+            pipe = self.redis.pipeline(transaction=False)
+            for key, written in unsynced.items():
+                ttl = self.l1.ttl(key)
+                if written and ttl is None:
+                    continue  # 已过期
+                if written:
+                    pipe.setex(key, max(1, int(ttl)), self.l1.get(key))
+                else:
+                    pipe.delete(key)
+                self._invalidate(pipe, key)
+            await pipe.execute()
+        except Exception:
+            self._unsynced = dict(unsynced, **self._unsynced)
             raise
+        if self._outage:
+            logger.info(f"Redis已恢复，补写{len(unsynced)}个键")
+            self._outage = False
+
+    def start(self) -> None:
+        """启动订阅失效通知的后台任务，重复调用无效"""
+        if self.redis is not None and self._task is None:
+            self._task = asyncio.ensure_future(self._listen())
+
+    async def _listen(self) -> None:
+        while True:
+            pubsub = self.subscriber.pubsub(ignore_subscribe_messages=True)
+            try:
+                await pubsub.subscribe(INVALIDATE_CHANNEL)
+                await self._recovered()
+                # 断开期间可能错过了其他worker的失效通知
+                self.l1.clear()
+                self._subscribed = True
+                self._down_until = 0.0
+                logger.info("Redis连接成功")
+                while True:
+                    # 超时只表示没有消息；连接断开时抛出异常
+                    message = await pubsub.get_message(timeout=self.retry_interval)
+                    if message is None or message["type"] != "message":
+                        continue
+                    origin, _, key = message["data"].partition(" ")
+                    if origin != self.instance_id:
+                        self.l1.delete(key)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self._mark_down(e)
+            finally:
+                self._subscribed = False
+                await pubsub.aclose()
+            await asyncio.sleep(self.retry_interval)
 
-    def set_data(self, key: str, data: Any, expire_seconds: int = 300) -> bool:
+    def _invalidate(self, pipe, key: str) -> None:
+        """在管道中加入失效通知，其他worker收到后删除L1中的该键"""
+        pipe.publish(INVALIDATE_CHANNEL, f"{self.instance_id} {key}")
+
+    async def set_data(self, key: str, data: Any, expire_seconds: int = 300) -> bool:
         """
         设置缓存数据
         :param key: 缓存键
         :param data: 要缓存的数据
         :param expire_seconds: 过期时间（秒），默认5分钟
-        :return: 是否成功
+        :return: 是否成功（Redis不可用时写入进程内缓存也算成功）
         """
         try:
             serialized_data = json.dumps(data)
-            return self.redis.setex(key, expire_seconds, serialized_data)
         except Exception as e:
             logger.error(f"设置缓存失败 - key: {key}, error: {str(e)}")
             return False
+        if not self.available:
+            # Redis不可用时L1是唯一的存储，按原过期时间保存，恢复后补写
+            self.l1.set(key, serialized_data, expire_seconds)
+            self._unsynced[key] = True
+            return True
+        self.l1.set(key, serialized_data, min(expire_seconds, self.l1_ttl))
+        try:
+            pipe = self.redis.pipeline(transaction=False)
+            pipe.setex(key, expire_seconds, serialized_data)
+            self._invalidate(pipe, key)
+            await pipe.execute()
+            self._unsynced.pop(key, None)
+            await self._recovered()
+        except Exception as e:
+            self._mark_down(e)
+        return True
 
-    def get_data(self, key: str) -> Optional[Any]:
+    async def get_data(self, key: str) -> Optional[Any]:
         """
         获取缓存数据
         :param key: 缓存键
         :return: 缓存的数据，如果不存在则返回None
         """
+        data = self.l1.get(key)
+        if data is None and self.available:
+            try:
+                pipe = self.redis.pipeline(transaction=False)
+                pipe.get(key)
+                pipe.ttl(key)
+                data, ttl = await pipe.execute()
+                if data is not None:
+                    self.l1.set(key, data, min(ttl, self.l1_ttl) if ttl > 0 else self.l1_ttl)
+                await self._recovered()
+            except Exception as e:
+                self._mark_down(e)
+        if data is None:
+            self.misses += 1
+            return None
+        self.hits += 1
         try:
-            data = self.redis.get(key)
-            return json.loads(data) if data else None
+            return json.loads(data)
         except Exception as e:
             logger.error(f"获取缓存失败 - key: {key}, error: {str(e)}")
             return None
 
-    def delete_data(self, key: str) -> bool:
+    async def delete_data(self, key: str) -> bool:
         """
         删除缓存数据
         :param key: 缓存键
         :return: 是否成功
         """
+        self.l1.delete(key)
+        if not self.available:
+            self._unsynced[key] = False
+            return True
         try:
-            return bool(self.redis.delete(key))
+            pipe = self.redis.pipeline(transaction=False)
+            pipe.delete(key)
+            self._invalidate(pipe, key)
+            await pipe.execute()
+            self._unsynced.pop(key, None)
+            await self._recovered()
+            return True
         except Exception as e:
+            self._mark_down(e)
             logger.error(f"删除缓存失败 - key: {key}, error: {str(e)}")
             return False
 
-    def set_system_metrics(self, metrics: Dict[str, Any]) -> bool:
+    async def ping(self) -> bool:
+        """检查Redis连接，不可用时不等待超时"""
+        if not self.available:
+            return False
+        try:
+            result = await self.redis.ping()
+            await self._recovered()
+            return result
+        except Exception as e:
+            self._mark_down(e)
+            return False
+
+    async def set_system_metrics(self, metrics: Dict[str, Any]) -> bool:
         """
         缓存系统指标数据
         :param metrics: 系统指标数据
         :return: 是否成功
         """
-        return self.set_data("system_metrics", metrics, 60)  # 1分钟过期
+        return await self.set_data("system_metrics", metrics, 60)  # 1分钟过期
 
-    def get_system_metrics(self) -> Optional[Dict[str, Any]]:
+    async def get_system_metrics(self) -> Optional[Dict[str, Any]]:
         """
         获取缓存的系统指标数据
         :return: 系统指标数据
         """
-        return self.get_data("system_metrics")
+        return await self.get_data("system_metrics")
 
-    def set_network_info(self, network_info: Dict[str, Any]) -> bool:
+    async def set_network_info(self, network_info: Dict[str, Any]) -> bool:
         """
         缓存网络信息数据
         :param network_info: 网络信息数据
         :return: 是否成功
         """
-        return self.set_data("network_info", network_info, 300)  # 5分钟过期
+        return await self.set_data("network_info", network_info, 300)  # 5分钟过期
 
-    def get_network_info(self) -> Optional[Dict[str, Any]]:
+    async def get_network_info(self) -> Optional[Dict[str, Any]]:
         """
         获取缓存的网络信息数据
         :return: 网络信息数据
         """
-        return self.get_data("network_info")
+        return await self.get_data("network_info")
 
     def clear_expired_cache(self) -> None:
         """
         清理过期的缓存数据
         """
         try:
-            # Redis会自动清理过期的键，这里可以添加自定义的清理逻辑
+            # Redis会自动清理过期的键，进程内缓存在读取时清理过期条目
             pass
         except Exception as e:
             logger.error(f"清理过期缓存失败: {str(e)}")
 
-# 创建全局Redis缓存实例
-redis_cache = RedisCache() 
\ No newline at end of file
+    def status(self) -> Dict[str, Any]:
+        return {
+            "redis": "connected" if self.available else "unavailable",
+            "l1_entries": len(self.l1),
+            "unsynced": len(self._unsynced),
+            "hits": self.hits,
+            "misses": self.misses
+        }
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if self.redis is not None:
+            await self.redis.aclose()
+            await self.subscriber.aclose()
+
+# 创建全局缓存实例（不连接Redis，Redis不可用时不影响导入）
+redis_cache = RedisCache()
@@ -1,5 +1,5 @@
 from pydantic_settings import BaseSettings
-from typing import List
+from typing import Dict, List
 import os
 from pathlib import Path
 
@@ -31,6 +31,13 @@ class Settings(BaseSettings):
     REDIS_PORT: int = 6379
     REDIS_PASSWORD: str = None
     REDIS_DB: int = 0
+    REDIS_MAX_CONNECTIONS: int = 20  # 连接池大小
+    REDIS_TIMEOUT: float = 0.5  # 连接和读写超时（秒）
+    REDIS_RETRY_INTERVAL: int = 10  # Redis不可用时重试连接的间隔（秒）
+    
+    # 进程内缓存配置
+    CACHE_L1_SIZE: int = 1000  # 最大条目数
+    CACHE_L1_TTL: int = 60  # 条目最长有效期（秒），限制其他worker更新后读到旧数据的时间
     
     # 日志配置
     LOG_LEVEL: str = "INFO"
@@ -39,7 +46,14 @@ class Settings(BaseSettings):
     
     # 监控配置
     MONITOR_INTERVAL: int = 60  # 监控数据收集间隔（秒）
-    DATA_RETENTION_DAYS: int = 30  # 监控数据保留天数
+    DATA_RETENTION_DAYS: int = 30  # 原始监控数据保留天数（至少2天）
+    ROLLUP_RETENTION_DAYS: Dict[str, int] = {  # 各精度汇总数据保留天数
+        "1m": 90,
+        "1h": 730,
+        "1d": 3650
+    }
+    METRICS_FLUSH_INTERVAL: float = 5.0  # 监控数据批量写入间隔（秒）
+    METRICS_BATCH_SIZE: int = 500  # 写入队列达到该条数时立即写入
     
     # 安全配置
     SSL_KEYFILE: str = None
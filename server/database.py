@@ -1,4 +1,4 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.orm import Session
 from contextlib import contextmanager
@@ -12,6 +12,21 @@ logger = logging.getLogger(__name__)
 # 创建数据库引擎
 engine = create_engine(settings.DB_URL)
 
+if engine.dialect.name == "sqlite":
+    @event.listens_for(engine, "connect")
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        """
+        SQLite使用WAL模式：写入不阻塞读取，synchronous=NORMAL 时提交只写WAL文件，
+        检查点时才fsync；busy_timeout 让并发写入等待锁而不是立即报错
+        """
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute("PRAGMA busy_timeout=5000")
+        cursor.execute("PRAGMA cache_size=-16000")
+        cursor.execute("PRAGMA temp_store=MEMORY")
+        cursor.close()
+
 # 创建会话工厂
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
@@ -39,24 +54,12 @@ def get_db() -> Generator[Session, None, None]:
         db.close()
 
 def cleanup_old_data(days: int = settings.DATA_RETENTION_DAYS) -> None:
-    """清理旧数据"""
-    from datetime import datetime, timedelta
-    from models import SystemMetrics, NetworkMetrics
+    """清理旧数据：删除超过保留期的监控数据分区"""
+    from timeseries import metric_store
     
-    cleanup_date = datetime.utcnow() - timedelta(days=days)
     try:
-        with get_db() as db:
-            # 删除旧的系统指标数据
-            db.query(SystemMetrics).filter(
-                SystemMetrics.timestamp < cleanup_date
-            ).delete()
-            
-            # 删除旧的网络指标数据
-            db.query(NetworkMetrics).filter(
-                NetworkMetrics.timestamp < cleanup_date
-            ).delete()
-            
-            logger.info(f"已清理{days}天前的数据")
+        dropped = metric_store.enforce_retention(raw_days=days)
+        logger.info(f"已清理{days}天前的数据，删除{dropped}个分区")
     except Exception as e:
         logger.error(f"数据清理失败: {str(e)}")
-        raise 
\ No newline at end of file
+        raise
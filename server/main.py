@@ -1,27 +1,29 @@
 from fastapi import FastAPI, HTTPException, Depends, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, StreamingResponse
 from fastapi.security import APIKeyHeader
 from pydantic import BaseModel
 from typing import List, Optional
 import uvicorn
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 import platform
 import os
 import sys
 import psutil
-import json
 import logging
 import time
+import asyncio
+from functools import partial
 from starlette.middleware.base import BaseHTTPMiddleware
 from typing import Dict, Any
 from config import init_config, settings
-from database import init_db, get_db, cleanup_old_data
-from models import SystemMetrics, NetworkMetrics
-from sqlalchemy.orm import Session
+from database import init_db, cleanup_old_data
 from cache import redis_cache
 from middleware import APIMonitorMiddleware, ServiceHealthMiddleware
+from utils.system_monitor import sampler
+from timeseries import metric_store, RESOLUTIONS
+from utils.export import EXPORT_FORMATS, encode_rows
 
 # 初始化配置
 settings = init_config()
@@ -47,7 +49,24 @@ app = FastAPI(
 @app.on_event("startup")
 async def startup_event():
     init_db()
+    metric_store.init()
     logger.info("数据库初始化完成")
+    # 后台按MONITOR_INTERVAL采集系统资源，接口直接返回最近一次的结果
+    sampler.interval = settings.MONITOR_INTERVAL
+    sampler.protocol = "HTTPS" if settings.SSL_CERTFILE else "HTTP"
+    # 采样结果进入时序存储的写入队列，由后台任务批量写入
+    sampler.on_sample(metric_store.write)
+    metric_store.start()
+    sampler.start()
+    # 订阅其他worker的缓存失效通知，Redis不可用时只使用进程内缓存
+    redis_cache.start()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await sampler.stop()
+    # 写入队列中剩余的监控数据
+    await metric_store.close()
+    await redis_cache.close()
 
 # API密钥认证
 api_key_header = APIKeyHeader(name="X-API-Key")
@@ -144,52 +163,10 @@ async def health_check():
     }
 
 @app.get("/system/resources", dependencies=[Depends(verify_api_key)])
-async def get_system_resources(db: Session = Depends(get_db)):
-    """获取系统资源使用情况"""
+async def get_system_resources():
+    """获取系统资源使用情况（后台采样器最近一次采集的结果）"""
     try:
-        # 尝试从缓存获取数据
-        cached_data = redis_cache.get_system_metrics()
-        if cached_data:
-            return cached_data
-
-        # 如果缓存不存在，则获取新数据
-        cpu_percent = psutil.cpu_percent(interval=1)
-        memory = psutil.virtual_memory()
-        disk = psutil.disk_usage('/')
-        
-        # 创建新的系统指标记录
-        metrics = SystemMetrics(
-            cpu_percent=cpu_percent,
-            memory_percent=memory.percent,
-            disk_percent=disk.percent,
-            memory_total=memory.total,
-            memory_available=memory.available,
-            disk_total=disk.total,
-            disk_free=disk.free
-        )
-        
-        # 保存到数据库
-        db.add(metrics)
-        db.commit()
-        
-        # 准备响应数据
-        response_data = {
-            "cpu": cpu_percent,
-            "memory": memory.percent,
-            "disk": disk.percent,
-            "details": {
-                "memory_total": memory.total,
-                "memory_available": memory.available,
-                "disk_total": disk.total,
-                "disk_free": disk.free,
-                "timestamp": datetime.now().isoformat()
-            }
-        }
-        
-        # 缓存数据
-        redis_cache.set_system_metrics(response_data)
-        
-        return response_data
+        return (await sampler.latest())["resources"]
     except Exception as e:
         logger.error(f"获取系统资源信息失败: {str(e)}")
         raise HTTPException(status_code=500, detail="获取系统资源信息失败")
@@ -243,84 +220,98 @@ async def get_database_status():
         }
 
 @app.get("/system/network", dependencies=[Depends(verify_api_key)])
-async def get_network_info(db: Session = Depends(get_db)):
-    """获取网络协议信息"""
+async def get_network_info():
+    """获取网络协议信息（后台采样器最近一次采集的结果）"""
     try:
-        # 尝试从缓存获取数据
-        cached_data = redis_cache.get_network_info()
-        if cached_data:
-            return cached_data
-
-        # 如果缓存不存在，则获取新数据
-        network_info = psutil.net_if_stats()
-        connections = psutil.net_connections()
-        
-        details = {
-            "interfaces": [name for name in network_info.keys()],
-            "timestamp": datetime.now().isoformat()
-        }
-        
-        # 创建新的网络指标记录
-        metrics = NetworkMetrics(
-            protocol="HTTPS" if settings.SSL_CERTFILE else "HTTP",
-            active_connections=len(connections),
-            interfaces_count=len(network_info),
-            details=json.dumps(details)
-        )
-        
-        # 保存到数据库
-        db.add(metrics)
-        db.commit()
-        
-        # 准备响应数据
-        response_data = {
-            "protocol": "HTTPS" if settings.SSL_CERTFILE else "HTTP",
-            "interfaces": len(network_info),
-            "active_connections": len(connections),
-            "details": details
-        }
-        
-        # 缓存数据
-        redis_cache.set_network_info(response_data)
-        
-        return response_data
+        return (await sampler.latest())["network"]
     except Exception as e:
         logger.error(f"获取网络信息失败: {str(e)}")
         raise HTTPException(status_code=500, detail="获取网络信息失败")
 
+def to_utc(value: Optional[datetime]) -> Optional[datetime]:
+    """查询参数中的时间转换为UTC（监控数据按UTC保存），不带时区的按UTC处理"""
+    if value is not None and value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
 @app.get("/metrics/history", dependencies=[Depends(verify_api_key)])
 async def get_metrics_history(
     start_time: Optional[datetime] = None,
     end_time: Optional[datetime] = None,
-    limit: int = 100,
-    db: Session = Depends(get_db)
+    max_points: int = 500,
+    step: Optional[int] = None,
+    resolution: Optional[str] = None,
+    method: str = "avg"
 ):
-    """获取历史监控数据"""
+    """
+    获取历史监控数据（列式）
+    返回 timestamps（UTC毫秒时间戳）和对应的 cpu/memory/disk 数组，点数不超过max_points，
+    未指定时间范围时返回最近24小时。
+    step（秒）指定降采样的时间桶间隔；resolution 可选 raw/1m/1h/1d，不指定时按时间范围选择；
+    数据点过多时 method=avg 按时间桶平均，method=lttb 用LTTB算法按CPU曲线挑选数据点
+    """
+    if resolution is not None and resolution not in RESOLUTIONS:
+        raise HTTPException(status_code=400, detail=f"resolution 必须是 {', '.join(RESOLUTIONS)} 之一")
+    if method not in ("avg", "lttb"):
+        raise HTTPException(status_code=400, detail="method 必须是 avg 或 lttb")
+    if not 2 <= max_points <= 10000:
+        raise HTTPException(status_code=400, detail="max_points 必须在 2 到 10000 之间")
+    if step is not None and step < 1:
+        raise HTTPException(status_code=400, detail="step 必须大于0")
+    end_time = to_utc(end_time) or datetime.utcnow()
+    start_time = to_utc(start_time) or end_time - timedelta(days=1)
+    if start_time >= end_time:
+        raise HTTPException(status_code=400, detail="start_time 必须早于 end_time")
     try:
-        query = db.query(SystemMetrics)
-        if start_time:
-            query = query.filter(SystemMetrics.timestamp >= start_time)
-        if end_time:
-            query = query.filter(SystemMetrics.timestamp <= end_time)
-            
-        metrics = query.order_by(SystemMetrics.timestamp.desc()).limit(limit).all()
-        
-        return [{
-            "timestamp": m.timestamp.isoformat(),
-            "cpu": m.cpu_percent,
-            "memory": m.memory_percent,
-            "disk": m.disk_percent,
-            "details": {
-                "memory_total": m.memory_total,
-                "memory_available": m.memory_available,
-                "disk_total": m.disk_total,
-                "disk_free": m.disk_free
-            }
-        } for m in metrics]
+        loop = asyncio.get_running_loop()
+        series = await loop.run_in_executor(None, partial(
+            metric_store.series, "system_metrics", start_time, end_time,
+            max_points=max_points, step=step, resolution=resolution, method=method
+        ))
+        return {
+            "resolution": series["resolution"],
+            "step": series["step"],
+            "start": start_time.isoformat(),
+            "end": end_time.isoformat(),
+            "timestamps": series["timestamps"],
+            "cpu": series["cpu_percent"],
+            "memory": series["memory_percent"],
+            "disk": series["disk_percent"]
+        }
     except Exception as e:
         logger.error(f"获取历史监控数据失败: {str(e)}")
         raise HTTPException(status_code=500, detail="获取历史监控数据失败")
 
+@app.get("/metrics/export", dependencies=[Depends(verify_api_key)])
+async def export_metrics(
+    start_time: Optional[datetime] = None,
+    end_time: Optional[datetime] = None,
+    kind: str = "system",
+    resolution: str = "raw",
+    format: str = "csv"
+):
+    """
+    流式导出监控数据，用于大批量拉取
+    kind 可选 system/network；format 可选 csv/ndjson/arrow（arrow需要安装pyarrow）；
+    未指定开始时间时导出保留期内的全部数据
+    """
+    if kind not in ("system", "network"):
+        raise HTTPException(status_code=400, detail="kind 必须是 system 或 network")
+    if resolution not in RESOLUTIONS:
+        raise HTTPException(status_code=400, detail=f"resolution 必须是 {', '.join(RESOLUTIONS)} 之一")
+    table = f"{kind}_metrics"
+    end_time = to_utc(end_time) or datetime.utcnow()
+    columns = metric_store.export_columns(table, resolution)
+    chunks = metric_store.export_rows(table, resolution, to_utc(start_time), end_time)
+    try:
+        body = encode_rows(format, columns, chunks)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    media_type, extension = EXPORT_FORMATS[format]
+    return StreamingResponse(body, media_type=media_type, headers={
+        "Content-Disposition": f'attachment; filename="{table}_{resolution}.{extension}"'
+    })
+
 @app.post("/messages")
 async def create_message(message: Message):
     message.timestamp = int(datetime.now().timestamp() * 1000)
@@ -339,7 +330,7 @@ async def get_messages(before: Optional[str] = None, limit: int = 20):
 async def get_api_stats():
     """获取API监控统计数据"""
     try:
-        stats = redis_cache.get_data("api_stats")
+        stats = await redis_cache.get_data("api_stats")
         if not stats:
             return {
                 "message": "暂无统计数据",
@@ -354,7 +345,7 @@ async def get_api_stats():
 async def get_service_health():
     """获取服务健康状态"""
     try:
-        health_status = redis_cache.get_data("service_health")
+        health_status = await redis_cache.get_data("service_health")
         if not health_status:
             # 如果缓存中没有数据，触发一次健康检查
             middleware = next(m for m in app.middleware if isinstance(m, ServiceHealthMiddleware))
@@ -391,7 +382,7 @@ async def get_performance_metrics():
         }
         
         # 缓存性能指标
-        redis_cache.set_data("performance_metrics", metrics, 60)
+        await redis_cache.set_data("performance_metrics", metrics, 60)
         
         return metrics
     except Exception as e:
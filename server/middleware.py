@@ -51,7 +51,7 @@ class APIMonitorMiddleware(BaseHTTPMiddleware):
                 "endpoints": self.endpoint_stats,
                 "timestamp": datetime.now().isoformat()
             }
-            redis_cache.set_data("api_stats", stats, 300)  # 5分钟过期
+            await redis_cache.set_data("api_stats", stats, 300)  # 5分钟过期
             
             # 添加处理时间到响应头
             response.headers["X-Process-Time"] = str(process_time)
@@ -72,19 +72,20 @@ class ServiceHealthMiddleware(BaseHTTPMiddleware):
     async def check_service_health(self):
         """检查服务健康状态"""
         try:
-            # 检查Redis连接
-            redis_status = redis_cache.redis.ping()
+            # 检查Redis连接（不可用时直接返回，不等待超时）
+            start_time = time.time()
+            redis_status = await redis_cache.ping()
+            latency = time.time() - start_time
             
             # 检查数据库连接
             from database import get_db
-            db = next(get_db())
-            db_status = True
-            db.close()
+            with get_db():
+                db_status = True
             
             health_status = {
                 "redis": {
                     "status": "healthy" if redis_status else "unhealthy",
-                    "latency": time.time() - start_time
+                    "latency": latency
                 },
                 "database": {
                     "status": "healthy" if db_status else "unhealthy"
@@ -93,7 +94,7 @@ class ServiceHealthMiddleware(BaseHTTPMiddleware):
             }
             
             # 缓存健康状态
-            redis_cache.set_data("service_health", health_status, 300)
+            await redis_cache.set_data("service_health", health_status, 300)
             
             return health_status
             
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, Float, String, DateTime
+from sqlalchemy import Column, Integer, Float, String, DateTime, Index, MetaData, Table
 from sqlalchemy.ext.declarative import declarative_base
 from datetime import datetime
 
@@ -25,4 +25,56 @@ class NetworkMetrics(Base):
     protocol = Column(String)
     active_connections = Column(Integer)
     interfaces_count = Column(Integer)
-    details = Column(String)  # JSON字符串存储接口详情 
\ No newline at end of file
+    details = Column(String)  # JSON字符串存储接口详情 
+
+# 时序存储（见 timeseries.py）的表结构：原始采样和汇总数据都按时间分区，每个分区一张表
+metrics_metadata = MetaData()
+
+# 各类监控数据参与汇总的指标
+ROLLUP_FIELDS = {
+    "system_metrics": ["cpu_percent", "memory_percent", "disk_percent"],
+    "network_metrics": ["active_connections", "interfaces_count"]
+}
+
+def raw_partition(kind: str, name: str, metadata: MetaData = metrics_metadata) -> Table:
+    """原始采样的分区表，结构与 SystemMetrics / NetworkMetrics 相同，timestamp 建索引"""
+    if name in metadata.tables:
+        return metadata.tables[name]
+    if kind == "system_metrics":
+        columns = [
+            Column("cpu_percent", Float),
+            Column("memory_percent", Float),
+            Column("disk_percent", Float),
+            Column("memory_total", Integer),
+            Column("memory_available", Integer),
+            Column("disk_total", Integer),
+            Column("disk_free", Integer)
+        ]
+    else:
+        columns = [
+            Column("protocol", String),
+            Column("active_connections", Integer),
+            Column("interfaces_count", Integer),
+            Column("details", String)
+        ]
+    return Table(
+        name, metadata,
+        Column("id", Integer, primary_key=True),
+        Column("timestamp", DateTime, nullable=False),
+        *columns,
+        Index(f"ix_{name}_timestamp", "timestamp")
+    )
+
+def rollup_partition(kind: str, name: str, metadata: MetaData = metrics_metadata) -> Table:
+    """汇总数据的分区表，每个时间桶一行，记录每个指标的min/max/avg/p95"""
+    if name in metadata.tables:
+        return metadata.tables[name]
+    columns = []
+    for field in ROLLUP_FIELDS[kind]:
+        columns += [Column(f"{field}_{stat}", Float) for stat in ("min", "max", "avg", "p95")]
+    return Table(
+        name, metadata,
+        Column("timestamp", DateTime, primary_key=True),  # 时间桶的起点
+        Column("samples", Integer, nullable=False),
+        *columns
+    )
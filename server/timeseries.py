@@ -0,0 +1,569 @@
+"""
+监控数据时序存储
+
+原始采样按天分区保存在 system_metrics_YYYYMMDD / network_metrics_YYYYMMDD 表中（timestamp 建索引），
+每个时间桶结束后汇总为 1m / 1h / 1d 三档精度，记录每个指标的 min/max/avg/p95；
+汇总数据 1m 按天、1h 按月、1d 按年分区，如 system_metrics_1h_202610。
+过期数据按分区整表删除，不做逐行删除；查询历史数据时按时间范围选择合适的精度。
+
+采样数据先进入写入队列，由后台任务按时间间隔或队列长度批量写入（executemany），
+采样和接口都不等待数据库提交；服务停止时写入队列中剩余的数据。
+"""
+import asyncio
+import json
+import logging
+import math
+import re
+import threading
+from datetime import datetime, timedelta
+from itertools import groupby
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from sqlalchemy import MetaData, func, inspect, select
+from sqlalchemy.engine import Engine
+
+from config import settings
+from database import engine
+from models import (
+    NetworkMetrics, ROLLUP_FIELDS, SystemMetrics, metrics_metadata, raw_partition, rollup_partition
+)
+
+logger = logging.getLogger(__name__)
+
+EPOCH = datetime(1970, 1, 1)
+
+KINDS = ("system_metrics", "network_metrics")
+
+# 汇总精度: (时间桶秒数, 分区单位)
+ROLLUPS = {
+    "1m": (60, "day"),
+    "1h": (3600, "month"),
+    "1d": (86400, "year")
+}
+
+RESOLUTIONS = ("raw",) + tuple(ROLLUPS)
+
+# 自动选择查询精度时，最多读取max_points的这么多倍的数据点再降采样
+OVERSAMPLE = 10
+
+# 分区表名的时间后缀
+PARTITION_FORMATS = {"day": "%Y%m%d", "month": "%Y%m", "year": "%Y"}
+
+PARTITION_RE = re.compile(r"^(system_metrics|network_metrics)(?:_(1m|1h|1d))?_(\d{4,8})$")
+
+def floor_time(ts: datetime, step: int) -> datetime:
+    """按step秒向下对齐时间"""
+    seconds = int((ts - EPOCH).total_seconds())
+    return EPOCH + timedelta(seconds=seconds - seconds % step)
+
+def partition_start(ts: datetime, unit: str) -> datetime:
+    if unit == "day":
+        return datetime(ts.year, ts.month, ts.day)
+    if unit == "month":
+        return datetime(ts.year, ts.month, 1)
+    return datetime(ts.year, 1, 1)
+
+def partition_end(start: datetime, unit: str) -> datetime:
+    if unit == "day":
+        return start + timedelta(days=1)
+    if unit == "month":
+        return datetime(start.year + start.month // 12, start.month % 12 + 1, 1)
+    return datetime(start.year + 1, 1, 1)
+
+def percentile(values: Sequence[float], q: float) -> float:
+    """已排序数据的百分位数（最近秩法）"""
+    return values[max(0, math.ceil(q * len(values)) - 1)]
+
+def bucket_average(timestamps: List[int], values: List[List[Optional[float]]], weights: List[int],
+                   step: int) -> Tuple[List[int], List[List[Optional[float]]]]:
+    """按step（与timestamps单位相同）对齐的时间桶加权平均，timestamps需按时间顺序排列"""
+    buckets: List[int] = []
+    sums = [[] for _ in values]
+    totals = [[] for _ in values]
+    for i, timestamp in enumerate(timestamps):
+        bucket = timestamp - timestamp % step
+        if not buckets or buckets[-1] != bucket:
+            buckets.append(bucket)
+            for column in range(len(values)):
+                sums[column].append(0.0)
+                totals[column].append(0)
+        for column, series in enumerate(values):
+            if series[i] is not None:
+                sums[column][-1] += series[i] * weights[i]
+                totals[column][-1] += weights[i]
+    averages = [[value / total if total else None for value, total in zip(column_sums, column_totals)]
+                for column_sums, column_totals in zip(sums, totals)]
+    return buckets, averages
+
+def lttb(x: List[int], y: List[Optional[float]], threshold: int) -> List[int]:
+    """Largest-Triangle-Three-Buckets 降采样，返回保留的数据点下标（首尾两点始终保留）"""
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return list(range(n))
+    y = [v if v is not None else 0.0 for v in y]
+    every = (n - 2) / (threshold - 2)
+    keep = [0]
+    a = 0
+    for i in range(threshold - 2):
+        start = int(i * every) + 1
+        end = int((i + 1) * every) + 1
+        # 下一个桶的平均点
+        next_end = min(int((i + 2) * every) + 1, n)
+        avg_x = sum(x[end:next_end]) / (next_end - end)
+        avg_y = sum(y[end:next_end]) / (next_end - end)
+        best, best_area = start, -1.0
+        for j in range(start, end):
+            area = abs((x[a] - avg_x) * (y[j] - y[a]) - (x[a] - x[j]) * (avg_y - y[a]))
+            if area > best_area:
+                best, best_area = j, area
+        keep.append(best)
+        a = best
+    keep.append(n - 1)
+    return keep
+
+class MetricStore:
+    """
+    按时间分区的监控数据存储
+    写入队列可在任意线程中调用，批量写入和汇总在线程池中执行，查询可在其他线程中并发执行
+    """
+
+    def __init__(self, engine: Engine):
+        self.engine = engine
+        # 原始数据的采样间隔（秒），用于选择查询精度
+        self.interval = settings.MONITOR_INTERVAL
+        # 按天汇总需要前一天的原始数据，原始数据至少保留2天
+        self.retention = dict(settings.ROLLUP_RETENTION_DAYS, raw=max(2, settings.DATA_RETENTION_DAYS))
+        self._partitions: Dict[Tuple[str, str], set] = {}
+        self._rolled: Dict[Tuple[str, str], datetime] = {}
+        self._retained_on = None
+        # 正在被查询的分区及查询数，保留期清理时跳过这些分区，留到下次再删除
+        self._reading: Dict[Tuple[str, str, datetime], int] = {}
+        self._lock = threading.RLock()
+        # 写入队列
+        self.flush_interval = settings.METRICS_FLUSH_INTERVAL
+        self.batch_size = settings.METRICS_BATCH_SIZE
+        # 数据库长时间不可用时队列最多保留的采样数，超出后丢弃最旧的
+        self.max_pending = settings.METRICS_BATCH_SIZE * 20
+        self.flushed = 0
+        self.dropped = 0
+        self._pending: List[Tuple[datetime, Dict[str, Dict[str, Any]]]] = []
+        self._pending_lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+
+    @staticmethod
+    def _unit(resolution: str) -> str:
+        return "day" if resolution == "raw" else ROLLUPS[resolution][1]
+
+    def _table(self, kind: str, resolution: str, start: datetime):
+        suffix = start.strftime(PARTITION_FORMATS[self._unit(resolution)])
+        with self._lock:
+            if resolution == "raw":
+                return raw_partition(kind, f"{kind}_{suffix}")
+            return rollup_partition(kind, f"{kind}_{resolution}_{suffix}")
+
+    def _ensure(self, kind: str, resolution: str, start: datetime):
+        """返回分区表，不存在时创建（在写入数据的事务之外执行）"""
+        table = self._table(kind, resolution, start)
+        if start not in self._partitions.get((kind, resolution), ()):
+            table.create(self.engine, checkfirst=True)
+            with self._lock:
+                self._partitions.setdefault((kind, resolution), set()).add(start)
+        return table
+
+    def init(self) -> None:
+        """加载已有的分区，迁移旧表中的数据并删除过期分区"""
+        names = inspect(self.engine).get_table_names()
+        partitions: Dict[Tuple[str, str], set] = {}
+        for name in names:
+            match = PARTITION_RE.match(name)
+            if not match:
+                continue
+            kind, resolution, suffix = match.groups()
+            resolution = resolution or "raw"
+            try:
+                start = datetime.strptime(suffix, PARTITION_FORMATS[self._unit(resolution)])
+            except ValueError:
+                continue
+            partitions.setdefault((kind, resolution), set()).add(start)
+        with self._lock:
+            self._partitions = partitions
+            self._rolled = {}
+        self._migrate_legacy(names)
+        self.enforce_retention()
+        logger.info(f"时序存储初始化完成，共{sum(len(s) for s in partitions.values())}个分区")
+
+    def _migrate_legacy(self, names: List[str], batch_size: int = 5000) -> None:
+        """把旧版 system_metrics / network_metrics 表中的数据移入按天分区的表"""
+        for model in (SystemMetrics, NetworkMetrics):
+            legacy = model.__table__
+            if legacy.name not in names:
+                continue
+            moved, last_id = 0, 0
+            while True:
+                with self.engine.connect() as conn:
+                    query = select(legacy).where(legacy.c.id > last_id).order_by(legacy.c.id).limit(batch_size)
+                    rows = [dict(row._mapping) for row in conn.execute(query)]
+                if not rows:
+                    break
+                last_id = rows[-1]["id"]
+                rows = sorted((r for r in rows if r["timestamp"] is not None), key=lambda r: r["timestamp"])
+                groups = [(self._ensure(legacy.name, "raw", start), [{k: v for k, v in r.items() if k != "id"} for r in group])
+                          for start, group in groupby(rows, key=lambda r: partition_start(r["timestamp"], "day"))]
+                with self.engine.begin() as conn:
+                    for table, group in groups:
+                        conn.execute(table.insert(), group)
+                    conn.execute(legacy.delete().where(legacy.c.id <= last_id))
+                moved += len(rows)
+            if moved:
+                logger.info(f"已将{moved}条{legacy.name}数据迁移到分区表")
+
+    @staticmethod
+    def sample_rows(resources: Dict[str, Any], network: Dict[str, Any],
+                    timestamp: datetime) -> Dict[str, Dict[str, Any]]:
+        """一次采样对应的原始数据行"""
+        details = resources["details"]
+        return {
+            "system_metrics": {
+                "timestamp": timestamp,
+                "cpu_percent": resources["cpu"],
+                "memory_percent": resources["memory"],
+                "disk_percent": resources["disk"],
+                "memory_total": details["memory_total"],
+                "memory_available": details["memory_available"],
+                "disk_total": details["disk_total"],
+                "disk_free": details["disk_free"]
+            },
+            "network_metrics": {
+                "timestamp": timestamp,
+                "protocol": network["protocol"],
+                "active_connections": network["active_connections"],
+                "interfaces_count": network["interfaces"],
+                "details": json.dumps(network["details"])
+            }
+        }
+
+    def write(self, resources: Dict[str, Any], network: Dict[str, Any],
+              timestamp: Optional[datetime] = None) -> None:
+        """
+        把一次采样加入写入队列，可在任意线程中调用
+        后台写入任务未启动时直接写入数据库
+        """
+        now = timestamp or datetime.utcnow()
+        rows = self.sample_rows(resources, network, now)
+        with self._pending_lock:
+            self._pending.append((now, rows))
+            overflow = len(self._pending) - self.max_pending
+            if overflow > 0:
+                del self._pending[:overflow]
+                self.dropped += overflow
+                logger.warning(f"监控数据写入队列已满，丢弃{overflow}条采样")
+            size = len(self._pending)
+        if self._task is None:
+            self.flush()
+        elif size >= self.batch_size:
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    def flush(self) -> int:
+        """把队列中的采样批量写入数据库并汇总已经结束的时间桶，返回写入的采样数"""
+        with self._flush_lock:
+            with self._pending_lock:
+                pending, self._pending = self._pending, []
+            if not pending:
+                return 0
+            try:
+                self._insert(pending)
+            except Exception:
+                # 放回队列，下次写入时重试
+                with self._pending_lock:
+                    self._pending[:0] = pending
+                raise
+            self.flushed += len(pending)
+            # 队列按时间顺序写入，最后一条采样之前的时间桶都已完整
+            now = pending[-1][0]
+            self.rollup(now)
+            if self._retained_on != now.date():
+                self.enforce_retention(now)
+            return len(pending)
+
+    def _insert(self, pending: List[Tuple[datetime, Dict[str, Dict[str, Any]]]]) -> None:
+        batches: Dict[Tuple[str, datetime], List[Dict[str, Any]]] = {}
+        for timestamp, rows in pending:
+            for kind, row in rows.items():
+                batches.setdefault((kind, partition_start(timestamp, "day")), []).append(row)
+        tables = {key: self._ensure(key[0], "raw", key[1]) for key in batches}
+        with self.engine.begin() as conn:
+            for key, rows in batches.items():
+                conn.execute(tables[key].insert(), rows)
+
+    def start(self) -> None:
+        """启动后台写入任务，重复调用无效"""
+        if self._task is not None:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.ensure_future(self._flush_loop())
+
+    async def _flush_loop(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self._loop.run_in_executor(None, self.flush)
+            except Exception as e:
+                logger.error(f"写入监控数据失败: {str(e)}")
+
+    async def close(self) -> None:
+        """停止后台写入任务，并写入队列中剩余的数据"""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, self.flush)
+        except Exception as e:
+            logger.error(f"写入剩余的监控数据失败: {str(e)}")
+
+    def _scan(self, kind: str, resolution: str, start: Optional[datetime], end: datetime,
+              columns: Optional[List[str]] = None, desc: bool = False,
+              limit: Optional[int] = None) -> Iterator[Any]:
+        """按时间顺序读取[start, end)内的数据，依次查询覆盖该范围的分区"""
+        unit = self._unit(resolution)
+        with self._lock:
+            starts = sorted(self._partitions.get((kind, resolution), ()), reverse=desc)
+        with self.engine.connect() as conn:
+            for partition in starts:
+                if partition >= end or (start is not None and partition_end(partition, unit) <= start):
+                    continue
+                key = (kind, resolution, partition)
+                with self._lock:
+                    # 取得分区列表之后，分区可能已被保留期清理删除
+                    if partition not in self._partitions.get((kind, resolution), ()):
+                        continue
+                    self._reading[key] = self._reading.get(key, 0) + 1
+                try:
+                    table = self._table(kind, resolution, partition)
+                    query = select(*[table.c[c] for c in columns]) if columns else select(table)
+                    query = query.where(table.c.timestamp < end)
+                    if start is not None:
+                        query = query.where(table.c.timestamp >= start)
+                    query = query.order_by(table.c.timestamp.desc() if desc else table.c.timestamp)
+                    if limit is not None:
+                        query = query.limit(limit)
+                    for row in conn.execute(query):
+                        yield row
+                        if limit is not None:
+                            limit -= 1
+                finally:
+                    with self._lock:
+                        self._reading[key] -= 1
+                        if not self._reading[key]:
+                            del self._reading[key]
+                if limit is not None and limit <= 0:
+                    return
+
+    def rollup(self, now: Optional[datetime] = None) -> None:
+        """汇总已经结束、尚未汇总的时间桶"""
+        now = now or datetime.utcnow()
+        for kind in KINDS:
+            for resolution, (step, unit) in ROLLUPS.items():
+                try:
+                    self._rollup(kind, resolution, step, unit, now)
+                except Exception as e:
+                    logger.error(f"汇总监控数据失败 - {kind} {resolution}: {str(e)}")
+
+    def _resume_point(self, kind: str, resolution: str, step: int) -> Optional[datetime]:
+        """服务启动后第一个需要汇总的时间桶：已汇总的最后一个桶之后，或最早的原始数据所在的桶"""
+        with self._lock:
+            rolled = sorted(self._partitions.get((kind, resolution), ()))
+            raw = sorted(self._partitions.get((kind, "raw"), ()))
+        with self.engine.connect() as conn:
+            if rolled:
+                table = self._table(kind, resolution, rolled[-1])
+                last = conn.execute(select(func.max(table.c.timestamp))).scalar()
+                if last is not None:
+                    return last + timedelta(seconds=step)
+            for start in raw:
+                table = self._table(kind, "raw", start)
+                first = conn.execute(select(func.min(table.c.timestamp))).scalar()
+                if first is not None:
+                    return floor_time(first, step)
+        return None
+
+    def _rollup(self, kind: str, resolution: str, step: int, unit: str, now: datetime) -> None:
+        key = (kind, resolution)
+        current = floor_time(now, step)
+        done = self._rolled.get(key) or self._resume_point(kind, resolution, step)
+        if done is None:
+            return
+        # 原始数据已经删除的时间段无法汇总
+        done = max(done, floor_time(now - timedelta(days=self.retention["raw"]), step))
+        if done >= current:
+            self._rolled[key] = done
+            return
+
+        fields = ROLLUP_FIELDS[kind]
+        buckets: Dict[datetime, List[Any]] = {}
+        for row in self._scan(kind, "raw", done, current, ["timestamp"] + fields):
+            buckets.setdefault(floor_time(row[0], step), []).append(row[1:])
+        rows = [self._aggregate(bucket, values, fields) for bucket, values in sorted(buckets.items())]
+        groups = [(self._ensure(kind, resolution, start), list(group))
+                  for start, group in groupby(rows, key=lambda r: partition_start(r["timestamp"], unit))]
+        with self.engine.begin() as conn:
+            for table, group in groups:
+                # 重新汇总时覆盖已有的时间桶
+                conn.execute(table.delete().where(
+                    table.c.timestamp >= group[0]["timestamp"],
+                    table.c.timestamp <= group[-1]["timestamp"]
+                ))
+                conn.execute(table.insert(), group)
+        self._rolled[key] = current
+
+    @staticmethod
+    def _aggregate(bucket: datetime, values: List[Any], fields: List[str]) -> Dict[str, Any]:
+        row = {"timestamp": bucket, "samples": len(values)}
+        for i, field in enumerate(fields):
+            column = sorted(v[i] for v in values if v[i] is not None)
+            row[f"{field}_min"] = column[0] if column else None
+            row[f"{field}_max"] = column[-1] if column else None
+            row[f"{field}_avg"] = sum(column) / len(column) if column else None
+            row[f"{field}_p95"] = percentile(column, 0.95) if column else None
+        return row
+
+    def enforce_retention(self, now: Optional[datetime] = None, raw_days: Optional[int] = None) -> int:
+        """删除整个分区都已超过保留期的分区表，返回删除的分区数"""
+        now = now or datetime.utcnow()
+        dropped = 0
+        busy = 0
+        with self._lock:
+            partitions = {key: sorted(starts) for key, starts in self._partitions.items()}
+        for (kind, resolution), starts in partitions.items():
+            days = raw_days if resolution == "raw" and raw_days is not None else self.retention.get(resolution)
+            if days is None:
+                continue  # 未配置保留期的精度永久保留
+            cutoff = now - timedelta(days=days)
+            unit = self._unit(resolution)
+            for start in starts:
+                if partition_end(start, unit) > cutoff:
+                    break
+                with self._lock:
+                    if self._reading.get((kind, resolution, start)):
+                        busy += 1
+                        continue
+                    # 先从分区列表中移除，之后开始的查询不再读取该分区
+                    self._partitions[(kind, resolution)].discard(start)
+                table = self._table(kind, resolution, start)
+                try:
+                    table.drop(self.engine, checkfirst=True)
+                except Exception:
+                    with self._lock:
+                        self._partitions[(kind, resolution)].add(start)
+                    raise
+                with self._lock:
+                    metrics_metadata.remove(table)
+                dropped += 1
+        # 有分区正在被查询时不记录日期，下次写入后重试
+        if not busy:
+            self._retained_on = now.date()
+        if dropped:
+            logger.info(f"已删除{dropped}个过期的监控数据分区")
+        return dropped
+
+    def resolution_for(self, start: datetime, end: datetime, max_points: int,
+                       step: Optional[int] = None) -> str:
+        """
+        查询[start, end]时使用的精度
+        指定step（秒）时选择不超过step的最粗精度，否则选择数据点数不超过max_points的最高精度；
+        都只考虑数据仍在保留期内的精度
+        """
+        span = (end - start).total_seconds()
+        oldest = datetime.utcnow() - start
+        steps = [("raw", self.interval)] + [(r, s) for r, (s, _) in ROLLUPS.items()]
+        retained = [(resolution, resolution_step) for resolution, resolution_step in steps
+                    if self.retention.get(resolution) is None
+                    or oldest <= timedelta(days=self.retention[resolution])]
+        if step is not None:
+            finer = [resolution for resolution, resolution_step in retained if resolution_step <= step]
+            if finer:
+                return finer[-1]
+        for resolution, resolution_step in retained:
+            if span / resolution_step <= max_points:
+                return resolution
+        return "1d"
+
+    def series(self, kind: str, start: datetime, end: datetime, max_points: int = 500,
+               step: Optional[int] = None, resolution: Optional[str] = None,
+               method: str = "avg") -> Dict[str, Any]:
+        """
+        列式返回[start, end]内的数据：timestamps（毫秒时间戳）和每个指标一个数组，点数不超过max_points
+        汇总数据取平均值；数据点超过max_points（或指定了step）时按时间桶加权平均降采样，
+        method为lttb时按第一个指标用LTTB算法挑选数据点，保留曲线的峰谷
+        """
+        if resolution is None:
+            resolution = self.resolution_for(start, end, max_points * OVERSAMPLE, step)
+        fields = ROLLUP_FIELDS[kind]
+        raw = resolution == "raw"
+        columns = ["timestamp"] + (fields if raw else [f"{field}_avg" for field in fields] + ["samples"])
+
+        timestamps: List[int] = []
+        values: List[List[Optional[float]]] = [[] for _ in fields]
+        weights: List[int] = []
+        for row in self._scan(kind, resolution, start, end + timedelta(microseconds=1), columns):
+            timestamps.append(int((row[0] - EPOCH).total_seconds() * 1000))
+            for i, column in enumerate(values):
+                column.append(row[i + 1])
+            weights.append(1 if raw else row[-1])
+
+        # 按时间桶降采样时桶的数量不超过max_points
+        span = (end - start).total_seconds()
+        min_step = math.ceil(span / max(1, max_points - 1)) if len(timestamps) > max_points else 0
+        if step is not None or (min_step and method != "lttb"):
+            step = max(step or 0, min_step)
+            timestamps, values = bucket_average(timestamps, values, weights, step * 1000)
+        elif len(timestamps) > max_points:
+            keep = lttb(timestamps, values[0], max_points)
+            timestamps = [timestamps[i] for i in keep]
+            values = [[column[i] for i in keep] for column in values]
+        result = {"resolution": resolution, "step": step, "timestamps": timestamps}
+        for field, column in zip(fields, values):
+            result[field] = [round(v, 2) if v is not None else None for v in column]
+        return result
+
+    def export_columns(self, kind: str, resolution: str) -> List[Tuple[str, type]]:
+        """导出的列名及其Python类型（不含自增id）"""
+        factory = raw_partition if resolution == "raw" else rollup_partition
+        table = factory(kind, f"{kind}_{resolution}", MetaData())
+        return [(c.name, c.type.python_type) for c in table.columns if c.name != "id"]
+
+    def export_rows(self, kind: str, resolution: str, start: Optional[datetime], end: datetime,
+                    chunk_size: int = 5000) -> Iterator[List[Any]]:
+        """按时间顺序分块读取[start, end]内的数据，用于流式导出"""
+        columns = [name for name, _ in self.export_columns(kind, resolution)]
+        chunk = []
+        for row in self._scan(kind, resolution, start, end + timedelta(microseconds=1), columns):
+            chunk.append(row)
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    def status(self) -> Dict[str, Any]:
+        with self._lock:
+            partitions = {f"{kind}:{resolution}": len(starts) for (kind, resolution), starts in self._partitions.items()}
+        return {
+            "interval": self.interval,
+            "retention_days": self.retention,
+            "partitions": partitions,
+            "pending": len(self._pending),
+            "flushed": self.flushed,
+            "dropped": self.dropped
+        }
+
+# 全局时序存储
+metric_store = MetricStore(engine)
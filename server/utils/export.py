@@ -0,0 +1,66 @@
+import csv
+import io
+import json
+from datetime import datetime
+from typing import Any, Iterable, Iterator, List, Tuple
+
+try:
+    import pyarrow as pa
+except ImportError:  # arrow格式为可选功能
+    pa = None
+
+# 导出格式: (媒体类型, 文件扩展名)
+EXPORT_FORMATS = {
+    "csv": ("text/csv", "csv"),
+    "ndjson": ("application/x-ndjson", "ndjson"),
+    "arrow": ("application/vnd.apache.arrow.stream", "arrow")
+}
+
+Columns = List[Tuple[str, type]]
+
+def _value(value: Any) -> Any:
+    return value.isoformat() if isinstance(value, datetime) else value
+
+def encode_csv(columns: Columns, chunks: Iterable[List[Any]]) -> Iterator[bytes]:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow([name for name, _ in columns])
+    yield buffer.getvalue().encode("utf-8")
+    for chunk in chunks:
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerows([_value(v) for v in row] for row in chunk)
+        yield buffer.getvalue().encode("utf-8")
+
+def encode_ndjson(columns: Columns, chunks: Iterable[List[Any]]) -> Iterator[bytes]:
+    names = [name for name, _ in columns]
+    for chunk in chunks:
+        yield "".join(
+            json.dumps(dict(zip(names, map(_value, row))), ensure_ascii=False) + "\n" for row in chunk
+        ).encode("utf-8")
+
+def encode_arrow(columns: Columns, chunks: Iterable[List[Any]]) -> Iterator[bytes]:
+    """Arrow IPC 流格式，每块数据一个record batch"""
+    types = {datetime: pa.timestamp("us"), float: pa.float64(), int: pa.int64(), str: pa.string()}
+    schema = pa.schema([(name, types[python_type]) for name, python_type in columns])
+    sink = io.BytesIO()
+    writer = pa.ipc.new_stream(sink, schema)
+    for chunk in chunks:
+        arrays = [pa.array([row[i] for row in chunk], type=field.type) for i, field in enumerate(schema)]
+        writer.write_batch(pa.record_batch(arrays, schema=schema))
+        yield sink.getvalue()
+        sink.seek(0)
+        sink.truncate()
+    writer.close()
+    yield sink.getvalue()
+
+def encode_rows(fmt: str, columns: Columns, chunks: Iterable[List[Any]]) -> Iterator[bytes]:
+    """
+    把按块读取的数据行编码为指定格式的字节流，用于流式响应
+    """
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"不支持的导出格式: {fmt}")
+    if fmt == "arrow" and pa is None:
+        raise ValueError("导出arrow格式需要安装pyarrow")
+    encoder = {"csv": encode_csv, "ndjson": encode_ndjson, "arrow": encode_arrow}[fmt]
+    return encoder(columns, chunks)
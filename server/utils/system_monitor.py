@@ -1,27 +1,44 @@
 import psutil
 import os
 import sqlite3
-from typing import Dict, Any
+import asyncio
+import time
+from typing import Dict, Any, Callable, List, Optional
 import logging
 from datetime import datetime
 
 logger = logging.getLogger(__name__)
 
-async def get_system_resources() -> Dict[str, Any]:
+class ResourceSampler:
     """
-    获取系统资源使用情况
-    返回CPU、内存和磁盘使用率
+    后台资源采样器
+    按固定间隔在线程池中采集CPU、内存、磁盘和网络信息，保存为内存中的快照；
+    接口直接返回最近一次的快照，不阻塞事件循环，无论多少客户端轮询，每个间隔只采集一次
     """
-    try:
-        # CPU使用率
-        cpu_percent = psutil.cpu_percent(interval=1)
-        
-        # 内存信息
+
+    def __init__(self, interval: float = 60, protocol: str = "HTTP"):
+        self.interval = interval
+        self.protocol = protocol
+        self.resources: Optional[Dict[str, Any]] = None
+        self.network: Optional[Dict[str, Any]] = None
+        self.sampled_at = 0.0
+        self.samples = 0
+        self._listeners: List[Callable[[Dict[str, Any], Dict[str, Any]], None]] = []
+        self._task: Optional[asyncio.Task] = None
+        self._first: Optional[asyncio.Future] = None
+
+    def on_sample(self, listener: Callable[[Dict[str, Any], Dict[str, Any]], None]) -> None:
+        """
+        注册采样回调，每次采样后以(资源快照, 网络快照)调用
+        回调在采样线程中执行
+        """
+        self._listeners.append(listener)
+
+    def _sample_resources(self) -> Dict[str, Any]:
+        # 不指定interval时返回距上次调用期间的平均CPU使用率，不会阻塞
+        cpu_percent = psutil.cpu_percent(interval=None)
         memory = psutil.virtual_memory()
-        
-        # 磁盘信息
         disk = psutil.disk_usage('/')
-        
         return {
             "cpu": cpu_percent,
             "memory": memory.percent,
@@ -34,6 +51,95 @@ async def get_system_resources() -> Dict[str, Any]:
                 "timestamp": datetime.now().isoformat()
             }
         }
+
+    def _sample_network(self) -> Dict[str, Any]:
+        network_info = psutil.net_if_stats()
+        try:
+            connections = len(psutil.net_connections())
+        except psutil.AccessDenied:
+            # 部分系统需要root权限才能列出全部连接
+            connections = None
+        return {
+            "protocol": self.protocol,
+            "interfaces": len(network_info),
+            "active_connections": connections,
+            "details": {
+                "interfaces": [name for name in network_info.keys()],
+                "timestamp": datetime.now().isoformat()
+            }
+        }
+
+    def sample(self) -> None:
+        """采集一次并替换快照（在线程池中执行）"""
+        resources = self._sample_resources()
+        network = self._sample_network()
+        self.resources, self.network = resources, network
+        self.sampled_at = time.time()
+        self.samples += 1
+        for listener in self._listeners:
+            try:
+                listener(resources, network)
+            except Exception as e:
+                logger.error(f"处理采样结果失败: {str(e)}")
+
+    def start(self) -> None:
+        """启动后台采样，重复调用无效"""
+        if self._task is not None:
+            return
+        # 第一次调用只记录CPU时间基准，之后的采样返回两次之间的平均值
+        psutil.cpu_percent(interval=None)
+        self._first = asyncio.get_running_loop().create_future()
+        self._task = asyncio.ensure_future(self._loop())
+
+    async def _loop(self) -> None:
+        loop = asyncio.get_running_loop()
+        # 第一次采样前等待一小段时间，让CPU使用率有意义
+        await asyncio.sleep(min(self.interval, 0.5))
+        while True:
+            started = time.monotonic()
+            try:
+                await loop.run_in_executor(None, self.sample)
+                if not self._first.done():
+                    self._first.set_result(None)
+            except Exception as e:
+                logger.error(f"采集系统资源失败: {str(e)}")
+                if not self._first.done():
+                    # 正在等待第一次采样的请求返回错误，之后的请求等待下一次采样
+                    failed, self._first = self._first, loop.create_future()
+                    failed.set_exception(e)
+                    failed.exception()
+            await asyncio.sleep(max(0.0, self.interval - (time.monotonic() - started)))
+
+    async def latest(self) -> Dict[str, Dict[str, Any]]:
+        """最近一次的快照；服务刚启动尚未采集时等待第一次采样完成"""
+        if self.resources is None:
+            self.start()
+            await asyncio.shield(self._first)
+        return {"resources": self.resources, "network": self.network}
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            "interval": self.interval,
+            "samples": self.samples,
+            "sampled_at": datetime.fromtimestamp(self.sampled_at).isoformat() if self.sampled_at else None
+        }
+
+# 全局采样器，使用前可修改interval和protocol
+sampler = ResourceSampler()
+
+async def get_system_resources() -> Dict[str, Any]:
+    """
+    获取系统资源使用情况
+    返回后台采样器最近一次采集的CPU、内存和磁盘使用率
+    """
+    try:
+        return (await sampler.latest())["resources"]
     except Exception as e:
         logger.error(f"获取系统资源信息失败: {str(e)}")
         raise Exception("获取系统资源信息失败")
@@ -89,22 +195,10 @@ async def check_db_connection() -> Dict[str, Any]:
 async def get_network_info() -> Dict[str, Any]:
     """
     获取网络协议信息
+    返回后台采样器最近一次采集的结果
     """
     try:
-        # 获取网络接口信息
-        network_info = psutil.net_if_stats()
-        # 获取网络连接信息
-        connections = psutil.net_connections()
-        
-        return {
-            "protocol": "HTTP",  # 默认为HTTP，如果配置了SSL则为HTTPS
-            "interfaces": len(network_info),
-            "active_connections": len(connections),
-            "details": {
-                "interfaces": [name for name in network_info.keys()],
-                "timestamp": datetime.now().isoformat()
-            }
-        }
+        return (await sampler.latest())["network"]
     except Exception as e:
         logger.error(f"获取网络信息失败: {str(e)}")
         raise Exception("获取网络信息失败") 
\ No newline at end of file